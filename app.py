@@ -1,94 +1,63 @@
 import logging
-import os
-import re
-import shutil
-import stat
 import subprocess
-import time
-import uuid
-from contextlib import contextmanager
+import sys
 from pathlib import Path
 
 import gradio as gr
-import requests
 
-from tm import create_tm
+from jobs import JOB_WORKERS, JobQueue
 
 logging.basicConfig(format="%(asctime)s - %(message)s", level=logging.INFO)
 
-GITHUB_TOKEN = os.getenv("GITHUB_TOKEN")
-
-ALIGNER_SCRIPT_DIR = Path("./tibetan-aligner").resolve()
-ALIGNER_SCRIPT_NAME = "align_tib_en.sh"
-ALIGNER_SCRIPT_PATH = ALIGNER_SCRIPT_DIR / ALIGNER_SCRIPT_NAME
-assert ALIGNER_SCRIPT_PATH.is_file()
-
-
-def make_dir_executable(dir_path: Path):
-    for fn in dir_path.iterdir():
-        st = os.stat(fn)
-        os.chmod(fn, st.st_mode | stat.S_IEXEC)
-        st = os.stat(fn)
-        os.chmod(fn, st.st_mode | stat.S_IXGRP)
-        st = os.stat(fn)
-        os.chmod(fn, st.st_mode | stat.S_IXOTH)
-
-
-make_dir_executable(ALIGNER_SCRIPT_DIR)
-
-
-@contextmanager
-def TemporaryDirectory():
-    tmpdir = Path("./output").resolve() / uuid.uuid4().hex[:8]
-    tmpdir.mkdir(exist_ok=True, parents=True)
-    try:
-        yield tmpdir
-    finally:
-        shutil.rmtree(str(tmpdir))
-
-
-def download_file(github_file_url: str, output_fn) -> Path:
-    """Download file from github"""
-    headers = {
-        "Authorization": f"token {GITHUB_TOKEN}",
-        "Accept": "application/vnd.github+json",
-    }
-    authenticated_file_url = f"{github_file_url}?token={GITHUB_TOKEN}"
-    with requests.get(authenticated_file_url, headers=headers, stream=True) as r:
-        r.raise_for_status()
-        with open(output_fn, "wb") as f:
-            for chunk in r.iter_content(chunk_size=8192):
-                f.write(chunk)
-    return output_fn
-
-
-def _run_align_script(bo_fn, en_fn, output_dir):
-    start = time.time()
-    cmd = [str(ALIGNER_SCRIPT_PATH), str(bo_fn), str(en_fn), str(output_dir)]
-    output = subprocess.run(
-        cmd,
-        check=True,
-        capture_output=True,
-        text=True,
-        cwd=str(ALIGNER_SCRIPT_DIR),
-    )
-    output_fn = re.search(r"\[OUTPUT\] (.*)", output.stdout).group(1)
-    output_fn = "/" + output_fn.split("//")[-1]
-    end = time.time()
-    total_time = round((end - start) / 60, 2)
-    logging.info(f"Total time taken for Aligning: {total_time} mins")
-    return output_fn
+job_queue = None
+
+
+def get_job_queue() -> JobQueue:
+    global job_queue
+    if job_queue is None:
+        job_queue = JobQueue(max_workers=JOB_WORKERS)
+    return job_queue
+
+
+def metrics():
+    return {"workers": get_job_queue().worker_metrics()}
+
+
+def submit(text_pairs):
+    """Queue one text pair, or a list of them, and return the job id(s) right away"""
+    if isinstance(text_pairs, list):
+        return {"job_ids": get_job_queue().submit_batch(text_pairs)}
+    return {"job_id": get_job_queue().submit(text_pairs)}
+
+
+def status(request):
+    job_ids = request.get("job_ids") or [request["job_id"]]
+    return {job_id: get_job_queue().status(job_id) for job_id in job_ids}
+
+
+def result(request):
+    return get_job_queue().result(request["job_id"], wait=request.get("wait", False))
+
+
+def submit_batch(text_pairs):
+    """Queue a list of text pairs to be aligned together as one job"""
+    return {"job_id": get_job_queue().submit_aligned_batch(text_pairs)}
+
+
+def align_batch(text_pairs):
+    job_id = get_job_queue().submit_aligned_batch(text_pairs)
+    job = get_job_queue().result(job_id, wait=True)
+    if job["status"] != "done":
+        raise gr.Error(job["error"])
+    return job["result"]
 
 
 def align(text_pair):
-    logging.info(f"Running aligner for TM{text_pair['text_id']}...")
-    with TemporaryDirectory() as tmpdir:
-        output_dir = Path(tmpdir)
-        bo_fn = download_file(text_pair["bo_file_url"], output_fn=output_dir / "bo.tx")
-        en_fn = download_file(text_pair["en_file_url"], output_fn=output_dir / "en.tx")
-        aligned_fn = _run_align_script(bo_fn, en_fn, output_dir)
-        repo_url = create_tm(aligned_fn, text_pair=text_pair)
-        return {"tm_repo_url": repo_url}
+    job_id = get_job_queue().submit(text_pair)
+    job = get_job_queue().result(job_id, wait=True)
+    if job["status"] != "done":
+        raise gr.Error(job["error"])
+    return job["result"]
 
 
 with gr.Blocks() as demo:
@@ -109,7 +78,30 @@ with gr.Blocks() as demo:
         outputs=output,
         api_name="align",
     )
+    for fn, api_name in [
+        (submit, "submit"),
+        (submit_batch, "submit_batch"),
+        (align_batch, "align_batch"),
+        (status, "status"),
+        (result, "result"),
+    ]:
+        job_input = gr.JSON(visible=False)
+        job_output = gr.JSON(visible=False)
+        job_btn = gr.Button(api_name, visible=False)
+        job_btn.click(fn=fn, inputs=job_input, outputs=job_output, api_name=api_name)
+    metrics_output = gr.JSON(visible=False)
+    metrics_btn = gr.Button("Model metrics", visible=False)
+    metrics_btn.click(
+        fn=metrics,
+        inputs=None,
+        outputs=metrics_output,
+        api_name="model_metrics",
+    )
 
 
 if __name__ == "__main__":
+    # compile the DP kernels once, before the job workers import them; without them they use the NumPy kernels
+    subprocess.run([sys.executable, "build_dp_core.py"], cwd=Path(__file__).parent / "tibetan-aligner")
+    get_job_queue().warm_up()
+    demo.queue(concurrency_count=max(JOB_WORKERS, 1) + 8)
     demo.launch(server_name="0.0.0.0", server_port=7860, show_error=True, debug=True)
@@ -0,0 +1,248 @@
+"""
+Download of the input texts, with an on-disk cache.
+
+Every URL is cached together with its ETag/Last-Modified and the sha256 of its
+body. A cached file is revalidated with a conditional request and only fetched
+again if it changed, so re-aligning a text after a parameter change does not
+download it twice. A cached file whose body no longer matches its sha256 is
+fetched again. Interrupted transfers are resumed with a Range request, and
+the least recently used files are evicted once the cache grows past max_bytes.
+Partial downloads left behind by crashed processes are removed once they are
+older than DOWNLOAD_PART_MAX_AGE seconds.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import List, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+GITHUB_TOKEN = os.getenv("GITHUB_TOKEN")
+DOWNLOAD_CACHE_DIR = os.getenv("DOWNLOAD_CACHE_DIR", "./cache/downloads")
+DOWNLOAD_CACHE_MAX_BYTES = int(os.getenv("DOWNLOAD_CACHE_MAX_BYTES", 1024**3))
+DOWNLOAD_RETRIES = int(os.getenv("DOWNLOAD_RETRIES", 3))
+# a partial download untouched for this long belongs to a process that is gone
+DOWNLOAD_PART_MAX_AGE = int(os.getenv("DOWNLOAD_PART_MAX_AGE", 3600))
+
+CHUNK_SIZE = 1024 * 1024
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session() -> requests.Session:
+    """Process-wide session, so that connections to github are reused between downloads"""
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+            _session.mount("https://", adapter)
+            _session.mount("http://", adapter)
+            _session.headers.update(
+                {
+                    "Authorization": f"token {GITHUB_TOKEN}",
+                    "Accept": "application/vnd.github+json",
+                }
+            )
+        return _session
+
+
+def _sha256(fn: Path) -> str:
+    h = hashlib.sha256()
+    with open(fn, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class DownloadCache:
+    def __init__(self, cache_dir, max_bytes: int = DOWNLOAD_CACHE_MAX_BYTES):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self._sweep()
+
+    def _paths(self, url: str):
+        key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        return self.cache_dir / f"{key}.body", self.cache_dir / f"{key}.json"
+
+    def get(self, url: str) -> Optional[dict]:
+        """Metadata of the cached copy of url, or None if there is no intact copy"""
+        body_fn, meta_fn = self._paths(url)
+        try:
+            meta = json.loads(meta_fn.read_text())
+            if body_fn.stat().st_size != meta["size"]:
+                return None
+            sha256 = _sha256(body_fn)
+        except (OSError, ValueError):
+            return None
+        if sha256 != meta["sha256"]:
+            logging.warning(f"Cached copy of {url} is corrupt, dropping it")
+            self._remove(body_fn)
+            return None
+        meta["path"] = str(body_fn)
+        return meta
+
+    def touch(self, url: str):
+        body_fn, _ = self._paths(url)
+        try:
+            os.utime(body_fn)
+        except OSError:
+            pass
+
+    def put(self, url: str, tmp_fn: Path, etag=None, last_modified=None) -> dict:
+        """Move a completely downloaded tmp_fn into the cache"""
+        body_fn, meta_fn = self._paths(url)
+        meta = {
+            "url": url,
+            "etag": etag,
+            "last_modified": last_modified,
+            "sha256": _sha256(tmp_fn),
+            "size": tmp_fn.stat().st_size,
+        }
+        # write to unique names and rename, so concurrent workers never see a half-written entry
+        tmp_meta_fn = meta_fn.with_suffix(f".{uuid.uuid4().hex}.tmp")
+        tmp_meta_fn.write_text(json.dumps(meta))
+        os.replace(tmp_fn, body_fn)
+        os.replace(tmp_meta_fn, meta_fn)
+        self._evict()
+        meta["path"] = str(body_fn)
+        return meta
+
+    def size_bytes(self) -> int:
+        return sum(fn.stat().st_size for fn in self.cache_dir.glob("*.body"))
+
+    @staticmethod
+    def _remove(body_fn: Path):
+        for fn in (body_fn, body_fn.with_suffix(".json")):
+            try:
+                fn.unlink()
+            except OSError:
+                pass
+
+    def _sweep(self):
+        """Remove partial downloads and metadata files that their (crashed) writers never finished"""
+        now = time.time()
+        for pattern in ("*.part", "*.tmp"):
+            for fn in self.cache_dir.glob(pattern):
+                try:
+                    if now - fn.stat().st_mtime > DOWNLOAD_PART_MAX_AGE:
+                        fn.unlink()
+                except OSError:
+                    pass
+
+    def _evict(self):
+        self._sweep()
+        bodies = []
+        for fn in self.cache_dir.glob("*.body"):
+            try:
+                stat = fn.stat()
+            except OSError:
+                continue
+            bodies.append((stat.st_mtime, stat.st_size, fn))
+        excess = sum(size for _, size, _ in bodies) - self.max_bytes
+        # drop least recently used files until we are back under the limit
+        for _, size, fn in sorted(bodies):
+            if excess <= 0:
+                break
+            self._remove(fn)
+            excess -= size
+
+
+def get_download_cache(cache_dir=DOWNLOAD_CACHE_DIR) -> Optional[DownloadCache]:
+    """Cache in cache_dir, or None if caching is disabled by setting DOWNLOAD_CACHE_DIR to ''"""
+    if not cache_dir:
+        return None
+    return DownloadCache(cache_dir)
+
+
+def _fetch(url: str, part_fn: Path, headers: dict) -> requests.Response:
+    """
+    GET url into part_fn, resuming from whatever part_fn already holds if the transfer is interrupted.
+    Returns the response of the first request (for its status and validators).
+    """
+    # the token goes in the session's Authorization header only, so it never shows up in urls, logs or errors
+    session = get_session()
+    first_response = None
+    for attempt in range(DOWNLOAD_RETRIES + 1):
+        done = part_fn.stat().st_size if part_fn.exists() else 0
+        request_headers = dict(headers)
+        if done:
+            request_headers["Range"] = f"bytes={done}-"
+            if first_response is not None and first_response.headers.get("ETag"):
+                request_headers["If-Range"] = first_response.headers["ETag"]
+        try:
+            with session.get(url, headers=request_headers, stream=True, timeout=60) as r:
+                if first_response is None:
+                    first_response = r
+                if r.status_code == 304:
+                    return r
+                r.raise_for_status()
+                # the server ignored the Range header, start over
+                mode = "ab" if done and r.status_code == 206 else "wb"
+                with open(part_fn, mode) as f:
+                    for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                        f.write(chunk)
+                return first_response
+        except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+            if attempt == DOWNLOAD_RETRIES:
+                raise
+            logging.warning(f"Download of {url} interrupted ({e}), retrying...")
+            time.sleep(2**attempt)
+
+
+def download_file(github_file_url: str, output_fn, cache: Optional[DownloadCache] = None) -> Path:
+    """Download file from github, or copy it from cache if it has not changed upstream"""
+    output_fn = Path(output_fn)
+    # download into the cache dir, so that adding the file to the cache is a rename
+    part_dir = cache.cache_dir if cache is not None else output_fn.parent
+    part_fn = part_dir / f"{uuid.uuid4().hex}.part"
+    headers = {}
+    cached = cache.get(github_file_url) if cache is not None else None
+    if cached is not None:
+        if cached["etag"]:
+            headers["If-None-Match"] = cached["etag"]
+        if cached["last_modified"]:
+            headers["If-Modified-Since"] = cached["last_modified"]
+
+    try:
+        r = _fetch(github_file_url, part_fn, headers)
+        if r.status_code == 304:
+            logging.info(f"{github_file_url} not modified, using cached copy")
+            cache.touch(github_file_url)
+            try:
+                shutil.copyfile(cached["path"], output_fn)
+            except FileNotFoundError:
+                # evicted by another download in the meantime, fetch it again
+                return download_file(github_file_url, output_fn, cache=cache)
+            return output_fn
+        # copy out before handing the file to the cache, where it may be evicted at any time
+        shutil.copyfile(part_fn, output_fn)
+        if cache is not None:
+            cache.put(
+                github_file_url,
+                part_fn,
+                etag=r.headers.get("ETag"),
+                last_modified=r.headers.get("Last-Modified"),
+            )
+        return output_fn
+    finally:
+        if part_fn.exists():
+            part_fn.unlink()
+
+
+def download_files(urls: List[str], output_fns: List[Path], cache: Optional[DownloadCache] = None) -> List[Path]:
+    """Download several files at once over the shared session"""
+    with ThreadPoolExecutor(max_workers=max(len(urls), 1)) as executor:
+        futures = [executor.submit(download_file, url, fn, cache) for url, fn in zip(urls, output_fns)]
+        return [future.result() for future in futures]
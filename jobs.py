@@ -0,0 +1,233 @@
+import logging
+import multiprocessing
+import os
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, List
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", 2))
+# finished jobs, with their results, are forgotten after JOB_TTL seconds or once there are more than JOB_HISTORY
+JOB_TTL = float(os.getenv("JOB_TTL", 24 * 3600))
+JOB_HISTORY = int(os.getenv("JOB_HISTORY", 1000))
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+def _update(jobs, job_id: str, **fields):
+    # manager dict proxies only see changes made by reassigning the value
+    job = jobs[job_id]
+    job.update(fields)
+    jobs[job_id] = job
+
+
+def _init_worker(workers, max_workers):
+    """Load the model once per worker process, before the first job arrives"""
+    logging.basicConfig(format="%(asctime)s - %(message)s", level=logging.INFO)
+    # share the cores between the workers: DP threads of one alignment, DP processes of a batch
+    cores = str(max((os.cpu_count() or 1) // max_workers, 1))
+    os.environ.setdefault("DP_NUM_THREADS", cores)
+    os.environ.setdefault("BATCH_DP_WORKERS", cores)
+    import pipeline  # noqa: F401  (puts tibetan-aligner on sys.path)
+    from dp_utils import DP_CORE_BACKEND, DP_CORE_IMPORT_TIME
+    from model_registry import model_metrics, preload_model
+
+    preload_model()
+    workers[os.getpid()] = {
+        **model_metrics(),
+        "dp_core_backend": DP_CORE_BACKEND,
+        "dp_core_import_time_s": DP_CORE_IMPORT_TIME,
+    }
+
+
+def _run_job(job_id: str, text_pair: Dict[str, str], jobs, align_fn=None):
+    import pipeline
+    from pipeline import STAGES
+
+    align_fn = align_fn or pipeline.align
+
+    def report_stage(stage):
+        _update(
+            jobs,
+            job_id,
+            stage=stage,
+            stages_done=STAGES.index(stage),
+            stage_started_at=time.time(),
+        )
+
+    _update(jobs, job_id, status=RUNNING, started_at=time.time(), worker_pid=os.getpid())
+    try:
+        result = align_fn(text_pair, report_stage=report_stage)
+    except Exception as e:
+        logging.error(f"Job {job_id} failed: {e}")
+        _update(
+            jobs,
+            job_id,
+            status=FAILED,
+            error=f"{type(e).__name__}: {e}",
+            traceback=traceback.format_exc(),
+            finished_at=time.time(),
+        )
+        return
+    _update(
+        jobs,
+        job_id,
+        status=DONE,
+        stage=None,
+        stages_done=len(STAGES),
+        result=result,
+        finished_at=time.time(),
+    )
+
+
+def _run_batch_job(job_id: str, text_pairs: List[Dict[str, str]], jobs):
+    import pipeline
+
+    return _run_job(job_id, text_pairs, jobs, align_fn=pipeline.align_batch)
+
+
+class JobQueue:
+    """
+    Runs alignment jobs on a bounded pool of worker processes.
+
+    submit() returns a job id right away; status() and result() can be polled with it.
+    Each worker loads the model once and then runs one job at a time.
+    If a worker process dies (e.g. out of memory), the pool is started again: the jobs that were
+       running fail, the queued ones run on the new pool.
+    """
+
+    def __init__(self, max_workers: int = JOB_WORKERS, ttl: float = JOB_TTL, history: int = JOB_HISTORY):
+        # spawn, not fork: torch does not survive being forked after it has started threads
+        self._ctx = multiprocessing.get_context("spawn")
+        self._manager = self._ctx.Manager()
+        self._jobs = self._manager.dict()
+        self._workers = self._manager.dict()
+        self.max_workers = max_workers
+        self.ttl = ttl
+        self.history = history
+        self._lock = threading.Lock()
+        self._executor = self._new_executor()
+
+    def _new_executor(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(
+            max_workers=self.max_workers,
+            mp_context=self._ctx,
+            initializer=_init_worker,
+            initargs=(self._workers, self.max_workers),
+        )
+
+    def _restart(self, broken: ProcessPoolExecutor):
+        """Replace the executor with a new one, unless another caller already did"""
+        with self._lock:
+            if self._executor is not broken:
+                return
+            logging.error("A worker process died, restarting the worker pool")
+            # not wait=True: this may run on the broken pool's own management thread
+            broken.shutdown(wait=False)
+            self._workers.clear()
+            self._executor = self._new_executor()
+
+    def warm_up(self):
+        """Start every worker now, so the model is loaded before the first job arrives"""
+        # the pool only starts a new process when no idle one is free, so keep each one busy until all have started
+        barrier = self._manager.Barrier(self.max_workers)
+        for future in [self._executor.submit(barrier.wait) for _ in range(self.max_workers)]:
+            future.result()
+
+    def _submit(self, fn, text_pairs, text_id) -> str:
+        job_id = uuid.uuid4().hex
+        self._jobs[job_id] = {
+            "job_id": job_id,
+            "text_id": text_id,
+            "status": QUEUED,
+            "stage": None,
+            "stages_done": 0,
+            "submitted_at": time.time(),
+        }
+        self._evict()
+        self._enqueue(job_id, fn, text_pairs)
+        return job_id
+
+    def _enqueue(self, job_id: str, fn, text_pairs):
+        executor = self._executor
+        try:
+            future = executor.submit(fn, job_id, text_pairs, self._jobs)
+        except BrokenProcessPool:
+            self._restart(executor)
+            return self._enqueue(job_id, fn, text_pairs)
+        future.add_done_callback(lambda f: self._on_done(job_id, f, executor, fn, text_pairs))
+
+    def submit(self, text_pair: Dict[str, str]) -> str:
+        return self._submit(_run_job, text_pair, text_pair.get("text_id"))
+
+    def submit_batch(self, text_pairs: List[Dict[str, str]]) -> List[str]:
+        """One job per text pair, spread over all workers"""
+        return [self.submit(text_pair) for text_pair in text_pairs]
+
+    def submit_aligned_batch(self, text_pairs: List[Dict[str, str]]) -> str:
+        """
+        One job for all text_pairs, aligned together by pipeline.align_batch on a single worker;
+           its result is a list with one entry per pair
+        """
+        return self._submit(_run_batch_job, text_pairs, [text_pair.get("text_id") for text_pair in text_pairs])
+
+    def _on_done(self, job_id: str, future, executor: ProcessPoolExecutor, fn, text_pairs):
+        # _run_job records its own failures; this catches the worker process dying
+        exc = future.exception()
+        if isinstance(exc, BrokenProcessPool):
+            self._restart(executor)
+            if self._jobs[job_id]["status"] == QUEUED:
+                # it never started, so it is not what took the worker down: run it on the new pool
+                self._enqueue(job_id, fn, text_pairs)
+                return
+        if exc is not None:
+            _update(
+                self._jobs,
+                job_id,
+                status=FAILED,
+                error=f"{type(exc).__name__}: {exc}",
+                finished_at=time.time(),
+            )
+
+    def _evict(self):
+        """Forget finished jobs that are older than ttl, and the oldest ones past history"""
+        now = time.time()
+        finished = sorted(
+            (job["finished_at"], job_id)
+            for job_id, job in self._jobs.items()
+            if job["status"] in (DONE, FAILED) and "finished_at" in job
+        )
+        expired = [job_id for finished_at, job_id in finished if now - finished_at > self.ttl]
+        expired += [job_id for _, job_id in finished[len(expired) : max(len(finished) - self.history, len(expired))]]
+        for job_id in expired:
+            self._jobs.pop(job_id, None)
+
+    def status(self, job_id: str) -> Dict:
+        job = self._jobs.get(job_id)
+        if job is None:
+            raise KeyError(f"Unknown job id: {job_id}")
+        return {k: v for k, v in job.items() if k not in ("result", "traceback")}
+
+    def result(self, job_id: str, wait: bool = False, poll_interval: float = 1.0) -> Dict:
+        """Result of a finished job; with wait=True, block until the job has finished"""
+        while True:
+            job = self._jobs.get(job_id)
+            if job is None:
+                raise KeyError(f"Unknown job id: {job_id}")
+            if job["status"] in (DONE, FAILED) or not wait:
+                return job
+            time.sleep(poll_interval)
+
+    def worker_metrics(self) -> Dict:
+        return dict(self._workers)
+
+    def shutdown(self, wait: bool = True):
+        with self._lock:
+            self._executor.shutdown(wait=wait)
+        self._manager.shutdown()
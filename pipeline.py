@@ -0,0 +1,163 @@
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+from downloads import download_files, get_download_cache
+from tm import create_tm, create_tms
+
+# texts longer than this are aligned window by window to bound memory
+CHUNKED_ALIGNMENT_MIN_LINES = int(os.getenv("CHUNKED_ALIGNMENT_MIN_LINES", 20000))
+
+ALIGNER_DIR = (Path(__file__).parent / "tibetan-aligner").resolve()
+assert ALIGNER_DIR.is_dir()
+sys.path.insert(0, str(ALIGNER_DIR))
+
+from aligner import align as align_texts  # noqa: E402
+from aligner import align_batch as align_texts_batch  # noqa: E402
+from aligner import align_chunked  # noqa: E402
+from outputs import write_outputs  # noqa: E402
+
+STAGES = ["downloading", "aligning", "publishing"]
+
+
+@contextmanager
+def TemporaryDirectory():
+    # every job gets its own fresh directory; mkdtemp never hands out one that already exists
+    output_root = Path("./output").resolve()
+    output_root.mkdir(exist_ok=True, parents=True)
+    tmpdir = Path(tempfile.mkdtemp(prefix="job-", dir=output_root))
+    try:
+        yield tmpdir
+    finally:
+        shutil.rmtree(str(tmpdir))
+
+
+def _read_lines(fn: Path):
+    with open(fn, "r", encoding="utf-8") as f:
+        return f.readlines()
+
+
+def _use_chunked(bo_lines, en_lines) -> bool:
+    return max(len(bo_lines), len(en_lines)) > CHUNKED_ALIGNMENT_MIN_LINES
+
+
+def _align_chunked(bo_lines, en_lines):
+    alignments, scores = [], []
+    for bo_ids, en_ids, score in align_chunked(bo_lines, en_lines):
+        alignments.append((bo_ids, en_ids))
+        scores.append(score)
+    return alignments, scores
+
+
+def _run_aligner(bo_fn: Path, en_fn: Path, output_dir: Path) -> Path:
+    start = time.time()
+    bo_lines = _read_lines(bo_fn)
+    en_lines = _read_lines(en_fn)
+    if _use_chunked(bo_lines, en_lines):
+        alignments, scores = _align_chunked(bo_lines, en_lines)
+    else:
+        alignments, scores = align_texts(bo_lines, en_lines)
+    output_fn = write_outputs(
+        bo_lines, en_lines, alignments, scores, output_prefix=output_dir / bo_fn.name
+    )
+    end = time.time()
+    total_time = round((end - start) / 60, 2)
+    logging.info(f"Total time taken for Aligning: {total_time} mins")
+    return output_fn
+
+
+def align(text_pair, report_stage=None):
+    """
+    Download, align and publish one text pair.
+    report_stage, if given, is called with each stage name from STAGES as it starts.
+    """
+    report_stage = report_stage or (lambda stage: None)
+    logging.info(f"Running aligner for TM{text_pair['text_id']}...")
+    with TemporaryDirectory() as tmpdir:
+        output_dir = Path(tmpdir)
+        report_stage("downloading")
+        bo_fn, en_fn = download_files(
+            [text_pair["bo_file_url"], text_pair["en_file_url"]],
+            [output_dir / "bo.tx", output_dir / "en.tx"],
+            cache=get_download_cache(),
+        )
+        report_stage("aligning")
+        aligned_fn = _run_aligner(bo_fn, en_fn, output_dir)
+        report_stage("publishing")
+        repo_url = create_tm(aligned_fn, text_pair=text_pair)
+        return {"tm_repo_url": repo_url}
+
+
+def align_batch(text_pairs, report_stage=None):
+    """
+    Download, align and publish many text pairs, encoding them together with one model instance.
+    A pair that fails does not stop the others; returns one result per pair, in input order,
+       with either a "tm_repo_url" or an "error".
+    """
+    report_stage = report_stage or (lambda stage: None)
+    results = [{"text_id": text_pair.get("text_id")} for text_pair in text_pairs]
+
+    def fail(ii, e):
+        logging.error(f"Failed to align TM{text_pairs[ii].get('text_id')}: {e}")
+        results[ii]["error"] = f"{type(e).__name__}: {e}"
+
+    with TemporaryDirectory() as tmpdir:
+        output_dir = Path(tmpdir)
+        report_stage("downloading")
+        downloaded = dict()
+        cache = get_download_cache()
+        for ii, text_pair in enumerate(text_pairs):
+            pair_dir = output_dir / str(ii)
+            pair_dir.mkdir()
+            try:
+                downloaded[ii] = download_files(
+                    [text_pair["bo_file_url"], text_pair["en_file_url"]],
+                    [pair_dir / "bo.tx", pair_dir / "en.tx"],
+                    cache=cache,
+                )
+            except Exception as e:
+                fail(ii, e)
+
+        report_stage("aligning")
+        start = time.time()
+        lines = dict()
+        for ii, (bo_fn, en_fn) in downloaded.items():
+            try:
+                lines[ii] = _read_lines(bo_fn), _read_lines(en_fn)
+            except Exception as e:
+                fail(ii, e)
+        batched = [ii for ii in lines if not _use_chunked(*lines[ii])]
+        aligned = dict(zip(batched, align_texts_batch([lines[ii] for ii in batched])))
+        for ii in lines:
+            if ii not in aligned:
+                try:
+                    aligned[ii] = _align_chunked(*lines[ii])
+                except Exception as e:
+                    aligned[ii] = e
+        aligned_fns = dict()
+        for ii, alignment in aligned.items():
+            if isinstance(alignment, Exception):
+                fail(ii, alignment)
+                continue
+            bo_fn = downloaded[ii][0]
+            try:
+                aligned_fns[ii] = write_outputs(*lines[ii], *alignment, output_prefix=bo_fn.parent / bo_fn.name)
+            except Exception as e:
+                fail(ii, e)
+        total_time = round((time.time() - start) / 60, 2)
+        logging.info(f"Total time taken for Aligning {len(lines)} text pairs: {total_time} mins")
+
+        report_stage("publishing")
+        published = sorted(aligned_fns)
+        repo_urls = create_tms([aligned_fns[ii] for ii in published], [text_pairs[ii] for ii in published])
+        for ii, repo_url in zip(published, repo_urls):
+            if isinstance(repo_url, Exception):
+                fail(ii, repo_url)
+            else:
+                results[ii]["tm_repo_url"] = repo_url
+    return results
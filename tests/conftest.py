@@ -0,0 +1,52 @@
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Base for the HTTP stand-ins; subclasses implement do_GET etc."""
+
+    def log_message(self, format, *args):
+        pass
+
+    def send(self, status, body=b"", headers=None):
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+
+@pytest.fixture
+def serve():
+    """Start a local HTTP server for a StubHandler subclass and return its base url"""
+    servers = []
+
+    def start(handler_cls):
+        server = ThreadingHTTPServer(("127.0.0.1", 0), handler_cls)
+        server.requests = []
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return f"http://127.0.0.1:{server.server_address[1]}"
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture
+def no_sleep(monkeypatch):
+    """Skip backoff delays; returns the list of delays that were asked for"""
+    import time
+
+    delays = []
+    monkeypatch.setattr(time, "sleep", delays.append)
+    return delays
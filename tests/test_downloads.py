@@ -0,0 +1,162 @@
+import logging
+import os
+import time
+from urllib.parse import urlparse
+
+import pytest
+
+import downloads
+from conftest import StubHandler
+
+
+class TextServer(StubHandler):
+    """Serves files with ETags, answers If-None-Match and Range, and can drop a transfer halfway"""
+
+    files = {}
+    drop_next = False
+    statuses = []
+    requests = []
+
+    def send_response(self, code, message=None):
+        self.statuses.append(code)
+        super().send_response(code, message)
+
+    def do_GET(self):
+        self.requests.append((self.path, self.headers.get("Authorization")))
+        path = urlparse(self.path).path
+        body, etag = self.files[path]
+        if self.headers.get("If-None-Match") == etag:
+            return self.send(304, headers={"ETag": etag})
+        start = 0
+        if self.headers.get("Range"):
+            start = int(self.headers["Range"].split("=")[1].rstrip("-"))
+        status = 206 if start else 200
+        self.send_response(status)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body) - start))
+        self.end_headers()
+        if type(self).drop_next:
+            type(self).drop_next = False
+            self.wfile.write(body[start : start + len(body) // 2])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.wfile.write(body[start:])
+
+
+@pytest.fixture
+def server(serve):
+    handler = type("Handler", (TextServer,), {"files": {}, "drop_next": False, "statuses": [], "requests": []})
+    url = serve(handler)
+    handler.url = url
+    return handler
+
+
+@pytest.fixture(autouse=True)
+def fresh_session(monkeypatch):
+    monkeypatch.setattr(downloads, "_session", None)
+
+
+def download(server, tmp_path, cache, name="bo.txt"):
+    out = tmp_path / f"out-{time.monotonic_ns()}"
+    return downloads.download_file(f"{server.url}/{name}", out, cache=cache).read_bytes()
+
+
+def test_cached_file_is_revalidated_not_downloaded_again(server, tmp_path):
+    server.files["/bo.txt"] = ("བཀྲ་ཤིས།\n".encode() * 100, '"v1"')
+    cache = downloads.DownloadCache(tmp_path / "cache")
+
+    assert download(server, tmp_path, cache) == server.files["/bo.txt"][0]
+    assert download(server, tmp_path, cache) == server.files["/bo.txt"][0]
+    assert server.statuses == [200, 304]
+
+    meta = cache.get(f"{server.url}/bo.txt")
+    assert meta["etag"] == '"v1"'
+    assert meta["sha256"] == downloads._sha256(meta["path"])
+
+
+def test_changed_file_is_downloaded_again(server, tmp_path):
+    cache = downloads.DownloadCache(tmp_path / "cache")
+    server.files["/bo.txt"] = (b"first\n", '"v1"')
+    assert download(server, tmp_path, cache) == b"first\n"
+    server.files["/bo.txt"] = (b"second\n", '"v2"')
+    assert download(server, tmp_path, cache) == b"second\n"
+
+
+def test_interrupted_download_is_resumed(server, tmp_path, no_sleep, monkeypatch):
+    # whole chunks reach the partial file, so the transfer breaks after several of them
+    monkeypatch.setattr(downloads, "CHUNK_SIZE", 1024)
+    body = bytes(range(256)) * 64
+    server.files["/bo.txt"] = (body, '"v1"')
+    server.drop_next = True
+    cache = downloads.DownloadCache(tmp_path / "cache")
+
+    assert download(server, tmp_path, cache) == body
+    assert server.statuses == [200, 206]
+    assert len(no_sleep) == 1
+    assert list((tmp_path / "cache").glob("*.part")) == []
+
+
+def test_token_is_sent_as_header_and_kept_out_of_urls_and_logs(server, tmp_path, no_sleep, monkeypatch, caplog):
+    monkeypatch.setattr(downloads, "GITHUB_TOKEN", "SECRETTOKEN")
+    monkeypatch.setattr(downloads, "CHUNK_SIZE", 1024)
+    server.files["/bo.txt"] = (bytes(range(256)) * 64, '"v1"')
+    server.drop_next = True
+
+    with caplog.at_level(logging.WARNING):
+        download(server, tmp_path, downloads.DownloadCache(tmp_path / "cache"))
+
+    assert "interrupted" in caplog.text
+    assert "SECRETTOKEN" not in caplog.text
+    assert [path for path, _ in server.requests] == ["/bo.txt", "/bo.txt"]
+    assert {auth for _, auth in server.requests} == {"token SECRETTOKEN"}
+
+
+def test_corrupt_cache_entry_is_fetched_again(server, tmp_path):
+    server.files["/bo.txt"] = (b"original text\n", '"v1"')
+    cache = downloads.DownloadCache(tmp_path / "cache")
+    download(server, tmp_path, cache)
+
+    body_fn = next((tmp_path / "cache").glob("*.body"))
+    body_fn.write_bytes(b"corrupt! text\n")  # same size, so only the sha256 catches it
+
+    assert cache.get(f"{server.url}/bo.txt") is None
+    assert download(server, tmp_path, cache) == b"original text\n"
+    assert server.statuses == [200, 200]
+
+
+def test_stale_partial_downloads_are_swept(tmp_path):
+    cache_dir = tmp_path / "cache"
+    cache_dir.mkdir()
+    stale, fresh, stale_meta = cache_dir / "a.part", cache_dir / "b.part", cache_dir / "c.0123.tmp"
+    for fn in (stale, fresh, stale_meta):
+        fn.write_bytes(b"partial")
+    old = time.time() - downloads.DOWNLOAD_PART_MAX_AGE - 60
+    os.utime(stale, (old, old))
+    os.utime(stale_meta, (old, old))
+
+    downloads.DownloadCache(cache_dir)
+
+    assert sorted(fn.name for fn in cache_dir.iterdir()) == ["b.part"]
+
+
+def test_least_recently_used_files_are_evicted(server, tmp_path):
+    server.files["/bo.txt"] = (b"b" * 600, '"b"')
+    server.files["/en.txt"] = (b"e" * 600, '"e"')
+    cache = downloads.DownloadCache(tmp_path / "cache", max_bytes=1000)
+
+    download(server, tmp_path, cache, "bo.txt")
+    download(server, tmp_path, cache, "en.txt")
+
+    assert cache.get(f"{server.url}/bo.txt") is None
+    assert cache.get(f"{server.url}/en.txt") is not None
+    assert cache.size_bytes() <= 1000
+
+
+def test_download_files_fetches_a_pair(server, tmp_path):
+    server.files["/bo.txt"] = (b"bo\n", '"b"')
+    server.files["/en.txt"] = (b"en\n", '"e"')
+    bo_fn, en_fn = downloads.download_files(
+        [f"{server.url}/bo.txt", f"{server.url}/en.txt"], [tmp_path / "bo.tx", tmp_path / "en.tx"]
+    )
+    assert (bo_fn.read_bytes(), en_fn.read_bytes()) == (b"bo\n", b"en\n")
@@ -0,0 +1,236 @@
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "tibetan-aligner"))
+
+import dp_core_np  # noqa: E402
+import dp_utils  # noqa: E402
+
+try:
+    import dp_core
+except ModuleNotFoundError:
+    dp_core = None
+
+KERNELS = ["make_dense_costs", "dense_dp", "score_path", "make_sparse_costs", "sparse_dp"]
+
+backends = pytest.mark.parametrize(
+    "backend",
+    [
+        pytest.param(dp_core_np, id="numpy"),
+        pytest.param(dp_core, id="cython", marks=pytest.mark.skipif(dp_core is None, reason="dp_core is not built")),
+    ],
+)
+threads = pytest.mark.parametrize("num_threads", [1, 4])
+
+
+def cost(vecs0, vecs1, norms0, norms1, x_overlap, y_overlap, xx, yy):
+    """Cost of aligning the x_overlap lines ending at xx with the y_overlap lines ending at yy, as vecalign defines it"""
+    dot = float(np.dot(vecs0[x_overlap - 1, xx].astype(np.float64), vecs1[y_overlap - 1, yy]))
+    return 2.0 * (1.0 - dot) * x_overlap * y_overlap / (norms0[x_overlap - 1, xx] + 1e-6 + norms1[y_overlap - 1, yy])
+
+
+def reference_dp(vecs0, vecs1, norms0, norms1, alignment_types, del_penalty):
+    """Plain DP over every (x, y) node; returns the best alignments and their total cost"""
+    size0, size1 = vecs0.shape[1], vecs1.shape[1]
+    steps = [(0, 1), (1, 0)] + list(alignment_types)
+    csum = np.full((size0 + 1, size1 + 1), np.inf)
+    back = {}
+    csum[0, 0] = 0.0
+    for xx in range(size0 + 1):
+        for yy in range(size1 + 1):
+            for x_overlap, y_overlap in steps:
+                if (xx, yy) == (0, 0) or xx < x_overlap or yy < y_overlap:
+                    continue
+                if x_overlap == 0 or y_overlap == 0:
+                    step_cost = del_penalty
+                else:
+                    step_cost = cost(vecs0, vecs1, norms0, norms1, x_overlap, y_overlap, xx - 1, yy - 1)
+                total = csum[xx - x_overlap, yy - y_overlap] + step_cost
+                if total < csum[xx, yy]:
+                    csum[xx, yy] = total
+                    back[xx, yy] = (x_overlap, y_overlap)
+    alignments = []
+    xx, yy = size0, size1
+    while (xx, yy) != (0, 0):
+        x_overlap, y_overlap = back[xx, yy]
+        alignments.append((list(range(xx - x_overlap, xx)), list(range(yy - y_overlap, yy))))
+        xx, yy = xx - x_overlap, yy - y_overlap
+    return alignments[::-1], csum[size0, size1]
+
+
+def make_pair(rng, beads, dim=32, noise=0.05, num_overlaps=2):
+    """
+    Document embeddings for a pair with a known alignment: beads is a list of (src lines, tgt lines) counts,
+       both sides of a bead share a meaning vector; returns vecs0, vecs1 and the gold alignments
+    """
+    gold, x, y = [], 0, 0
+    for nx, ny in beads:
+        gold.append((list(range(x, x + nx)), list(range(y, y + ny))))
+        x, y = x + nx, y + ny
+    lines0 = rng.standard_normal((x, dim)).astype(np.float32) * noise
+    lines1 = rng.standard_normal((y, dim)).astype(np.float32) * noise
+    for src, tgt in gold:
+        meaning = rng.standard_normal(dim).astype(np.float32)
+        lines0[src] += meaning / max(len(src), 1)
+        lines1[tgt] += meaning / max(len(tgt), 1)
+
+    def doc(lines):
+        # overlay ii covers the ii + 1 lines ending at each line, front padded like dp_utils.layer
+        out = np.empty((num_overlaps,) + lines.shape, dtype=np.float32)
+        for ii in range(num_overlaps):
+            out[ii] = sum(np.roll(lines, shift, axis=0) for shift in range(ii + 1))
+            out[ii, :ii] = rng.standard_normal((ii, dim))
+        dp_utils.make_norm1(out)
+        return out
+
+    return doc(lines0), doc(lines1), gold
+
+
+def random_norms(rng, shape):
+    return rng.uniform(0.8, 1.2, shape).astype(np.float32)
+
+
+@backends
+def test_make_dense_costs(backend):
+    rng = np.random.default_rng(0)
+    vecs0, vecs1, _ = make_pair(rng, [(1, 1)] * 9 + [(1, 2), (2, 1)], num_overlaps=3)
+    norms0, norms1 = random_norms(rng, vecs0.shape[:2]), random_norms(rng, vecs1.shape[:2])
+
+    for offset0, offset1 in [(0, 0), (1, 2)]:
+        costs = backend.make_dense_costs(vecs0, vecs1, norms0, norms1, offset0, offset1)
+        expected = [[cost(vecs0, vecs1, norms0, norms1, offset0 + 1, offset1 + 1, xx, yy)
+                     for yy in range(vecs1.shape[1])] for xx in range(vecs0.shape[1])]
+        np.testing.assert_allclose(costs, expected, rtol=1e-5, atol=1e-6)
+
+
+@backends
+def test_dense_dp(backend):
+    rng = np.random.default_rng(1)
+    alignment_cost = rng.uniform(0, 2, (15, 12)).astype(np.float32)
+    pen = 0.7
+
+    csum, bp = backend.dense_dp(alignment_cost, pen)
+
+    # row by row, first of equal costs wins: the original dp_core loop
+    expected_csum = np.zeros_like(csum)
+    # the edges are multiples of pen in single precision, like c * pen in C
+    expected_csum[0, :] = np.arange(13, dtype=np.float32) * np.float32(pen)
+    expected_csum[:, 0] = np.arange(16, dtype=np.float32) * np.float32(pen)
+    expected_bp = np.zeros_like(bp)
+    for rr in range(1, 16):
+        for cc in range(1, 13):
+            options = [expected_csum[rr - 1, cc - 1] + alignment_cost[rr - 1, cc - 1],
+                       expected_csum[rr, cc - 1] + np.float32(pen),
+                       expected_csum[rr - 1, cc] + np.float32(pen)]
+            expected_bp[rr, cc] = int(np.argmin(options))
+            expected_csum[rr, cc] = min(options)
+    np.testing.assert_allclose(csum, expected_csum, rtol=1e-9)
+    np.testing.assert_array_equal(bp[1:, 1:], expected_bp[1:, 1:])
+
+
+@backends
+@threads
+def test_score_path(backend, num_threads):
+    rng = np.random.default_rng(2)
+    vecs0, vecs1, _ = make_pair(rng, [(1, 1)] * 40, num_overlaps=1)
+    norms0, norms1 = random_norms(rng, 40), random_norms(rng, 40)
+    xx = rng.integers(0, 40, 100).astype(np.int32)
+    yy = rng.integers(0, 40, 100).astype(np.int32)
+    out = np.empty(100, dtype=np.float32)
+
+    backend.score_path(xx, yy, norms0, norms1, vecs0[0], vecs1[0], out, num_threads=num_threads)
+
+    expected = [cost(vecs0, vecs1, norms0[None], norms1[None], 1, 1, x, y) for x, y in zip(xx, yy)]
+    np.testing.assert_allclose(out, expected, rtol=1e-5, atol=1e-6)
+
+
+@backends
+@threads
+def test_make_sparse_costs(backend, num_threads):
+    rng = np.random.default_rng(3)
+    vecs0, vecs1, gold = make_pair(rng, [(1, 1)] * 20 + [(1, 2), (2, 1)] * 5, num_overlaps=2)
+    norms0, norms1 = random_norms(rng, vecs0.shape[:2]), random_norms(rng, vecs1.shape[:2])
+    alignment_types = dp_utils.make_alignment_types(3)
+    path = dp_utils.alignment_to_search_path(gold)
+    width_over2 = 4
+
+    # small tiles, so that the threads get several each
+    a_b_costs, b_offset = backend.make_sparse_costs(vecs0, vecs1, norms0, norms1, path, alignment_types,
+                                                    width_over2, tile_size=7, num_threads=num_threads)
+
+    expected = np.full(a_b_costs.shape, np.inf)
+    for aa, bb in ((x + y, y) for x, y in path):
+        assert b_offset[aa] == bb - width_over2
+        for col in range(2 * width_over2):
+            yy = bb - width_over2 + col
+            xx = aa - yy
+            if 0 <= xx < vecs0.shape[1] and 0 <= yy < vecs1.shape[1]:
+                for ii, (x_overlap, y_overlap) in enumerate(alignment_types):
+                    expected[ii, aa, col] = cost(vecs0, vecs1, norms0, norms1, x_overlap, y_overlap, xx, yy)
+    np.testing.assert_allclose(a_b_costs, expected, rtol=1e-5, atol=1e-6)
+
+
+@backends
+@threads
+def test_sparse_dp_finds_the_best_path(backend, num_threads):
+    rng = np.random.default_rng(4)
+    beads = [(1, 1), (1, 2), (1, 1), (0, 1), (2, 1), (1, 1), (1, 0), (1, 1), (2, 2), (1, 1)]
+    vecs0, vecs1, gold = make_pair(rng, beads, noise=0.3)
+    norms0, norms1 = random_norms(rng, vecs0.shape[:2]), random_norms(rng, vecs1.shape[:2])
+    alignment_types = dp_utils.make_alignment_types(3)
+    del_penalty = 0.9
+    size0, size1 = vecs0.shape[1], vecs1.shape[1]
+
+    # a band wider than the documents, so the sparse DP sees every node the full DP does
+    path = dp_utils.alignment_to_search_path(gold)
+    a_b_costs, b_offset = backend.make_sparse_costs(vecs0, vecs1, norms0, norms1, path, alignment_types,
+                                                    size0 + size1, num_threads=num_threads)
+    a_b_csum, a_b_xp, a_b_yp, new_b_offset = backend.sparse_dp(a_b_costs, b_offset, alignment_types, del_penalty,
+                                                               size0, size1, num_threads=num_threads)
+    alignments, _ = dp_utils.sparse_traceback(a_b_csum, a_b_xp, a_b_yp, new_b_offset, size0, size1)
+
+    expected_alignments, expected_cost = reference_dp(vecs0, vecs1, norms0, norms1, alignment_types, del_penalty)
+    assert alignments == expected_alignments
+    aa, bb = dp_utils.xy2ab_w_offset(size0, size1, new_b_offset)
+    assert a_b_csum[aa, bb] == pytest.approx(expected_cost, rel=1e-5)
+
+
+def run_vecalign(monkeypatch, backend, num_threads, vecs0, vecs1):
+    for name in KERNELS:
+        monkeypatch.setattr(dp_utils, name, getattr(backend, name))
+    np.random.seed(0)  # the deletion penalty is estimated from random samples
+    stack = dp_utils.vecalign(vecs0=vecs0.copy(), vecs1=vecs1.copy(),
+                              final_alignment_types=dp_utils.make_alignment_types(3),
+                              del_percentile_frac=0.2, width_over2=8, max_size_full_dp=50,
+                              costs_sample_size=20000, num_samps_for_norm=100, num_threads=num_threads)
+    return stack[0]["final_alignments"], stack[0]["alignment_scores"]
+
+
+@backends
+@threads
+def test_vecalign_recovers_known_alignment(backend, num_threads, monkeypatch):
+    rng = np.random.default_rng(5)
+    beads = [[(1, 1), (1, 2), (2, 1)][ii] for ii in rng.choice(3, 150, p=[0.8, 0.1, 0.1])]
+    vecs0, vecs1, gold = make_pair(rng, beads)
+
+    # large enough for max_size_full_dp=50 to take it through two levels of downsampling
+    alignments, _ = run_vecalign(monkeypatch, backend, num_threads, vecs0, vecs1)
+    assert alignments == gold
+
+
+@pytest.mark.skipif(dp_core is None, reason="dp_core is not built")
+@threads
+def test_backends_agree(num_threads, monkeypatch):
+    rng = np.random.default_rng(6)
+    beads = [[(1, 1), (1, 2), (2, 1), (0, 1), (1, 0)][ii] for ii in rng.choice(5, 150, p=[0.7, 0.1, 0.1, 0.05, 0.05])]
+    vecs0, vecs1, _ = make_pair(rng, beads, noise=0.5)
+
+    alignments_np, scores_np = run_vecalign(monkeypatch, dp_core_np, num_threads, vecs0, vecs1)
+    alignments_c, scores_c = run_vecalign(monkeypatch, dp_core, num_threads, vecs0, vecs1)
+    alignments_c1, _ = run_vecalign(monkeypatch, dp_core, 1, vecs0, vecs1)
+
+    assert alignments_np == alignments_c == alignments_c1
+    np.testing.assert_allclose(scores_np, scores_c, rtol=1e-4, atol=1e-6)
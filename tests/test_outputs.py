@@ -0,0 +1,127 @@
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+ALIGNER_DIR = Path(__file__).resolve().parent.parent / "tibetan-aligner"
+sys.path.insert(0, str(ALIGNER_DIR))
+
+import score  # noqa: E402
+from alignment_table import AlignmentTable  # noqa: E402
+from dp_utils import print_alignments, read_alignments  # noqa: E402
+from outputs import TM_BO_SUFFIX, TM_EN_SUFFIX, read_ladder, write_outputs  # noqa: E402
+
+BO_LINES = [
+    "བཀྲ་ཤིས་བདེ་ལེགས།",
+    "  ཐུགས་རྗེ་ཆེ། ",
+    "ཁྱེད་རང་",
+    "སྐུ་གཟུགས་བདེ་པོ་ཡིན་པས།",
+    "ང་བོད་པ་ཡིན།",
+    "འདི་ག་རེ་རེད།",
+    "དེ་དེབ་རེད།",
+    "ག་དུས་ཡོང་གི་ཡིན།",
+]
+EN_LINES = [
+    "Hello.",
+    "Thank you",
+    "very much.",
+    "An extra line.",
+    "How are you?",
+    "What is this?",
+    "  That is a book. ",
+    "When will you come?",
+]
+# matches, a 1-2 and a 2-1, an insertion, a deletion and a match whose score rounds to 0 in the ladder
+ALIGNMENTS = [
+    ([0], [0]),
+    ([1], [1, 2]),
+    ([], [3]),
+    ([2, 3], [4]),
+    ([4], []),
+    ([5], [5]),
+    ([6], [6]),
+    ([7], [7]),
+]
+SCORES = [0.31, 0.25, 0.0, 0.42, 0.0, 0.0000004, 0.2, 0.1]
+
+
+@pytest.fixture
+def pair(tmp_path):
+    (tmp_path / "bo.txt").write_text("\n".join(BO_LINES) + "\n", encoding="utf-8")
+    (tmp_path / "en.txt").write_text("\n".join(EN_LINES) + "\n", encoding="utf-8")
+    with open(tmp_path / "ladder", "w", encoding="utf-8") as fout:
+        print_alignments(ALIGNMENTS, SCORES, file=fout)
+    return tmp_path
+
+
+def legacy(script, tmp_path):
+    """Run one of the old per-output scripts on the pair, as align_tib_en.sh used to; returns its stdout"""
+    return subprocess.run(
+        [sys.executable, str(ALIGNER_DIR / script), "bo.txt", "en.txt", "ladder"],
+        cwd=tmp_path, check=True, capture_output=True, env=dict(os.environ, PYTHONUTF8="1"),
+    ).stdout
+
+
+def test_outputs_match_legacy_scripts(pair):
+    alignments, scores = read_ladder(pair / "ladder")
+    write_outputs(BO_LINES, EN_LINES, alignments, scores, pair / "out")
+
+    legacy("ladder2org.py", pair)
+    assert (pair / "out.org").read_bytes() == (pair / "bo.txt_en.txt.org").read_bytes()
+    assert (pair / "out.train").read_bytes() == legacy("create_train.py", pair)
+    assert (pair / "out.train_cleaned").read_bytes() == legacy("create_train_clean.py", pair)
+
+
+def test_tm_halves_split_train_cleaned(pair):
+    train_cleaned_fn = write_outputs(BO_LINES, EN_LINES, ALIGNMENTS, SCORES, pair / "out")
+
+    rows = [row for row in train_cleaned_fn.read_text(encoding="utf-8").splitlines() if row]
+    bo = Path(str(train_cleaned_fn) + TM_BO_SUFFIX).read_text(encoding="utf-8").splitlines()
+    en = Path(str(train_cleaned_fn) + TM_EN_SUFFIX).read_text(encoding="utf-8").splitlines()
+    assert list(zip(bo, en)) == [tuple(row.split("\t", 1)) for row in rows]
+
+
+def test_alignments_roundtrip_through_outputs_and_score(pair):
+    write_outputs(BO_LINES, EN_LINES, ALIGNMENTS, SCORES, pair / "out")
+
+    table = AlignmentTable.load(pair / "out.npz")
+    np.testing.assert_allclose(table.scores, SCORES)
+    assert read_alignments(pair / "out.npz") == ALIGNMENTS
+    assert read_alignments(pair / "ladder") == ALIGNMENTS
+    assert read_ladder(pair / "out.npz") == (ALIGNMENTS, pytest.approx(SCORES))
+
+    res = score.score_multiple([read_alignments(pair / "ladder")], [read_alignments(pair / "out.npz")])
+    assert res["f1_strict"] == res["f1_lax"] == 1.0
+
+    # merge the 1-1s at the end into a 2-2: strict misses, lax still overlaps;
+    #   precision counts the insertion and deletion, recall does not
+    test = ALIGNMENTS[:-2] + [([6, 7], [6, 7])]
+    table_res = score.score_multiple([AlignmentTable.load(pair / "out.npz")], [AlignmentTable.from_alignments(test)])
+    list_res = score.score_multiple([ALIGNMENTS], [test])
+    assert table_res == list_res
+    assert list_res["precision_strict"] == pytest.approx(6 / 7)
+    assert list_res["recall_strict"] == pytest.approx(4 / 6)
+    assert list_res["f1_lax"] == 1.0
+
+
+def random_alignment(rng, size):
+    alignments, x, y = [], 0, 0
+    while x < size:
+        nx, ny = [(1, 1), (1, 2), (2, 1), (0, 1), (1, 0), (2, 2)][rng.integers(6)]
+        alignments.append((list(range(x, x + nx)), list(range(y, y + ny))))
+        x, y = x + nx, y + ny
+    return alignments
+
+
+def test_span_counts_match_set_based_counts():
+    rng = np.random.default_rng(0)
+    for _ in range(20):
+        gold, test = random_alignment(rng, 200), random_alignment(rng, 200)
+        pcounts, rcounts = score._counts(gold, test)
+
+        np.testing.assert_array_equal(pcounts, score._precision(goldalign=gold, testalign=test))
+        no_del = [[(x, y) for x, y in alignments if len(x) and len(y)] for alignments in (gold, test)]
+        np.testing.assert_array_equal(rcounts, score._precision(goldalign=no_del[1], testalign=no_del[0]))
@@ -0,0 +1,179 @@
+import base64
+import json
+import logging
+import subprocess
+
+import pytest
+import requests
+
+import tm
+from conftest import StubHandler
+
+TOKEN = "SECRETTOKEN"
+
+
+@pytest.fixture(autouse=True)
+def github(monkeypatch):
+    monkeypatch.setattr(tm, "GITHUB_USERNAME", "user")
+    monkeypatch.setattr(tm, "GITHUB_EMAIL", "user@example.com")
+    monkeypatch.setattr(tm, "GITHUB_ORG", "org")
+    monkeypatch.setattr(tm, "GITHUB_ACCESS_TOKEN", TOKEN)
+    monkeypatch.setattr(tm, "PUBLISH_RETRIES", 2)
+    monkeypatch.setattr(tm, "_session", None)
+
+
+def git(*args):
+    return subprocess.run(["git", *args], check=True, capture_output=True, text=True).stdout
+
+
+def make_repo(tmp_path):
+    repo_path = tmp_path / "TM1"
+    repo_path.mkdir()
+    (repo_path / "TM1-bo.txt").write_text("བཀྲ་ཤིས།\n", encoding="utf-8")
+    (repo_path / "TM1-en.txt").write_text("Hello\n")
+    (repo_path / "README.md").write_text("## Input\n")
+    return repo_path
+
+
+def test_build_commit(tmp_path):
+    repo_path = make_repo(tmp_path)
+    git_dir = tmp_path / "TM1.git"
+    sha = tm.build_commit(repo_path, git_dir)
+
+    git(f"--git-dir={git_dir}", "fsck", "--strict")
+    assert git(f"--git-dir={git_dir}", "rev-parse", "main").strip() == sha
+    assert git(f"--git-dir={git_dir}", "log", "--format=%an <%ae> %s", "main").strip() == (
+        "user <user@example.com> Initial commit"
+    )
+    assert git(f"--git-dir={git_dir}", "ls-tree", "--name-only", "main").split() == sorted(
+        fn.name for fn in repo_path.iterdir()
+    )
+    for fn in repo_path.iterdir():
+        assert git(f"--git-dir={git_dir}", "show", f"main:{fn.name}") == fn.read_text(encoding="utf-8")
+
+
+def test_push_repo_to_local_bare_repo(tmp_path, no_sleep):
+    git_dir = tmp_path / "TM1.git"
+    sha = tm.build_commit(make_repo(tmp_path), git_dir)
+    remote = tmp_path / "remote.git"
+    git("init", "-q", "--bare", str(remote))
+
+    tm.push_repo(git_dir, str(remote))
+
+    assert git(f"--git-dir={remote}", "rev-parse", "main").strip() == sha
+    assert no_sleep == []
+
+
+def test_push_repo_does_not_retry_permanent_failures(tmp_path, no_sleep):
+    git_dir = tmp_path / "TM1.git"
+    tm.build_commit(make_repo(tmp_path), git_dir)
+
+    with pytest.raises(Exception) as excinfo:
+        tm.push_repo(git_dir, str(tmp_path / "missing.git"))
+    assert not isinstance(excinfo.value, tm.TransientPushError)
+    assert no_sleep == []
+
+
+def auth_header():
+    return "Basic " + base64.b64encode(f"org:{TOKEN}".encode()).decode()
+
+
+def stub_git_server(serve, status, headers=None):
+    """HTTP stand-in answering every git request with status; returns its url and the auth headers it got"""
+    auth_headers = []
+
+    class Handler(StubHandler):
+        def do_GET(self):
+            auth_headers.append(self.headers.get("Authorization"))
+            self.send(status, b"", headers)
+
+    return serve(Handler), auth_headers
+
+
+def test_push_repo_retries_transient_failures_without_leaking_token(tmp_path, serve, no_sleep, caplog):
+    git_dir = tmp_path / "TM1.git"
+    tm.build_commit(make_repo(tmp_path), git_dir)
+    url, auth_headers = stub_git_server(serve, 503)
+
+    with caplog.at_level(logging.WARNING), pytest.raises(tm.TransientPushError) as excinfo:
+        tm.push_repo(git_dir, f"{url}/TM1.git")
+
+    assert len(no_sleep) == tm.PUBLISH_RETRIES
+    assert TOKEN not in str(excinfo.value)
+    assert TOKEN not in caplog.text
+    # the token still reaches the server, as an auth header
+    assert auth_header() in auth_headers
+
+
+def test_push_repo_does_not_retry_auth_failures(tmp_path, serve, no_sleep, caplog):
+    git_dir = tmp_path / "TM1.git"
+    tm.build_commit(make_repo(tmp_path), git_dir)
+    url, auth_headers = stub_git_server(serve, 401, {"WWW-Authenticate": 'Basic realm="GitHub"'})
+
+    with caplog.at_level(logging.WARNING), pytest.raises(Exception) as excinfo:
+        tm.push_repo(git_dir, f"{url}/TM1.git")
+
+    assert not isinstance(excinfo.value, tm.TransientPushError)
+    assert no_sleep == []
+    assert TOKEN not in str(excinfo.value)
+    assert TOKEN not in caplog.text
+    assert auth_header() in auth_headers
+
+
+class FakeGitHubAPI(StubHandler):
+    """POST /orgs/org/repos answers with the queued statuses in turn, then 201"""
+
+    statuses = []
+    existing = False
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        self.server.requests.append(("POST", self.path))
+        status = self.statuses.pop(0) if self.statuses else 201
+        body = {"html_url": "https://github.com/org/TM1"} if status == 201 else {"message": "nope"}
+        self.send(status, json.dumps(body).encode(), {"Content-Type": "application/json"})
+
+    def do_GET(self):
+        self.server.requests.append(("GET", self.path))
+        if self.existing:
+            self.send(200, json.dumps({"html_url": "https://github.com/org/TM1"}).encode())
+        else:
+            self.send(404, b"{}")
+
+
+@pytest.fixture
+def github_api(serve, monkeypatch):
+    def start(statuses, existing=False):
+        handler = type("Handler", (FakeGitHubAPI,), {"statuses": list(statuses), "existing": existing})
+        url = serve(handler)
+        monkeypatch.setattr(tm, "GITHUB_API_ENDPOINT", f"{url}/orgs/org/repos")
+        monkeypatch.setattr(tm, "GITHUB_REPO_API", url + "/repos/{org}/{repo_name}")
+        return handler
+
+    return start
+
+
+def test_create_remote_repo_retries_server_errors(github_api, no_sleep):
+    github_api([502, 429])
+    assert tm.create_remote_repo("TM1") == "https://github.com/org/TM1"
+    assert no_sleep == [0.5, 1.0]
+
+
+def test_create_remote_repo_takes_over_existing_repo(github_api, no_sleep):
+    github_api([422], existing=True)
+    assert tm.create_remote_repo("TM1") == "https://github.com/org/TM1"
+    assert no_sleep == []
+
+
+def test_create_remote_repo_does_not_retry_client_errors(github_api, no_sleep):
+    github_api([401])
+    with pytest.raises(requests.HTTPError):
+        tm.create_remote_repo("TM1")
+    assert no_sleep == []
+
+
+def test_create_remote_repo_gives_up(github_api, no_sleep):
+    github_api([503] * 10)
+    with pytest.raises(requests.ConnectionError):
+        tm.create_remote_repo("TM1")
+    assert len(no_sleep) == tm.PUBLISH_RETRIES
@@ -1,4 +1,6 @@
 #!/bin/bash
+set -e
+
 number_of_overlays=6 # the higher the number of overlays, the more precise alignment is going to be, but also slower
 deletion=0.06 # higher = less precise
 search_buffer_size=50
@@ -7,37 +9,49 @@ search_buffer_size=50
 # first parameter is a file in Tibetan unicode
 # second parameter is a file with English in plain text.
 # third parameter is output path
+#
+# Every intermediate file lives in a private scratch directory that is removed on exit,
+# so several alignments can run at the same time from any working directory.
 
-cp $1 $1.work
-cp $2 $2.work
+script_dir=$(cd "$(dirname "$0")" && pwd)
+bo_name=$(basename "$1")
+en_name=$(basename "$2")
 output_dir=${3:-"output"}
-mkdir $output_dir
-
-cp $2.work $2.work2
+mkdir -p "$output_dir"
+
+work_dir=$(mktemp -d "${TMPDIR:-/tmp}/align_tib_en.XXXXXXXX")
+trap 'rm -rf "$work_dir"' EXIT
+mkdir "$work_dir/bo" "$work_dir/en"
+bo_work="$work_dir/bo/$bo_name.work"
+en_work="$work_dir/en/$en_name.work"
+alignments="$work_dir/alignments.npz"
+
+# with EMBEDDING_STORE_DIR set, the embedding stores are kept there, so that aligning the same texts
+# again (e.g. with another number_of_overlays) only encodes the overlays that are not stored yet.
+# They are named by the sha256 of the text, which get_vectors.py also records in the store: runs on
+# different texts never share a store, whatever the file names, and the same text is embedded only once
+if [ -n "$EMBEDDING_STORE_DIR" ]; then
+    mkdir -p "$EMBEDDING_STORE_DIR"
+    bo_store="$EMBEDDING_STORE_DIR/$(sha256sum "$1" | cut -d' ' -f1)"
+    en_store="$EMBEDDING_STORE_DIR/$(sha256sum "$2" | cut -d' ' -f1)"
+else
+    bo_store="$work_dir/bo/${bo_name}_store"
+    en_store="$work_dir/en/${en_name}_store"
+fi
+
+cp "$1" "$bo_work"
+cp "$2" "$en_work"
 
 echo '[INFO] Getting Embedding...'
-time python get_vectors.py $1.work $number_of_overlays
-time python get_vectors.py $2.work $number_of_overlays
+time python "$script_dir/get_vectors.py" "$bo_work" $number_of_overlays "$bo_store"
+time python "$script_dir/get_vectors.py" "$en_work" $number_of_overlays "$en_store"
 
-rm ladder
 echo '[INFO] Running alignment...'
-time ./vecalign.py -a $number_of_overlays -d $deletion --search_buffer_size $search_buffer_size --alignment_max_size $number_of_overlays --src $1.work --tgt $2.work \
-   --src_embed $1.work_overlay $1.work_vectors.npy  \
-   --tgt_embed $2.work_overlay $2.work_vectors.npy >> ladder
-
-rm $1.org
-rm $1.train
-python ladder2org.py $1.work $2.work ladder >> $1.org
-python create_train.py $1.work $2.work ladder >> $1.train
-python create_train_clean.py $1.work $2.work ladder >> $1.train_cleaned
-
-# clean up
-mv *.txt* $output_dir/
-mv $output_dir/requirements.txt ./
-rm $output_dir/$1.work
-rm $output_dir/$2.work
-rm $output_dir/$2.work2
-rm $output_dir/$1.work_vectors.npy
-rm $output_dir/$2.work_vectors.npy
-
-echo "[OUTPUT] $output_dir/$1.train_cleaned"
+time python "$script_dir/vecalign.py" -a $number_of_overlays -d $deletion --search_buffer_size $search_buffer_size --alignment_max_size $number_of_overlays --src "$bo_work" --tgt "$en_work" \
+   --src_embed "$bo_store" \
+   --tgt_embed "$en_store" \
+   --output "$alignments"
+
+python "$script_dir/outputs.py" "$bo_work" "$en_work" "$alignments" "$output_dir/$bo_name" > /dev/null
+
+echo "[OUTPUT] $output_dir/$bo_name.train_cleaned"
@@ -0,0 +1,363 @@
+"""
+In-process Tibetan-English alignment.
+
+Runs the same stages as align_tib_en.sh (get_vectors.py and vecalign.py)
+inside a single interpreter, keeping the overlay embeddings in memory instead
+of passing them through temp files. outputs.write_outputs writes the results.
+"""
+
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ALL_COMPLETED, FIRST_COMPLETED, ProcessPoolExecutor, wait
+from itertools import islice
+from math import ceil
+from random import seed as seed
+
+import numpy as np
+
+from dp_utils import gather_doc_embedding, make_alignment_types, make_overlay_index, vecalign
+from embedding_cache import get_embedding_cache
+from get_vectors import encode_overlays
+from model_registry import MODEL_PATH, get_model
+from projection import PROJECTION_DIM, PROJECTION_METHOD, get_projection
+from quantize import EMBEDDING_PRECISION
+
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:  # comes with scikit-learn, which sentence-transformers needs
+    threadpool_limits = None
+
+logger = logging.getLogger('vecalign')
+
+# defaults used by align_tib_en.sh
+NUMBER_OF_OVERLAYS = 6  # the higher the number of overlays, the more precise alignment is going to be, but also slower
+DELETION = 0.06  # higher = less precise
+SEARCH_BUFFER_SIZE = 50
+
+# source lines per window in align_chunked
+CHUNK_WINDOW_SIZE = 2000
+
+# processes running the DP stage of align_batch
+BATCH_DP_WORKERS = int(os.getenv("BATCH_DP_WORKERS", os.cpu_count() or 1))
+# text pairs whose overlays are encoded together in align_batch
+BATCH_ENCODE_GROUP_SIZE = int(os.getenv("BATCH_ENCODE_GROUP_SIZE", 32))
+
+
+def embed_document(model, lines, num_overlaps, cache=None, precision='float32', projection=None):
+    """
+    Encode all distinct overlaps of lines (up to num_overlaps) and
+       return the (num_overlaps, len(lines), dim) document embedding, stored at precision
+       and, if a projection.Projection is given, projected to its dimensions
+    """
+    overlays, overlay_index = make_overlay_index(lines, num_overlaps)
+    line_embeddings = encode_overlays(model, overlays, cache=cache)
+    if projection is not None:
+        line_embeddings = projection.apply(line_embeddings)
+    return gather_doc_embedding(line_embeddings, overlay_index, precision=precision)
+
+
+def _get_projection(model, model_path, projection_method, projection_dim):
+    if not projection_dim:
+        return None
+    return get_projection(model_path, projection_method, projection_dim,
+                          input_dim=model.get_sentence_embedding_dimension())
+
+
+def _alignment_max_size(number_of_overlays):
+    if number_of_overlays < 2:
+        logger.warning('Alignment_max_size < 2. Increasing to 2 so that 1-1 alignments will be considered')
+        return 2
+    return number_of_overlays
+
+
+def _vecalign(vecs0, vecs1, alignment_max_size, deletion, search_buffer_size,
+              max_size_full_dp, costs_sample_size, num_samps_for_norm, precision='float32', num_threads=-1):
+    stack = vecalign(vecs0=vecs0,
+                     vecs1=vecs1,
+                     final_alignment_types=make_alignment_types(alignment_max_size),
+                     del_percentile_frac=deletion,
+                     width_over2=ceil(alignment_max_size / 2.0) + search_buffer_size,
+                     max_size_full_dp=max_size_full_dp,
+                     costs_sample_size=costs_sample_size,
+                     num_samps_for_norm=num_samps_for_norm,
+                     precision=precision,
+                     num_threads=num_threads)
+
+    return stack[0]['final_alignments'], stack[0]['alignment_scores']
+
+
+def _align_lines(model, cache, bo_lines, en_lines, alignment_max_size, deletion, search_buffer_size,
+                 max_size_full_dp, costs_sample_size, num_samps_for_norm, precision='float32', projection=None):
+    vecs0 = embed_document(model, bo_lines, alignment_max_size, cache=cache, precision=precision,
+                           projection=projection)
+    vecs1 = embed_document(model, en_lines, alignment_max_size, cache=cache, precision=precision,
+                           projection=projection)
+
+    return _vecalign(vecs0, vecs1, alignment_max_size, deletion, search_buffer_size,
+                     max_size_full_dp, costs_sample_size, num_samps_for_norm, precision=precision)
+
+
+def align(bo_lines,
+          en_lines,
+          number_of_overlays=NUMBER_OF_OVERLAYS,
+          deletion=DELETION,
+          search_buffer_size=SEARCH_BUFFER_SIZE,
+          max_size_full_dp=300,
+          costs_sample_size=20000,
+          num_samps_for_norm=100,
+          precision=EMBEDDING_PRECISION,
+          projection_dim=PROJECTION_DIM,
+          projection_method=PROJECTION_METHOD,
+          model_path=MODEL_PATH):
+    """
+    Align Tibetan lines to English lines, using the shared model_path instance from model_registry
+       and the embedding cache in EMBEDDING_CACHE_DIR (unless that is set to '').
+
+    Returns (alignments, scores) as produced by dp_utils.vecalign, where each
+       alignment is a pair of (bo line ids, en line ids).
+    """
+    # make runs consistent
+    seed(42)
+    np.random.seed(42)
+
+    model = get_model(model_path)
+    cache = get_embedding_cache(model_path, model.max_seq_length)
+    projection = _get_projection(model, model_path, projection_method, projection_dim)
+
+    return _align_lines(model, cache, bo_lines, en_lines,
+                        alignment_max_size=_alignment_max_size(number_of_overlays),
+                        deletion=deletion,
+                        search_buffer_size=search_buffer_size,
+                        max_size_full_dp=max_size_full_dp,
+                        costs_sample_size=costs_sample_size,
+                        num_samps_for_norm=num_samps_for_norm,
+                        precision=precision,
+                        projection=projection)
+
+
+def _init_dp_worker():
+    # the pool already runs one DP per core, so each one gets a single thread, BLAS included
+    if threadpool_limits is not None:
+        threadpool_limits(1)
+
+
+def _batch_dp(rng_state, vecs0, vecs1, dp_kwargs):
+    # continue from the random state align() would have at this point, so that results match it exactly
+    np.random.set_state(rng_state)
+    return _vecalign(vecs0, vecs1, num_threads=1, **dp_kwargs)
+
+
+def align_batch(text_pairs,
+                number_of_overlays=NUMBER_OF_OVERLAYS,
+                deletion=DELETION,
+                search_buffer_size=SEARCH_BUFFER_SIZE,
+                max_size_full_dp=300,
+                costs_sample_size=20000,
+                num_samps_for_norm=100,
+                dp_workers=BATCH_DP_WORKERS,
+                encode_group_size=BATCH_ENCODE_GROUP_SIZE,
+                precision=EMBEDDING_PRECISION,
+                projection_dim=PROJECTION_DIM,
+                projection_method=PROJECTION_METHOD,
+                model_path=MODEL_PATH):
+    """
+    Align many (bo_lines, en_lines) pairs with one model instance.
+
+    The distinct overlays of encode_group_size pairs at a time are encoded together, so the
+       model sees large, well-filled batches, and the DP of each pair runs on a pool of
+       dp_workers single-threaded processes while the next group is encoded. At most
+       2 * dp_workers pairs wait for the pool at a time, so their embeddings do not pile up.
+
+    Returns one entry per pair, in input order: (alignments, scores) exactly as align() would
+       return them, or the exception raised while aligning that pair.
+    """
+    model = get_model(model_path)
+    cache = get_embedding_cache(model_path, model.max_seq_length)
+    projection = _get_projection(model, model_path, projection_method, projection_dim)
+    alignment_max_size = _alignment_max_size(number_of_overlays)
+    dp_kwargs = dict(alignment_max_size=alignment_max_size,
+                     deletion=deletion,
+                     search_buffer_size=search_buffer_size,
+                     max_size_full_dp=max_size_full_dp,
+                     costs_sample_size=costs_sample_size,
+                     num_samps_for_norm=num_samps_for_norm,
+                     precision=precision)
+
+    results = [None] * len(text_pairs)
+    executor = None
+    if dp_workers > 1:
+        # spawn, not fork: the model's threads do not survive a fork
+        executor = ProcessPoolExecutor(max_workers=dp_workers, mp_context=multiprocessing.get_context('spawn'),
+                                       initializer=_init_dp_worker)
+    futures = dict()
+
+    def collect(return_when):
+        done, _ = wait(futures, return_when=return_when)
+        for future in done:
+            ii = futures.pop(future)
+            try:
+                results[ii] = future.result()
+            except Exception as e:
+                results[ii] = e
+
+    try:
+        for start in range(0, len(text_pairs), max(encode_group_size, 1)):
+            group = range(start, min(start + encode_group_size, len(text_pairs)))
+
+            # distinct overlays of the whole group, and each document's index into them
+            overlay2row = dict()
+            overlay_indexes = dict()
+            for ii in group:
+                doc_indexes = []
+                for lines in text_pairs[ii]:
+                    overlays, overlay_index = make_overlay_index(lines, alignment_max_size)
+                    rows = np.array([overlay2row.setdefault(overlay, len(overlay2row)) for overlay in overlays],
+                                    dtype=np.int64)
+                    doc_indexes.append(rows[overlay_index])
+                overlay_indexes[ii] = doc_indexes
+            try:
+                line_embeddings = encode_overlays(model, list(overlay2row), cache=cache)
+                if projection is not None:
+                    line_embeddings = projection.apply(line_embeddings)
+            except Exception as e:
+                for ii in group:
+                    results[ii] = e
+                continue
+
+            for ii in group:
+                try:
+                    # same seeding as align()
+                    seed(42)
+                    np.random.seed(42)
+                    vecs0, vecs1 = (gather_doc_embedding(line_embeddings, overlay_index, precision=precision)
+                                    for overlay_index in overlay_indexes[ii])
+                    if executor is None:
+                        results[ii] = _vecalign(vecs0, vecs1, **dp_kwargs)
+                    else:
+                        while len(futures) >= 2 * dp_workers:
+                            collect(FIRST_COMPLETED)
+                        futures[executor.submit(_batch_dp, np.random.get_state(), vecs0, vecs1, dp_kwargs)] = ii
+                except Exception as e:
+                    results[ii] = e
+
+        collect(ALL_COMPLETED)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    for ii, result in enumerate(results):
+        if isinstance(result, Exception):
+            logger.error('Failed to align pair %d: %s', ii, result)
+    return results
+
+
+def _find_anchor(alignments, scores, commit_size):
+    """
+    Index of the last confident many-many alignment that ends within the first commit_size source lines.
+    Confident means its score is no worse than the median score of the window;
+       if there is none, fall back to the last alignment within the commit region.
+    """
+    matched = [ii for ii, (x, y) in enumerate(alignments) if len(x) and len(y)]
+    if matched:
+        median = np.median([scores[ii] for ii in matched])
+        for ii in reversed(matched):
+            if alignments[ii][0][-1] < commit_size and scores[ii] <= median:
+                return ii
+
+    anchor = None
+    for ii, (x, y) in enumerate(alignments):
+        if len(x) and x[-1] >= commit_size:
+            break
+        anchor = ii
+    # always make progress
+    return 0 if anchor is None else anchor
+
+
+def align_chunked(bo_lines,
+                  en_lines,
+                  window_size=CHUNK_WINDOW_SIZE,
+                  commit_frac=0.75,
+                  length_ratio=1.0,
+                  number_of_overlays=NUMBER_OF_OVERLAYS,
+                  deletion=DELETION,
+                  search_buffer_size=SEARCH_BUFFER_SIZE,
+                  max_size_full_dp=300,
+                  costs_sample_size=20000,
+                  num_samps_for_norm=100,
+                  precision=EMBEDDING_PRECISION,
+                  projection_dim=PROJECTION_DIM,
+                  projection_method=PROJECTION_METHOD,
+                  model_path=MODEL_PATH):
+    """
+    Align book-length inputs with bounded memory.
+
+    bo_lines/en_lines can be any iterables of lines (e.g. open files); at most one window of each is
+       held in memory. Each window of window_size Tibetan lines (and the estimated matching number of
+       English lines, with some slack) is aligned, the alignments up to a confident anchor in the first
+       commit_frac of the window are yielded, and the next window starts right after that anchor.
+
+    Yields (bo line ids, en line ids, score) in document order, with ids relative to the whole document.
+    """
+    seed(42)
+    np.random.seed(42)
+
+    model = get_model(model_path)
+    cache = get_embedding_cache(model_path, model.max_seq_length)
+    projection = _get_projection(model, model_path, projection_method, projection_dim)
+    alignment_max_size = _alignment_max_size(number_of_overlays)
+
+    bo_iter = iter(bo_lines)
+    en_iter = iter(en_lines)
+    bo_buf, en_buf = [], []
+    bo_offset, en_offset = 0, 0
+
+    while True:
+        # en lines per bo line so far, starting from length_ratio
+        ratio = (en_offset + length_ratio * window_size) / (bo_offset + window_size)
+        en_window_size = max(ceil(window_size * ratio * 1.5), alignment_max_size)
+        bo_buf.extend(islice(bo_iter, window_size - len(bo_buf)))
+        en_buf.extend(islice(en_iter, en_window_size - len(en_buf)))
+        bo_done = len(bo_buf) < window_size
+        en_done = len(en_buf) < en_window_size
+
+        if not bo_buf or not en_buf:
+            # one side has run out, everything left on the other side is an insertion/deletion
+            for ii in range(len(bo_buf)):
+                yield [bo_offset + ii], [], 0.0
+            for ii in range(len(en_buf)):
+                yield [], [en_offset + ii], 0.0
+            for ii, _ in enumerate(bo_iter, start=bo_offset + len(bo_buf)):
+                yield [ii], [], 0.0
+            for ii, _ in enumerate(en_iter, start=en_offset + len(en_buf)):
+                yield [], [ii], 0.0
+            return
+
+        alignments, scores = _align_lines(model, cache, bo_buf, en_buf,
+                                          alignment_max_size=alignment_max_size,
+                                          deletion=deletion,
+                                          search_buffer_size=search_buffer_size,
+                                          max_size_full_dp=max_size_full_dp,
+                                          costs_sample_size=costs_sample_size,
+                                          num_samps_for_norm=num_samps_for_norm,
+                                          precision=precision,
+                                          projection=projection)
+
+        if bo_done and en_done:
+            anchor = len(alignments) - 1
+        else:
+            anchor = _find_anchor(alignments, scores, commit_size=max(int(len(bo_buf) * commit_frac), 1))
+
+        bo_used, en_used = 0, 0
+        for (x, y), score in zip(alignments[:anchor + 1], scores[:anchor + 1]):
+            yield [bo_offset + ii for ii in x], [en_offset + ii for ii in y], float(score)
+            bo_used += len(x)
+            en_used += len(y)
+
+        if anchor == len(alignments) - 1 and bo_done and en_done:
+            return
+
+        del bo_buf[:bo_used]
+        del en_buf[:en_used]
+        bo_offset += bo_used
+        en_offset += en_used
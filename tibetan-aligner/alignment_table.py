@@ -0,0 +1,97 @@
+"""
+Columnar on-disk format for alignment results.
+
+vecalign.py prints alignments as text lines like '[1, 2]:[1]:0.354184',
+which every consumer has to parse again. An AlignmentTable keeps the same
+information as five arrays, one entry per alignment: the source and target
+span (start, end) and the score. Every alignment vecalign makes covers
+consecutive lines, so a span is all that is needed; an empty side is an
+insertion or deletion. Tables are saved as an uncompressed .npz file, which
+loads in one read per column and can be concatenated across many documents
+with plain numpy. np.load reads .npz columns into memory (mmap_mode does not
+apply to them), which is fine at 28 bytes per alignment.
+"""
+
+from itertools import chain
+
+import numpy as np
+
+TABLE_VERSION = 1
+COLUMNS = ('src_start', 'src_end', 'tgt_start', 'tgt_end', 'scores')
+
+
+def _spans(ids_list):
+    """(start, end) arrays for lists of consecutive ids; an empty list starts and ends after the previous one"""
+    lengths = np.fromiter(map(len, ids_list), dtype=np.int64, count=len(ids_list))
+    ids = np.fromiter(chain.from_iterable(ids_list), dtype=np.int64, count=int(lengths.sum()))
+    offsets = np.cumsum(lengths) - lengths
+    nonempty = lengths > 0
+    first = np.zeros(len(ids_list), dtype=np.int64)
+    first[nonempty] = ids[offsets[nonempty]]
+    # every id must be its list's first id plus its position in the list
+    wrong = ids != np.repeat(first - offsets, lengths) + np.arange(len(ids))
+    if wrong.any():
+        ii = np.searchsorted(offsets, np.flatnonzero(wrong)[0], side='right') - 1
+        raise Exception('alignment side %s is not a run of consecutive line ids' % (list(ids_list[ii]),))
+    # an empty side sits where the last non-empty one before it ended
+    if len(ids_list):
+        last = np.maximum.accumulate(np.where(nonempty, np.arange(len(ids_list)), -1))
+        start = np.where(nonempty, first, np.where(last >= 0, (first + lengths)[np.maximum(last, 0)], 0))
+    else:
+        start = first
+    return start.astype(np.int32), (start + lengths).astype(np.int32)
+
+
+class AlignmentTable(object):
+    def __init__(self, src_start, src_end, tgt_start, tgt_end, scores):
+        self.src_start = src_start
+        self.src_end = src_end
+        self.tgt_start = tgt_start
+        self.tgt_end = tgt_end
+        self.scores = scores
+
+    @classmethod
+    def from_alignments(cls, alignments, scores=None):
+        """Table for a list of (src ids, tgt ids) as made by dp_utils.vecalign; scores default to 0"""
+        src_start, src_end = _spans([x for x, _ in alignments])
+        tgt_start, tgt_end = _spans([y for _, y in alignments])
+        if scores is None:
+            scores = np.zeros(len(alignments))
+        scores = np.asarray(scores, dtype=np.float64)
+        if len(scores) != len(alignments):
+            raise Exception('got %d alignments but %d scores' % (len(alignments), len(scores)))
+        return cls(src_start, src_end, tgt_start, tgt_end, scores)
+
+    def __len__(self):
+        return len(self.scores)
+
+    def alignments(self):
+        """List of (src ids, tgt ids), as dp_utils.read_alignments returns"""
+        return [(list(range(x0, x1)), list(range(y0, y1)))
+                for x0, x1, y0, y1 in zip(self.src_start.tolist(), self.src_end.tolist(),
+                                          self.tgt_start.tolist(), self.tgt_end.tolist())]
+
+    def matched(self):
+        """Mask of the alignments that have lines on both sides, i.e. no insertions/deletions"""
+        return (self.src_end > self.src_start) & (self.tgt_end > self.tgt_start)
+
+    def save(self, path):
+        # through a file object, so that numpy does not append .npz to the name
+        with open(path, 'wb') as fout:
+            np.savez(fout, version=TABLE_VERSION, **{column: getattr(self, column) for column in COLUMNS})
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            if int(data['version']) != TABLE_VERSION:
+                raise Exception('unsupported alignment table version %s in %s' % (data['version'], path))
+            return cls(*(data[column] for column in COLUMNS))
+
+    @staticmethod
+    def is_table(path):
+        """npz files are zip archives, text alignment files never start with its magic bytes"""
+        try:
+            with open(path, 'rb') as fin:
+                return fin.read(4) == b'PK\x03\x04'
+        except OSError:
+            return False
@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark the alignment pipeline for throughput and quality.
+
+Synthetic document pairs of any size are generated with a known gold alignment
+and controlled insertion/deletion rates, and stub embeddings (no model needed).
+Real corpora (source, target and a gold alignment file in the vecalign format)
+can be added with --real; those are embedded with the model.
+
+Every case runs in a fresh process, so its memory high-water mark is its own.
+One JSON line per case is printed (and written to --output) with the time of
+each stage, including the stages timed inside dp_utils.vecalign, the peak
+resident memory and the F1 against the gold alignment. Pass a previous results
+file as --compare to see the change in runtime and F1 for every case:
+
+    python bench.py --output before.jsonl
+    # ... change something ...
+    python bench.py --compare before.jsonl
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import resource
+import tempfile
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from math import ceil
+from pathlib import Path
+from time import time
+
+import numpy as np
+
+from aligner import DELETION, NUMBER_OF_OVERLAYS, SEARCH_BUFFER_SIZE, embed_document
+from dp_utils import make_alignment_types, read_alignments, vecalign
+from outputs import write_outputs
+from quantize import EMBEDDING_PRECISION, PRECISIONS
+from score import score_multiple
+
+logger = logging.getLogger('vecalign')
+
+# (src sentences, tgt sentences) per bead, and how often each bead type occurs,
+#   apart from insertions (0, 1) and deletions (1, 0), which make up the rest
+BEAD_TYPES = [(1, 1), (1, 2), (2, 1), (1, 0), (0, 1)]
+MATCH_PROBS = [0.8, 0.07, 0.07]
+
+
+def make_gold(num_lines, rng, insertion_rate=0.03, deletion_rate=0.03):
+    """Random gold alignment with about num_lines source lines"""
+    match_rate = 1.0 - insertion_rate - deletion_rate
+    if match_rate <= 0:
+        raise Exception('insertion_rate + deletion_rate must be below 1')
+    probs = [p * match_rate / sum(MATCH_PROBS) for p in MATCH_PROBS] + [deletion_rate, insertion_rate]
+    gold = []
+    x, y = 0, 0
+    while x < num_lines:
+        nx, ny = BEAD_TYPES[rng.choice(len(BEAD_TYPES), p=probs)]
+        gold.append((list(range(x, x + nx)), list(range(y, y + ny))))
+        x += nx
+        y += ny
+    return gold, x, y
+
+
+def make_line_vectors(gold, size0, size1, dim, noise, rng):
+    """
+    Stub sentence embeddings: both sides of a bead share a random meaning vector,
+       split over its sentences, plus noise
+    """
+    vecs0 = rng.standard_normal((size0, dim)).astype(np.float32) * noise
+    vecs1 = rng.standard_normal((size1, dim)).astype(np.float32) * noise
+    for x, y in gold:
+        meaning = rng.standard_normal(dim).astype(np.float32)
+        for ii in x:
+            vecs0[ii] += meaning / len(x)
+        for ii in y:
+            vecs1[ii] += meaning / len(y)
+    return vecs0, vecs1
+
+
+def make_doc_vectors(line_vecs, num_overlaps, rng):
+    """(num_overlaps, num_lines, dim) stub document embedding: an overlay is the sum of its lines"""
+    size, dim = line_vecs.shape
+    csum = np.concatenate([np.zeros((1, dim), dtype=np.float32), np.cumsum(line_vecs, axis=0)])
+    doc = np.empty((num_overlaps, size, dim), dtype=np.float32)
+    for ii in range(num_overlaps):
+        overlap = ii + 1
+        doc[ii, overlap - 1:] = csum[overlap:] - csum[:size - overlap + 1]
+        # front padding, like dp_utils.layer
+        doc[ii, :overlap - 1] = rng.standard_normal((min(overlap - 1, size), dim))
+    return doc
+
+
+def _max_rss_bytes():
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _synthetic_case(case, args):
+    rng = np.random.default_rng(args['seed'])
+    gold, size0, size1 = make_gold(case['size'], rng, case['insertion_rate'], case['deletion_rate'])
+    line0, line1 = make_line_vectors(gold, size0, size1, args['dim'], args['noise'], rng)
+    vecs0 = make_doc_vectors(line0, args['num_overlaps'], rng)
+    vecs1 = make_doc_vectors(line1, args['num_overlaps'], rng)
+    lines0 = ['bo %d' % ii for ii in range(size0)]
+    lines1 = ['en %d' % ii for ii in range(size1)]
+    return gold, lines0, lines1, vecs0, vecs1
+
+
+def _real_case(case, args):
+    from model_registry import get_model
+
+    lines0 = Path(case['src']).read_text(encoding='utf-8').splitlines()
+    lines1 = Path(case['tgt']).read_text(encoding='utf-8').splitlines()
+    model = get_model()
+    vecs0 = embed_document(model, lines0, args['num_overlaps'])
+    vecs1 = embed_document(model, lines1, args['num_overlaps'])
+    return read_alignments(case['gold']), lines0, lines1, vecs0, vecs1
+
+
+def run_case(case, args):
+    """Time every stage of one case; runs in its own process (see main)"""
+    stages = dict()
+    peaks = dict()
+
+    def timed(stage, fn, *fn_args):
+        if args['trace_memory']:
+            tracemalloc.reset_peak()
+        t0 = time()
+        result = fn(*fn_args)
+        stages[stage] = time() - t0
+        if args['trace_memory']:
+            peaks[stage] = tracemalloc.get_traced_memory()[1]
+        return result
+
+    if args['trace_memory']:
+        tracemalloc.start()
+    make_inputs = _real_case if 'src' in case else _synthetic_case
+    gold, lines0, lines1, vecs0, vecs1 = timed('embed' if 'src' in case else 'generate', make_inputs, case, args)
+
+    np.random.seed(42)
+    alignment_max_size = args['num_overlaps']
+    stack = timed('align', vecalign, vecs0, vecs1, make_alignment_types(alignment_max_size), args['deletion'],
+                  ceil(alignment_max_size / 2.0) + args['search_buffer_size'], args['max_size_full_dp'],
+                  20000, 100, None, None, args['precision'])
+    alignments, scores = stack[0]['final_alignments'], stack[0]['alignment_scores']
+    # the DP stages within align
+    for key, value in stack[0]['runtimes'].items():
+        stages['align: ' + key] = value
+    del stack, vecs0, vecs1
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        timed('write outputs', write_outputs, lines0, lines1, alignments, scores, Path(tmpdir) / 'bench')
+    f1 = timed('score', score_multiple, [gold], [alignments])
+    if args['trace_memory']:
+        tracemalloc.stop()
+
+    result = dict(case,
+                  size0=len(lines0),
+                  size1=len(lines1),
+                  precision=args['precision'],
+                  runtime_s=round(sum(value for key, value in stages.items() if ':' not in key), 4),
+                  stages_s={key: round(value, 4) for key, value in stages.items()},
+                  max_rss_bytes=_max_rss_bytes(),
+                  f1_strict=f1['f1_strict'],
+                  f1_lax=f1['f1_lax'])
+    if args['trace_memory']:
+        result['peak_traced_bytes'] = peaks
+    return result
+
+
+def compare(results, baseline_fn):
+    """Print the runtime ratio and F1 change of every case also found in baseline_fn"""
+    with open(baseline_fn, 'rt', encoding='utf-8') as fin:
+        baseline = {result['name']: result for result in (json.loads(line) for line in fin if line.strip())}
+    print('%-40s %10s %10s %8s %8s' % ('case', 'runtime_s', 'was', 'ratio', 'dF1'))
+    for result in results:
+        old = baseline.get(result['name'])
+        if old is None:
+            print('%-40s %10.3f %10s' % (result['name'], result['runtime_s'], '-'))
+            continue
+        print('%-40s %10.3f %10.3f %8.2f %+8.3f' % (result['name'], result['runtime_s'], old['runtime_s'],
+                                                    result['runtime_s'] / max(old['runtime_s'], 1e-9),
+                                                    result['f1_strict'] - old['f1_strict']))
+
+
+def main():
+    parser = argparse.ArgumentParser('Benchmark alignment speed, memory and F1 on synthetic and real corpora',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='*', default=[1000, 10000, 100000],
+                        help='Source lines per synthetic document (none to only run --real corpora)')
+    parser.add_argument('--insertion_rates', type=float, nargs='+', default=[0.03],
+                        help='Fraction of synthetic beads that are a target line with no source')
+    parser.add_argument('--deletion_rates', type=float, nargs='+', default=[0.03],
+                        help='Fraction of synthetic beads that are a source line with no target')
+    parser.add_argument('--real', nargs=3, action='append', default=[], metavar=('SRC', 'TGT', 'GOLD'),
+                        help='Real corpus to benchmark, embedded with the model; can be repeated')
+    parser.add_argument('--dim', type=int, default=256,
+                        help='Size of the stub embeddings (the model has 768); 100k lines take ~5GB at 256')
+    parser.add_argument('--noise', type=float, default=1.0, help='Noise added to the stub sentence embeddings')
+    parser.add_argument('--precision', default=EMBEDDING_PRECISION, choices=PRECISIONS)
+    parser.add_argument('-a', '--num_overlaps', type=int, default=NUMBER_OF_OVERLAYS)
+    parser.add_argument('-d', '--deletion', type=float, default=DELETION)
+    parser.add_argument('--search_buffer_size', type=int, default=SEARCH_BUFFER_SIZE)
+    parser.add_argument('--max_size_full_dp', type=int, default=300)
+    parser.add_argument('--trace_memory', action='store_true',
+                        help='Also report the peak traced (numpy/python) memory of each stage; slows things down')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='Write the results here, one JSON line per case')
+    parser.add_argument('--compare', help='Results file of an earlier run to compare against')
+    args = parser.parse_args()
+
+    cases = []
+    for size in args.sizes:
+        for insertion_rate in args.insertion_rates:
+            for deletion_rate in args.deletion_rates:
+                cases.append(dict(name='synthetic-%d-ins%g-del%g' % (size, insertion_rate, deletion_rate),
+                                  size=size, insertion_rate=insertion_rate, deletion_rate=deletion_rate))
+    for src, tgt, gold in args.real:
+        cases.append(dict(name='real-' + Path(src).stem, src=src, tgt=tgt, gold=gold))
+
+    results = []
+    fout = open(args.output, 'wt', encoding='utf-8') if args.output else None
+    try:
+        for case in cases:
+            # a fresh process per case, so that max_rss_bytes is the high-water mark of that case alone
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+                result = executor.submit(run_case, case, vars(args)).result()
+            results.append(result)
+            print(json.dumps(result), flush=True)
+            if fout is not None:
+                print(json.dumps(result), file=fout, flush=True)
+    finally:
+        if fout is not None:
+            fout.close()
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+"""
+Compare alignment at full and reduced embedding precision (see quantize.py).
+
+Builds synthetic document pairs with a known gold alignment and stub embeddings
+(no model needed), aligns each at every precision and prints one JSON line per
+run with the embedding memory, traced peak memory, runtime and F1 against both
+the gold alignment and the float32 alignment, computed with score.score_multiple.
+"""
+
+import argparse
+import json
+import logging
+import tracemalloc
+from math import ceil
+from time import time
+
+import numpy as np
+
+from bench import make_doc_vectors, make_gold, make_line_vectors
+from dp_utils import make_alignment_types, vecalign
+from quantize import PRECISIONS, quantize
+from score import score_multiple
+
+logger = logging.getLogger('vecalign')
+
+
+def run(vecs0, vecs1, precision, alignment_max_size, deletion, search_buffer_size, max_size_full_dp):
+    # vecalign normalizes float32 input in place, so give it a copy
+    vecs0 = quantize(vecs0, precision) if precision != 'float32' else vecs0.copy()
+    vecs1 = quantize(vecs1, precision) if precision != 'float32' else vecs1.copy()
+    embedding_bytes = vecs0.nbytes + vecs1.nbytes
+
+    np.random.seed(42)
+    tracemalloc.start()
+    t0 = time()
+    stack = vecalign(vecs0=vecs0,
+                     vecs1=vecs1,
+                     final_alignment_types=make_alignment_types(alignment_max_size),
+                     del_percentile_frac=deletion,
+                     width_over2=ceil(alignment_max_size / 2.0) + search_buffer_size,
+                     max_size_full_dp=max_size_full_dp,
+                     costs_sample_size=20000,
+                     num_samps_for_norm=100)
+    runtime = time() - t0
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return stack[0]['final_alignments'], dict(embedding_bytes=embedding_bytes,
+                                              peak_traced_bytes=peak,
+                                              runtime_s=runtime)
+
+
+def _normalize(doc):
+    doc /= np.linalg.norm(doc, axis=-1, keepdims=True) + 1e-5
+    return doc
+
+
+def main():
+    parser = argparse.ArgumentParser('Benchmark reduced precision embeddings against float32',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 5000, 20000], help='Source lines per document')
+    parser.add_argument('--precisions', nargs='+', default=list(PRECISIONS), choices=PRECISIONS)
+    parser.add_argument('--dim', type=int, default=768, help='Embedding size')
+    parser.add_argument('--noise', type=float, default=1.0, help='Noise added to the stub sentence embeddings')
+    parser.add_argument('-a', '--alignment_max_size', type=int, default=6)
+    parser.add_argument('-d', '--del_percentile_frac', type=float, default=0.06)
+    parser.add_argument('--search_buffer_size', type=int, default=50)
+    parser.add_argument('--max_size_full_dp', type=int, default=300)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        rng = np.random.default_rng(args.seed)
+        gold, size0, size1 = make_gold(size, rng)
+        line0, line1 = make_line_vectors(gold, size0, size1, args.dim, args.noise, rng)
+        # quantization expects norm 1 vectors, normalize once up front for every precision
+        vecs0 = _normalize(make_doc_vectors(line0, args.alignment_max_size, rng))
+        vecs1 = _normalize(make_doc_vectors(line1, args.alignment_max_size, rng))
+        del line0, line1
+
+        reference = None
+        for precision in args.precisions:
+            alignments, stats = run(vecs0, vecs1, precision, args.alignment_max_size, args.del_percentile_frac,
+                                    args.search_buffer_size, args.max_size_full_dp)
+            if precision == 'float32':
+                reference = alignments
+            result = dict(size0=size0, size1=size1, dim=args.dim, precision=precision,
+                          embedding_bytes=stats['embedding_bytes'],
+                          peak_traced_bytes=stats['peak_traced_bytes'],
+                          runtime_s=round(stats['runtime_s'], 4),
+                          f1_vs_gold=score_multiple(gold_list=[gold], test_list=[alignments]))
+            if reference is not None:
+                result['f1_vs_float32'] = score_multiple(gold_list=[reference], test_list=[alignments])
+            print(json.dumps(result), flush=True)
+
+
+if __name__ == '__main__':
+    main()
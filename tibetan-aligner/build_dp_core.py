@@ -0,0 +1,50 @@
+"""
+Builds the dp_core Cython extension next to dp_core.pyx unless it is already importable.
+
+    python build_dp_core.py
+
+app.py runs this once at startup, before any job worker imports dp_utils, so that a fresh
+deployment gets the compiled kernels without compiling inside a job. Concurrent builds wait on
+a lock file for the first one. If the build fails, dp_utils falls back to the NumPy kernels.
+"""
+
+import fcntl
+import importlib
+import importlib.util
+import logging
+import os
+import subprocess
+import sys
+
+logger = logging.getLogger('vecalign')
+
+ALIGNER_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def dp_core_built():
+    importlib.invalidate_caches()
+    return importlib.util.find_spec('dp_core') is not None
+
+
+def build_dp_core():
+    """Run setup.py build_ext --inplace if dp_core is not built yet; returns whether it is built afterwards"""
+    if dp_core_built():
+        return True
+    try:
+        with open(os.path.join(ALIGNER_DIR, '.dp_core_build.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if dp_core_built():
+                return True  # another process built it while we waited
+            logger.warning('compiled dp_core not found, building it in %s', ALIGNER_DIR)
+            subprocess.run([sys.executable, 'setup.py', 'build_ext', '--inplace'],
+                           cwd=ALIGNER_DIR, check=True, capture_output=True, text=True)
+    except subprocess.CalledProcessError as e:
+        logger.error('building dp_core failed:\n%s', e.stderr[-4000:])
+    except OSError as e:
+        logger.error('building dp_core failed: %s', e)
+    return dp_core_built()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(message)s', level=logging.INFO)
+    sys.exit(0 if build_dp_core() else 1)
@@ -16,10 +16,21 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+import os
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 
+from quantize import to_float32
+
 cimport numpy as np
 cimport cython
+from cython.parallel cimport parallel, prange
+from libc.math cimport INFINITY
+
+# Number of threads used by the cost kernels and sparse_dp.
+# The extension is built with OpenMP where available (see setup.py); without it, prange runs serially.
+DP_NUM_THREADS = int(os.getenv("DP_NUM_THREADS", os.cpu_count() or 1))
 
 
 def make_x_y_offsets(alignment_types):
@@ -61,20 +72,13 @@ def make_dense_costs(np.ndarray[float, ndim=3] vecs0,  # itput
     cdef int vecsize = np.shape(vecs0)[2]
     assert vecs1.shape[2] == vecsize
 
-    cdef int xi, yi
-    cdef float sumx
-
-    cdef np.ndarray[float, ndim=2] costs = np.empty((size0, size1), dtype=np.float32)
-
-    for xi in range(size0):
-        for yi in range(size1):
-            sumx = 0.0
-            for jj in range(vecsize):
-                sumx += vecs0[offset0, xi, jj] * vecs1[offset1, yi, jj]
-
-            costs[xi, yi] = 2.0 * (1.0 - sumx) / (1e-6 + norm0[offset0, xi] + norm1[offset1, yi])
-            # normalize by alignment type  
-            costs[xi, yi] = costs[xi, yi] * (offset0 + 1) * (offset1 + 1)
+    # all dot products in one BLAS call (sgemm), then normalize with broadcasting, in place
+    cdef np.ndarray[float, ndim=2] costs = np.dot(vecs0[offset0], vecs1[offset1].T)
+    np.subtract(1.0, costs, out=costs)
+    costs *= 2.0
+    costs /= (norm0[offset0, :, None] + 1e-6) + norm1[offset1, None, :]
+    # normalize by alignment type
+    costs *= (offset0 + 1) * (offset1 + 1)
 
     return costs
 
@@ -144,39 +148,84 @@ def dense_dp(np.ndarray[float, ndim=2] alignment_cost, float pen):
     return csum, bp
 
 
-def score_path(np.ndarray[int, ndim=1] xx,
-               np.ndarray[int, ndim=1] yy,
-               np.ndarray[float, ndim=1] norm1,
-               np.ndarray[float, ndim=1] norm2,
-               np.ndarray[float, ndim=2] vecs1,
-               np.ndarray[float, ndim=2] vecs2,
-               np.ndarray[float, ndim=1] out):
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def score_path(int[:] xx,
+               int[:] yy,
+               float[:] norm1,
+               float[:] norm2,
+               float[:, :] vecs1,
+               float[:, :] vecs2,
+               float[:] out,
+               int num_threads=-1):
     cdef int xi, yi, ii, jj
     cdef float outx
     cdef int lenxy = xx.shape[0]
     cdef int vecsize = vecs1.shape[1]
 
-    for ii in range(lenxy):
+    if num_threads < 1:
+        num_threads = DP_NUM_THREADS
+
+    for ii in prange(lenxy, nogil=True, schedule='static', num_threads=max(num_threads, 1)):
         xi = xx[ii]
         yi = yy[ii]
         outx = 0.0
         for jj in range(vecsize):
-            outx += vecs1[xi, jj] * vecs2[yi, jj]
+            outx = outx + vecs1[xi, jj] * vecs2[yi, jj]
         out[ii] = 2.0 * (1.0 - outx) / (norm1[xi] + norm2[yi])
 
 
-# Bounds checking and wraparound slow things down by about 2x
-# Division by 0 checking has minimal speed impact
-@cython.boundscheck(False)  # turn off bounds-checking for entire function
-@cython.wraparound(False)  # turn off negative index wrapping for entire function
-@cython.cdivision(True)  # use c-style division (no division-by-zero check)
-def make_sparse_costs(np.ndarray[float, ndim=3] vecs0,  # intput: num aligns X num sents X dim
-                      np.ndarray[float, ndim=3] vecs1,  # input
+def _sparse_costs_tile(aa, bb, vecs0, vecs1, norms0, norms1, x_offsets, y_offsets, int width_over2, a_b_feats):
+    """
+    Fill a_b_feats for the search path points (aa, bb) of one tile, in a,b coordinates
+    """
+    cdef int xsize = vecs0.shape[1]
+    cdef int ysize = vecs1.shape[1]
+    cdef int ii_align, x_offset_idx, y_offset_idx
+    cdef int x_lo, x_hi, y_lo, y_hi
+
+    # convert ab to xy cords, for every point in the band
+    yy = bb[:, None] + np.arange(-width_over2, width_over2, dtype=np.int32)[None, :]
+    xx = aa[:, None] - yy
+    valid = (0 <= xx) & (xx < xsize) & (0 <= yy) & (yy < ysize)
+    if not valid.any():
+        return
+
+    rows, cols = np.nonzero(valid)
+    aa_valid = aa[rows]
+    xx_valid = xx[rows, cols]
+    yy_valid = yy[rows, cols]
+    x_lo = xx_valid.min()
+    x_hi = xx_valid.max() + 1
+    y_lo = yy_valid.min()
+    y_hi = yy_valid.max() + 1
+    xx_valid -= x_lo
+    yy_valid -= y_lo
+
+    for ii_align in range(x_offsets.shape[0]):
+        x_offset_idx = x_offsets[ii_align] - 1  # overlaps start at 1, vectors stored 0-based
+        y_offset_idx = y_offsets[ii_align] - 1
+
+        # reduced precision vectors are expanded one block at a time
+        block = np.dot(to_float32(vecs0[x_offset_idx, x_lo:x_hi]), to_float32(vecs1[y_offset_idx, y_lo:y_hi]).T)
+        feat = block[xx_valid, yy_valid]
+        np.subtract(1.0, feat, out=feat)
+        feat *= 2.0 * x_offsets[ii_align] * y_offsets[ii_align]
+        feat /= (norms0[x_offset_idx, x_lo:x_hi][xx_valid] + 1e-6) + norms1[y_offset_idx, y_lo:y_hi][yy_valid]
+
+        a_b_feats[ii_align, aa_valid, cols] = feat
+
+
+def make_sparse_costs(vecs0,  # intput: num aligns X num sents X dim, float32 or see quantize.py
+                      vecs1,  # input
                       np.ndarray[float, ndim=2] norms0,  # intput: num aligns X num sents
                       np.ndarray[float, ndim=2] norms1,  # input
                       x_y_path,
                       alignment_types,
-                      int width_over2):
+                      int width_over2,
+                      int tile_size=0,
+                      int num_threads=-1):
     """
     Make features for DP, *for lines running across approximate path*, *for each alignment type*
     x_offsets, y_offsets should not include (0,1), (1,0)
@@ -184,6 +233,12 @@ def make_sparse_costs(np.ndarray[float, ndim=3] vecs0,  # intput: num aligns X n
     Basically, we take the feature matrix, rotate it 45 degress, 
        and compute a "wavy" matrix for the features.
     It's like the diagonal but it moves around to hopefully always include the true path.
+
+    The path is processed in tiles of tile_size points (default: 2 * width_over2).
+    For each tile and alignment type, the dot products for the whole x/y block the band
+       passes through are computed with one matrix multiply, and the band is gathered from it.
+    Tiles write disjoint rows of the output, so they are spread over num_threads threads
+       (the matrix multiplies release the GIL).
     """
 
     cdef np.ndarray[int, ndim=2] x_y_path_ = np.array(x_y_path).astype(np.int32)
@@ -226,50 +281,119 @@ def make_sparse_costs(np.ndarray[float, ndim=3] vecs0,  # intput: num aligns X n
     # reserve outputs
     a_len = x_y_path_.shape[0]
     b_len = 2 * width_over2
-    cdef np.ndarray[float, ndim=3] a_b_feats = np.empty((len(alignment_types), a_len, b_len), dtype=np.float32)
-    cdef np.ndarray[int, ndim=1] b_offset = np.empty(a_len).astype(np.int32)
+    cdef np.ndarray[float, ndim=3] a_b_feats = np.full((len(alignment_types), a_len, b_len), np.inf, dtype=np.float32)
+    cdef np.ndarray[int, ndim=1] b_offset = np.empty(a_len, dtype=np.int32)
+
+    if tile_size <= 0:
+        tile_size = b_len
+    if num_threads < 1:
+        num_threads = DP_NUM_THREADS
+
+    # convert xy to ab cords
+    aa_path = x_y_path_[:, 0] + x_y_path_[:, 1]
+    bb_path = x_y_path_[:, 1]
+    b_offset[aa_path] = bb_path - width_over2
+
+    tiles = [(aa_path[start:start + tile_size], bb_path[start:start + tile_size])
+             for start in range(0, a_len, tile_size)]
+    args = (vecs0, vecs1, norms0, norms1, x_offsets, y_offsets, width_over2, a_b_feats)
+    if num_threads > 1 and len(tiles) > 1:
+        with ThreadPoolExecutor(max_workers=num_threads) as pool:
+            list(pool.map(lambda tile: _sparse_costs_tile(tile[0], tile[1], *args), tiles))
+    else:
+        for aa, bb in tiles:
+            _sparse_costs_tile(aa, bb, *args)
+
+    return a_b_feats, b_offset
 
-    cdef int x, y, aa, bb, xx, yy, a_idx, b_idx, bb2, x_offset, y_offset, ii_align, x_offset_idx, y_offset_idx
-    cdef int vecsize = vecs0.shape[2]
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline void _sparse_dp_cell(int aa_out,
+                                 int bb_out,
+                                 float[:, :, :] a_b_costs,
+                                 int[:] b_offset_in,
+                                 int[:] b_offset_out,
+                                 int[:] x_offsets,
+                                 int[:] y_offsets,
+                                 double del_penalty,
+                                 int x_in_size,
+                                 int y_in_size,
+                                 double[:, ::1] a_b_csum,
+                                 int[:, ::1] a_b_xp,
+                                 int[:, ::1] a_b_yp) noexcept nogil:
+    """
+    Cumulative cost and backpointers for one node of sparse_dp.
+    Only reads nodes with a smaller a, so all nodes with the same a can be computed concurrently.
+    """
+    cdef int a_in_size = a_b_costs.shape[1]
+    cdef int b_in_size = a_b_costs.shape[2]
+    cdef int a_out_size = a_in_size + 2
+    cdef int b_out_size = b_in_size
+    cdef int x_out_size = x_in_size + 1
+    cdef int y_out_size = y_in_size + 1
     cdef int num_alignments = x_offsets.shape[0]
 
-    cdef float sumx, feat
-    cdef float inf = np.inf
+    cdef int xx_out, yy_out, ii_align, x_offset, y_offset
+    cdef int aa_in_cost, bb_in_cost, aa_out_prev, bb_out_prev, xx_in_cost, yy_in_cost, xx_out_prev, yy_out_prev
+    cdef double alignment_cost, total_cost, prev_cost
 
-    for ii in range(x_y_path_.shape[0]):
-        x = x_y_path_[ii, 0]
-        y = x_y_path_[ii, 1]
+    #xx_out, yy_out = ab2xy_w_offset(aa_out, bb_out, b_offset_out)
+    yy_out = bb_out + b_offset_out[aa_out]
+    xx_out = aa_out - yy_out
 
-        # convert xy to ab cords
-        aa = x + y
-        bb = y
+    # edge case: all deletions in y-direction
+    if xx_out == 0 and 0 <= yy_out < y_out_size:
+        a_b_csum[aa_out, bb_out] = del_penalty * yy_out
+        a_b_xp[aa_out, bb_out] = 0
+        a_b_yp[aa_out, bb_out] = 1
 
-        a_idx = aa
-        b_offset[aa] = bb - width_over2
-        for b_idx, bb2 in enumerate(range(bb - width_over2, bb + width_over2)):
-            # convert ab to xy cords
-            xx = aa - bb2
-            yy = bb2
+    # edge case: all deletions in x-direction
+    elif yy_out == 0 and 0 <= xx_out < x_out_size:
+        a_b_csum[aa_out, bb_out] = del_penalty * xx_out
+        a_b_xp[aa_out, bb_out] = 1
+        a_b_yp[aa_out, bb_out] = 0
 
-            for ii_align in range(num_alignments):
-                x_offset = x_offsets[ii_align]
-                x_offset_idx = x_offset - 1  # overlaps start at 1, vectors stored 0-based
-                y_offset = y_offsets[ii_align]
-                y_offset_idx = y_offset - 1
+    else:
+        # initialize output to inf
+        a_b_csum[aa_out, bb_out] = INFINITY
+        a_b_xp[aa_out, bb_out] = -42
+        a_b_yp[aa_out, bb_out] = -42
 
-                if 0 <= xx < xsize and 0 <= yy < ysize:
-                    sumx = 0.0
-                    for jj in range(vecsize):
-                        sumx += vecs0[x_offset_idx, xx, jj] * vecs1[y_offset_idx, yy, jj]
-                    feat = 2.0 * x_offset * y_offset * (1.0 - sumx) / (
-                            1e-6 + norms0[x_offset_idx, xx] + norms1[y_offset_idx, yy])
+        for ii_align in range(num_alignments):
+            x_offset = x_offsets[ii_align]
+            y_offset = y_offsets[ii_align]
 
-                else:
-                    feat = inf
+            # coords of location of alignment cost, in input x/y space
+            xx_in_cost = xx_out - 1  # features were front padded,
+            yy_in_cost = yy_out - 1  #   so offset is always 1
 
-                a_b_feats[ii_align, a_idx, b_idx] = feat
+            # the coords of location of previous cumsum cost, in input x/y space
+            xx_out_prev = xx_out - x_offset
+            yy_out_prev = yy_out - y_offset
 
-    return a_b_feats, b_offset
+            if 0 <= xx_in_cost < x_in_size and 0 <= yy_in_cost < y_in_size and 0 <= xx_out_prev < x_out_size and 0 <= yy_out_prev < y_out_size:
+                # convert x,y to a,b
+                aa_in_cost = xx_in_cost + yy_in_cost
+                bb_in_cost = yy_in_cost - b_offset_in[aa_in_cost]
+
+                aa_out_prev = xx_out_prev + yy_out_prev
+                bb_out_prev = yy_out_prev - b_offset_out[aa_out_prev]
+
+                if 0 <= aa_in_cost < a_in_size and 0 <= bb_in_cost < b_in_size and 0 <= aa_out_prev < a_out_size and 0 <= bb_out_prev < b_out_size:
+                    if x_offset == 0 or y_offset == 0:
+                        alignment_cost = del_penalty
+                    else:
+                        alignment_cost = a_b_costs[ii_align, aa_in_cost, bb_in_cost]
+
+                    prev_cost = a_b_csum[aa_out_prev, bb_out_prev]
+
+                    total_cost = prev_cost + alignment_cost
+
+                    if total_cost < a_b_csum[aa_out, bb_out]:
+                        a_b_csum[aa_out, bb_out] = total_cost
+                        a_b_xp[aa_out, bb_out] = x_offset
+                        a_b_yp[aa_out, bb_out] = y_offset
 
 
 def sparse_dp(np.ndarray[float, ndim=3] a_b_costs,
@@ -277,7 +401,8 @@ def sparse_dp(np.ndarray[float, ndim=3] a_b_costs,
               alignment_types,
               double del_penalty,
               int x_in_size,
-              int y_in_size):
+              int y_in_size,
+              int num_threads=-1):
     """
     Do DP along a path, using features saved off along path.
     x_offsets, y_offsets should not include (0,1), (1,0)
@@ -335,77 +460,40 @@ def sparse_dp(np.ndarray[float, ndim=3] a_b_costs,
 
     # outputs
     # For anything being used in accumulation, use float64
-    cdef np.ndarray[double, ndim=2] a_b_csum = np.zeros((a_in_size + 2, b_in_size),
-                                                        dtype=np.float64) + np.inf  # error cumulative sum
-    cdef np.ndarray[int, ndim=2] a_b_xp = np.zeros((a_in_size + 2, b_in_size), dtype=np.int32) - 2  # backpointer for x
-    cdef np.ndarray[int, ndim=2] a_b_yp = np.zeros((a_in_size + 2, b_in_size), dtype=np.int32) - 2  # backpointer for y
-
-    cdef int num_alignments = x_offsets.shape[0]
-    cdef double inf = np.inf
-    cdef int xx_out, yy_out, ii_align, x_offset, y_offset
-    cdef int aa_in_cost, bb_in_cost, aa_out, bb_out, aa_out_prev, bb_out_prev, xx_in_cost, yy_in_cost, xx_out_prev, yy_out_prev
-
-    cdef double alignment_cost, total_cost, prev_cost
+    a_b_csum_ = np.zeros((a_in_size + 2, b_in_size), dtype=np.float64) + np.inf  # error cumulative sum
+    a_b_xp_ = np.zeros((a_in_size + 2, b_in_size), dtype=np.int32) - 2  # backpointer for x
+    a_b_yp_ = np.zeros((a_in_size + 2, b_in_size), dtype=np.int32) - 2  # backpointer for y
+
+    cdef double[:, ::1] a_b_csum = a_b_csum_
+    cdef int[:, ::1] a_b_xp = a_b_xp_
+    cdef int[:, ::1] a_b_yp = a_b_yp_
+    cdef float[:, :, :] costs = a_b_costs
+    cdef int[:] b_offset_in_view = b_offset_in
+    cdef int[:] b_offset_out_view = b_offset_out
+    cdef int[:] x_offsets_view = x_offsets
+    cdef int[:] y_offsets_view = y_offsets
+    cdef int aa_out, bb_out
+
+    if num_threads < 1:
+        num_threads = DP_NUM_THREADS
 
     # increasing in a is the same as going along diagonals in x/y, so DP order works
     #  (and any ordering is fine in b - nothing depends on values adjacent on diagonal in x/y)
-    for aa_out in range(a_in_size + 2):
-        for bb_out in range(b_in_size):
-            #xx_out, yy_out = ab2xy_w_offset(aa_out, bb_out, b_offset_out)
-            yy_out = bb_out + b_offset_out[aa_out]
-            xx_out = aa_out - yy_out
-
-            # edge case: all deletions in y-direction
-            if xx_out == 0 and 0 <= yy_out < y_out_size:
-                a_b_csum[aa_out, bb_out] = del_penalty * yy_out
-                a_b_xp[aa_out, bb_out] = 0
-                a_b_yp[aa_out, bb_out] = 1
-
-            # edge case: all deletions in x-direction
-            elif yy_out == 0 and 0 <= xx_out < x_out_size:
-                a_b_csum[aa_out, bb_out] = del_penalty * xx_out
-                a_b_xp[aa_out, bb_out] = 1
-                a_b_yp[aa_out, bb_out] = 0
-
-            else:
-                # initialize output to inf
-                a_b_csum[aa_out, bb_out] = inf
-                a_b_xp[aa_out, bb_out] = -42
-                a_b_yp[aa_out, bb_out] = -42
-
-                for ii_align in range(num_alignments):
-                    x_offset = x_offsets[ii_align]
-                    y_offset = y_offsets[ii_align]
-
-                    # coords of location of alignment cost, in input x/y space
-                    xx_in_cost = xx_out - 1  # features were front padded,
-                    yy_in_cost = yy_out - 1  #   so offset is always 1
-
-                    # the coords of location of previous cumsum cost, in input x/y space
-                    xx_out_prev = xx_out - x_offset
-                    yy_out_prev = yy_out - y_offset
-
-                    if 0 <= xx_in_cost < x_in_size and 0 <= yy_in_cost < y_in_size and 0 <= xx_out_prev < x_out_size and 0 <= yy_out_prev < y_out_size:
-                        # convert x,y to a,b
-                        aa_in_cost = xx_in_cost + yy_in_cost
-                        bb_in_cost = yy_in_cost - b_offset_in[aa_in_cost]
-
-                        aa_out_prev = xx_out_prev + yy_out_prev
-                        bb_out_prev = yy_out_prev - b_offset_out[aa_out_prev]
-
-                        if 0 <= aa_in_cost < a_in_size and 0 <= bb_in_cost < b_in_size and 0 <= aa_out_prev < a_out_size and 0 <= bb_out_prev < b_out_size:
-                            if x_offset == 0 or y_offset == 0:
-                                alignment_cost = del_penalty
-                            else:
-                                alignment_cost = a_b_costs[ii_align, aa_in_cost, bb_in_cost]
-
-                            prev_cost = a_b_csum[aa_out_prev, bb_out_prev]
-
-                            total_cost = prev_cost + alignment_cost
-
-                            if total_cost < a_b_csum[aa_out, bb_out]:
-                                a_b_csum[aa_out, bb_out] = total_cost
-                                a_b_xp[aa_out, bb_out] = x_offset
-                                a_b_yp[aa_out, bb_out] = y_offset
-
-    return a_b_csum, a_b_xp, a_b_yp, b_offset_out
+    # so each anti-diagonal (fixed a) is a wavefront whose cells can be computed in parallel;
+    #  prange ends with an implicit barrier before the next a starts
+    if num_threads > 1 and b_in_size > 1:
+        with nogil, parallel(num_threads=num_threads):
+            for aa_out in range(a_out_size):
+                for bb_out in prange(b_in_size, schedule='static'):
+                    _sparse_dp_cell(aa_out, bb_out, costs, b_offset_in_view, b_offset_out_view,
+                                    x_offsets_view, y_offsets_view, del_penalty,
+                                    x_in_size, y_in_size, a_b_csum, a_b_xp, a_b_yp)
+    else:
+        with nogil:
+            for aa_out in range(a_out_size):
+                for bb_out in range(b_in_size):
+                    _sparse_dp_cell(aa_out, bb_out, costs, b_offset_in_view, b_offset_out_view,
+                                    x_offsets_view, y_offsets_view, del_penalty,
+                                    x_in_size, y_in_size, a_b_csum, a_b_xp, a_b_yp)
+
+    return a_b_csum_, a_b_xp_, a_b_yp_, b_offset_out
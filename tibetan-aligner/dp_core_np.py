@@ -0,0 +1,301 @@
+"""
+Pure-NumPy implementation of the dp_core kernels.
+
+Used by dp_utils when the compiled dp_core extension is not available
+(see setup.py). Same functions, signatures and results as dp_core.pyx:
+the cost kernels agree within float tolerance, and dense_dp/sparse_dp make
+the same decisions, including tie-breaking, because they visit nodes one
+anti-diagonal at a time in the same order.
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from quantize import to_float32
+
+DP_NUM_THREADS = int(os.getenv("DP_NUM_THREADS", os.cpu_count() or 1))
+
+# rows per chunk in score_path, bounds the gathered vectors to a few MB
+_SCORE_PATH_CHUNK_SIZE = 4096
+
+
+def make_x_y_offsets(alignment_types):
+    # alignment types for which we will precompute costs
+
+    # deletion/insertion is added later
+    for x, y in alignment_types:
+        assert (x > 0)
+        assert (y > 0)
+
+    x_offsets = np.array([x for x, y in alignment_types], dtype=np.int32)  # MUST **NOT** INCLUDE (0,1), (1,0)
+    y_offsets = np.array([y for x, y in alignment_types], dtype=np.int32)  # MUST **NOT** INCLUDE (0,1), (1,0)
+    return x_offsets, y_offsets
+
+
+def make_dense_costs(vecs0, vecs1, norm0, norm1, offset0=0, offset1=0):
+    """
+    Make a full N*M feature matrix. By default, makes 1-1 alignments,
+       can build others by specifying offset0, offset1 to index into
+       vecs0, norms0 and vecs1, norms1 respectivly.
+    """
+    assert vecs0.shape[0] > offset0
+    assert vecs1.shape[0] > offset1
+    assert norm0.shape[0] > offset0
+    assert norm1.shape[0] > offset1
+    assert norm0.shape[1] == vecs0.shape[1]
+    assert norm1.shape[1] == vecs1.shape[1]
+    assert vecs1.shape[2] == vecs0.shape[2]
+
+    costs = np.dot(vecs0[offset0], vecs1[offset1].T).astype(np.float32, copy=False)
+    np.subtract(1.0, costs, out=costs)
+    costs *= 2.0
+    costs /= (norm0[offset0, :, None] + 1e-6) + norm1[offset1, None, :]
+    # normalize by alignment type
+    costs *= (offset0 + 1) * (offset1 + 1)
+    return costs
+
+
+def dense_dp(alignment_cost, pen):
+    """
+    Compute cost matrix (csum) and backpointers (bp)
+    from full 2-D 1-1 alignment costs matrix (alignment_cost)
+    """
+    # dp_core takes pen as a C float
+    pen = np.float32(pen)
+    size0, size1 = alignment_cost.shape
+
+    csum = np.empty((size0 + 1, size1 + 1), dtype=np.float64)
+    bp = np.empty((size0 + 1, size1 + 1), dtype=np.int32)
+
+    # initialize the all c-direction and r-direction deletion paths (c * pen is single precision in C)
+    csum[0, :] = np.arange(size1 + 1, dtype=np.float32) * pen
+    bp[0, :] = 1
+    csum[:, 0] = np.arange(size0 + 1, dtype=np.float32) * pen
+    bp[:, 0] = 2
+    csum[0, 0] = 0.0
+    bp[0, 0] = 4  # should not matter
+
+    # nodes with the same r + c only depend on the two previous anti-diagonals
+    for diag in range(2, size0 + size1 + 1):
+        r = np.arange(max(1, diag - size1), min(size0, diag - 1) + 1)
+        c = diag - r
+
+        cost0 = csum[r - 1, c - 1] + alignment_cost[r - 1, c - 1]
+        cost1 = csum[r, c - 1] + float(pen)
+        cost2 = csum[r - 1, c] + float(pen)
+
+        best = cost0
+        choice = np.zeros(len(r), dtype=np.int32)
+        better = cost1 < best
+        best = np.where(better, cost1, best)
+        choice[better] = 1
+        better = cost2 < best
+        best = np.where(better, cost2, best)
+        choice[better] = 2
+
+        csum[r, c] = best
+        bp[r, c] = choice
+
+    return csum, bp
+
+
+def score_path(xx, yy, norm1, norm2, vecs1, vecs2, out, num_threads=-1):
+    for start in range(0, xx.shape[0], _SCORE_PATH_CHUNK_SIZE):
+        xi = xx[start:start + _SCORE_PATH_CHUNK_SIZE]
+        yi = yy[start:start + _SCORE_PATH_CHUNK_SIZE]
+        outx = np.einsum('ij,ij->i', vecs1[xi], vecs2[yi])
+        out[start:start + len(xi)] = 2.0 * (1.0 - outx) / (norm1[xi] + norm2[yi])
+
+
+def _sparse_costs_tile(aa, bb, vecs0, vecs1, norms0, norms1, x_offsets, y_offsets, width_over2, a_b_feats):
+    """
+    Fill a_b_feats for the search path points (aa, bb) of one tile, in a,b coordinates
+    """
+    xsize = vecs0.shape[1]
+    ysize = vecs1.shape[1]
+
+    # convert ab to xy cords, for every point in the band
+    yy = bb[:, None] + np.arange(-width_over2, width_over2, dtype=np.int32)[None, :]
+    xx = aa[:, None] - yy
+    valid = (0 <= xx) & (xx < xsize) & (0 <= yy) & (yy < ysize)
+    if not valid.any():
+        return
+
+    rows, cols = np.nonzero(valid)
+    aa_valid = aa[rows]
+    xx_valid = xx[rows, cols]
+    yy_valid = yy[rows, cols]
+    x_lo, x_hi = xx_valid.min(), xx_valid.max() + 1
+    y_lo, y_hi = yy_valid.min(), yy_valid.max() + 1
+    xx_valid -= x_lo
+    yy_valid -= y_lo
+
+    for ii_align in range(x_offsets.shape[0]):
+        x_offset_idx = x_offsets[ii_align] - 1  # overlaps start at 1, vectors stored 0-based
+        y_offset_idx = y_offsets[ii_align] - 1
+
+        # reduced precision vectors are expanded one block at a time
+        block = np.dot(to_float32(vecs0[x_offset_idx, x_lo:x_hi]), to_float32(vecs1[y_offset_idx, y_lo:y_hi]).T)
+        feat = block[xx_valid, yy_valid]
+        np.subtract(1.0, feat, out=feat)
+        feat *= 2.0 * x_offsets[ii_align] * y_offsets[ii_align]
+        feat /= (norms0[x_offset_idx, x_lo:x_hi][xx_valid] + 1e-6) + norms1[y_offset_idx, y_lo:y_hi][yy_valid]
+
+        a_b_feats[ii_align, aa_valid, cols] = feat
+
+
+def make_sparse_costs(vecs0, vecs1, norms0, norms1, x_y_path, alignment_types, width_over2,
+                      tile_size=0, num_threads=-1):
+    """
+    Make features for DP, *for lines running across approximate path*, *for each alignment type*
+    x_offsets, y_offsets should not include (0,1), (1,0)
+    """
+    x_y_path_ = np.array(x_y_path).astype(np.int32)
+
+    assert (vecs0.shape[0] == norms0.shape[0])
+    assert (vecs1.shape[0] == norms1.shape[0])
+    assert (vecs0.shape[1] == norms0.shape[1])
+    assert (vecs1.shape[1] == norms1.shape[1])
+
+    max_x_overlap = max([0] + [x for x, y in alignment_types])  # add [0] in case alignment_types is empty
+    max_y_overlap = max([0] + [y for x, y in alignment_types])  # add [0] in case alignment_types is empty
+
+    # note: alignment types are specified 1-based, but vectors are stored 0-based
+    if max_x_overlap > vecs0.shape[0]:
+        raise Exception('%d x overlaps requrested (via alignment_types), but vecs0 only has %d' % (
+            max_x_overlap, vecs0.shape[0]))
+    if max_y_overlap > vecs1.shape[0]:
+        raise Exception('%d y overlaps requrested (via alignment_types), but vecs1 only has %d' % (
+            max_y_overlap, vecs1.shape[0]))
+
+    # vector diminsions should match
+    assert (vecs0.shape[2] == vecs1.shape[2])
+
+    x_offsets, y_offsets = make_x_y_offsets(alignment_types)
+
+    # reserve outputs
+    a_len = x_y_path_.shape[0]
+    b_len = 2 * width_over2
+    a_b_feats = np.full((len(alignment_types), a_len, b_len), np.inf, dtype=np.float32)
+    b_offset = np.empty(a_len, dtype=np.int32)
+
+    if tile_size <= 0:
+        tile_size = b_len
+    if num_threads < 1:
+        num_threads = DP_NUM_THREADS
+
+    # convert xy to ab cords
+    aa_path = x_y_path_[:, 0] + x_y_path_[:, 1]
+    bb_path = x_y_path_[:, 1]
+    b_offset[aa_path] = bb_path - width_over2
+
+    tiles = [(aa_path[start:start + tile_size], bb_path[start:start + tile_size])
+             for start in range(0, a_len, tile_size)]
+    args = (vecs0, vecs1, norms0, norms1, x_offsets, y_offsets, width_over2, a_b_feats)
+    if num_threads > 1 and len(tiles) > 1:
+        with ThreadPoolExecutor(max_workers=num_threads) as pool:
+            list(pool.map(lambda tile: _sparse_costs_tile(tile[0], tile[1], *args), tiles))
+    else:
+        for aa, bb in tiles:
+            _sparse_costs_tile(aa, bb, *args)
+
+    return a_b_feats, b_offset
+
+
+def sparse_dp(a_b_costs, b_offset_in, alignment_types, del_penalty, x_in_size, y_in_size, num_threads=-1):
+    """
+    Do DP along a path, using features saved off along path.
+    See dp_core.sparse_dp for the a,b coordinate system.
+
+    All nodes with the same a only depend on nodes with a smaller a,
+       so each a is computed as one vectorized step over b.
+    """
+    x_offsets, y_offsets = make_x_y_offsets(alignment_types)
+
+    # make x/y offsets, including (0,1), (1,), i.e. including deletion and insertion
+    x_offsets = np.concatenate([x_offsets, np.array([0, 1], dtype=np.int32)])
+    y_offsets = np.concatenate([y_offsets, np.array([1, 0], dtype=np.int32)])
+
+    a_in_size = a_b_costs.shape[1]
+    b_in_size = a_b_costs.shape[2]
+
+    a_out_size = a_in_size + 2
+    b_out_size = b_in_size
+
+    x_out_size = x_in_size + 1
+    y_out_size = y_in_size + 1
+
+    extra_two_points = np.array([b_offset_in[0], b_offset_in[0]], dtype=np.int32)
+    b_offset_out = np.concatenate([extra_two_points, b_offset_in + 1])
+
+    # outputs
+    # For anything being used in accumulation, use float64
+    a_b_csum = np.zeros((a_in_size + 2, b_in_size), dtype=np.float64) + np.inf  # error cumulative sum
+    a_b_xp = np.zeros((a_in_size + 2, b_in_size), dtype=np.int32) - 2  # backpointer for x
+    a_b_yp = np.zeros((a_in_size + 2, b_in_size), dtype=np.int32) - 2  # backpointer for y
+
+    bb_out = np.arange(b_in_size)
+
+    for aa_out in range(a_out_size):
+        yy_out = bb_out + b_offset_out[aa_out]
+        xx_out = aa_out - yy_out
+
+        # edge case: all deletions in y-direction
+        edge_y = (xx_out == 0) & (0 <= yy_out) & (yy_out < y_out_size)
+        # edge case: all deletions in x-direction
+        edge_x = ~edge_y & (yy_out == 0) & (0 <= xx_out) & (xx_out < x_out_size)
+        inner = ~(edge_y | edge_x)
+
+        csum = np.where(edge_y, del_penalty * yy_out, np.where(edge_x, del_penalty * xx_out, np.inf))
+        xp = np.where(edge_y, 0, np.where(edge_x, 1, -42)).astype(np.int32)
+        yp = np.where(edge_y, 1, np.where(edge_x, 0, -42)).astype(np.int32)
+
+        # coords of location of alignment cost, in input x/y space
+        xx_in_cost = xx_out - 1  # features were front padded,
+        yy_in_cost = yy_out - 1  #   so offset is always 1
+        aa_in_cost = aa_out - 2
+        in_cost_ok = (0 <= xx_in_cost) & (xx_in_cost < x_in_size) & (0 <= yy_in_cost) & (yy_in_cost < y_in_size)
+
+        if 0 <= aa_in_cost < a_in_size and inner.any():
+            bb_in_cost = yy_in_cost - b_offset_in[aa_in_cost]
+            in_cost_ok &= (0 <= bb_in_cost) & (bb_in_cost < b_in_size)
+            bb_in_cost_idx = np.clip(bb_in_cost, 0, b_in_size - 1)
+
+            for ii_align in range(x_offsets.shape[0]):
+                x_offset = x_offsets[ii_align]
+                y_offset = y_offsets[ii_align]
+
+                # the coords of location of previous cumsum cost, in input x/y space
+                xx_out_prev = xx_out - x_offset
+                yy_out_prev = yy_out - y_offset
+                aa_out_prev = aa_out - x_offset - y_offset
+                if not 0 <= aa_out_prev < a_out_size:
+                    continue
+                bb_out_prev = yy_out_prev - b_offset_out[aa_out_prev]
+
+                ok = inner & in_cost_ok & \
+                    (0 <= xx_out_prev) & (xx_out_prev < x_out_size) & \
+                    (0 <= yy_out_prev) & (yy_out_prev < y_out_size) & \
+                    (0 <= bb_out_prev) & (bb_out_prev < b_out_size)
+                if not ok.any():
+                    continue
+
+                if x_offset == 0 or y_offset == 0:
+                    alignment_cost = del_penalty
+                else:
+                    alignment_cost = a_b_costs[ii_align, aa_in_cost, bb_in_cost_idx].astype(np.float64)
+
+                total_cost = a_b_csum[aa_out_prev, np.clip(bb_out_prev, 0, b_out_size - 1)] + alignment_cost
+
+                better = ok & (total_cost < csum)
+                csum = np.where(better, total_cost, csum)
+                xp[better] = x_offset
+                yp[better] = y_offset
+
+        a_b_csum[aa_out] = csum
+        a_b_xp[aa_out] = xp
+        a_b_yp[aa_out] = yp
+
+    return a_b_csum, a_b_xp, a_b_yp, b_offset_out
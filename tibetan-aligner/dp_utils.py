@@ -14,7 +14,9 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+import importlib
 import logging
+import os
 import sys
 from ast import literal_eval
 from collections import OrderedDict
@@ -23,13 +25,48 @@ from time import time
 
 import numpy as np
 
-import pyximport
-pyximport.install(setup_args={'include_dirs':np.get_include()}, inplace=True, reload_support=True)
-
-from dp_core import make_dense_costs, score_path, sparse_dp, make_sparse_costs, dense_dp
+from alignment_table import AlignmentTable
+from embedding_store import EmbeddingStore
+from quantize import Int8Vectors, precision_of, quantize, to_float32
 
 logger = logging.getLogger('vecalign')  # set up in vecalign.py
 
+# dp_core is built at install or startup time (setup.py, build_dp_core.py); set DP_CORE_BUILD=1 to build it on import
+# instead when it is missing, e.g. when running the aligner scripts straight from a checkout
+DP_CORE_BUILD = os.getenv('DP_CORE_BUILD', '0') == '1'
+
+
+def _load_dp_core():
+    """the compiled dp_core module, or None if it has not been built"""
+    try:
+        return importlib.import_module('dp_core')
+    except ModuleNotFoundError as e:
+        # only dp_core itself missing means "not built"; anything else it fails to import is a real error
+        if e.name != 'dp_core':
+            raise
+        return None
+
+
+t0 = time()
+_dp_core = _load_dp_core()
+if _dp_core is None and DP_CORE_BUILD:
+    from build_dp_core import build_dp_core
+    build_dp_core()
+    _dp_core = _load_dp_core()
+if _dp_core is not None:
+    DP_CORE_BACKEND = 'cython'
+else:
+    import dp_core_np as _dp_core
+    DP_CORE_BACKEND = 'numpy'
+    logger.warning('compiled dp_core not available, using the slower NumPy kernels. '
+                   'Build it with "python build_dp_core.py" in tibetan-aligner/')
+make_dense_costs = _dp_core.make_dense_costs
+score_path = _dp_core.score_path
+sparse_dp = _dp_core.sparse_dp
+make_sparse_costs = _dp_core.make_sparse_costs
+dense_dp = _dp_core.dense_dp
+DP_CORE_IMPORT_TIME = time() - t0
+
 
 def preprocess_line(line):
     line = line.strip()
@@ -47,12 +84,52 @@ def yield_overlaps(lines, num_overlaps):
             yield out_line2
 
 
-def read_in_embeddings(text_file, embed_file):
+def make_overlay_index(lines, num_overlaps):
+    """
+    Distinct overlays of lines, as yield_overlaps makes them, and a (num_overlaps, len(lines)) array
+       giving the position in that list of the overlay of each (overlap, line).
+    Encode the overlays and pass the vectors to gather_doc_embedding with the index.
+    """
+    lines = [preprocess_line(line) for line in lines]
+    overlay2row = dict()
+    overlay_index = np.empty((num_overlaps, len(lines)), dtype=np.int64)
+    for ii, overlap in enumerate(range(1, num_overlaps + 1)):
+        # same truncation as yield_overlaps
+        overlay_index[ii] = [overlay2row.setdefault(out_line[:10000], len(overlay2row))
+                             for out_line in layer(lines, overlap)]
+    return list(overlay2row), overlay_index
+
+
+def gather_doc_embedding(line_embeddings, overlay_index, precision='float32'):
+    """
+    Document embedding (num_overlaps, len(lines), dim) for an index from make_overlay_index,
+       built with a single gather; there are no lookups that could miss
+    At a reduced precision (see quantize.py) the distinct vectors are normalized and quantized
+       before the gather, so the full float32 document embedding is never built.
+    """
+    if precision == 'float32':
+        return line_embeddings[overlay_index].astype(np.float32, copy=False)
+    line_embeddings = np.array(line_embeddings, dtype=np.float32)
+    make_norm1(line_embeddings[None])
+    line_embeddings = quantize(line_embeddings, precision)
+    if isinstance(line_embeddings, Int8Vectors):
+        return Int8Vectors(line_embeddings.codes[overlay_index], line_embeddings.scales[overlay_index])
+    return line_embeddings[overlay_index]
+
+
+def read_in_embeddings(text_file, embed_file=None, cache=None):
     """
     Given a text file with candidate sentences and a corresponing embedding file,
        make a maping from candidate sentence to embedding index, 
        and a numpy array of the embeddings
+    If text_file is an embedding_store.EmbeddingStore directory, returns the store and its memory-mapped vectors.
+    Otherwise, if embed_file is None, the embeddings are read from cache (an embedding_cache.EmbeddingCache) instead
     """
+    if embed_file is None and EmbeddingStore.is_store(text_file):
+        store = EmbeddingStore.open(text_file)
+        logger.debug('line embeddings shape: %s', store.vectors.shape)
+        return store, store.vectors
+
     sent2line = dict()
     with open(text_file, 'rt', encoding="utf-8") as fin:
         for ii, line in enumerate(fin):
@@ -61,8 +138,19 @@ def read_in_embeddings(text_file, embed_file):
             #     raise Exception('got multiple embeddings for the same line:',line)
             sent2line[line.strip()] = ii
 
-    line_embeddings = np.load(embed_file,allow_pickle=True)
-    print("LINE EMBEDDINGS SHAPE",line_embeddings.shape)
+    if embed_file is not None:
+        line_embeddings = np.load(embed_file,allow_pickle=True)
+    elif cache is not None:
+        sents = sorted(sent2line, key=sent2line.get)
+        sent2line = {sent: ii for ii, sent in enumerate(sents)}
+        vecs = cache.get_many(sents)
+        missing = [sent for sent, vec in zip(sents, vecs) if vec is None]
+        if missing:
+            raise Exception('%d lines of %s are not in the embedding cache, e.g. "%s"' % (len(missing), text_file, missing[0]))
+        line_embeddings = np.stack(vecs) if vecs else np.empty((0, 0), dtype=np.float32)
+    else:
+        raise Exception('need either an embedding file or an embedding cache')
+    logger.debug('line embeddings shape: %s', line_embeddings.shape)
     # line_embeddings = np.fromfile(embed_file, dtype=np.float32, count=-1)
     # if line_embeddings.size == 0:
     #     raise Exception('Got empty embedding file')
@@ -75,10 +163,18 @@ def read_in_embeddings(text_file, embed_file):
     return sent2line, line_embeddings
 
 
-def make_doc_embedding(sent2line, line_embeddings, lines, num_overlaps):
+def _lookup_rows(sent2line, out_lines):
+    if hasattr(sent2line, 'lookup'):
+        return sent2line.lookup(out_lines)
+    return np.fromiter((sent2line.get(out_line, -1) for out_line in out_lines), dtype=np.int64, count=len(out_lines))
+
+
+def make_doc_embedding(sent2line, line_embeddings, lines, num_overlaps, cache=None):
     """
     lines: sentences in input document to embed
-    sent2line, line_embeddings: precomputed embeddings for lines (and overlaps of lines)
+    sent2line, line_embeddings: precomputed embeddings for lines (and overlaps of lines),
+       or an embedding_store.EmbeddingStore and its vectors
+    cache: optional embedding_cache.EmbeddingCache, consulted for overlaps not in sent2line
     """
 
     lines = [preprocess_line(line) for line in lines]
@@ -87,17 +183,27 @@ def make_doc_embedding(sent2line, line_embeddings, lines, num_overlaps):
 
     vecs0 = np.empty((num_overlaps, len(lines), vecsize), dtype=np.float32)
 
-    for ii, overlap in enumerate(range(1, num_overlaps + 1)):
-        for jj, out_line in enumerate(layer(lines, overlap)):
-            try:
-                line_id = sent2line[out_line]
-            except KeyError:
-                logger.warning('Failed to find overlap=%d line "%s". Will use random vector.', overlap, out_line)
-                line_id = None
+    out_lines = [list(layer(lines, overlap)) for overlap in range(1, num_overlaps + 1)]
+    rows = [_lookup_rows(sent2line, layer_lines) for layer_lines in out_lines]
+
+    cached = dict()
+    if cache is not None:
+        misses = set()
+        for layer_lines, layer_rows in zip(out_lines, rows):
+            misses.update(layer_lines[jj] for jj in np.flatnonzero(layer_rows < 0))
+        misses = list(misses)
+        cached = {out_line: vec for out_line, vec in zip(misses, cache.get_many(misses)) if vec is not None}
 
-            if line_id is not None:
-                vec = line_embeddings[line_id]
+    for ii, overlap in enumerate(range(1, num_overlaps + 1)):
+        found = rows[ii] >= 0
+        # one gather per layer; from a memory-mapped store this only reads the rows used
+        vecs0[ii, found] = line_embeddings[rows[ii][found]]
+        for jj in np.flatnonzero(~found):
+            out_line = out_lines[ii][jj]
+            if out_line in cached:
+                vec = cached[out_line]
             else:
+                logger.warning('Failed to find overlap=%d line "%s". Will use random vector.', overlap, out_line)
                 vec = np.random.random(vecsize) - 0.5
                 vec = vec / np.linalg.norm(vec)
 
@@ -110,10 +216,12 @@ def make_norm1(vecs0):
     """
     make vectors norm==1 so that cosine distance can be computed via dot product
     """
+    # one overlap layer at a time, so the squares temporary is only a single layer
     for ii in range(vecs0.shape[0]):
-        for jj in range(vecs0.shape[1]):
-            norm = np.sqrt(np.square(vecs0[ii, jj, :]).sum())
-            vecs0[ii, jj, :] = vecs0[ii, jj, :] / (norm + 1e-5)
+        vecs = vecs0[ii]
+        norms = np.sqrt(np.square(vecs).sum(axis=1))
+        norms += 1e-5
+        vecs /= norms[:, None]
 
 
 def layer(lines, num_overlaps, comb=' '):
@@ -129,6 +237,9 @@ def layer(lines, num_overlaps, comb=' '):
 
 
 def read_alignments(fin):
+    if AlignmentTable.is_table(fin):
+        return AlignmentTable.load(fin).alignments()
+
     alignments = []
     with open(fin, 'rt', encoding="utf-8") as infile:
         for line in infile:
@@ -411,7 +522,8 @@ def make_del_knob(e_laser,
                   f_laser,
                   e_laser_norms,
                   f_laser_norms,
-                  sample_size):
+                  sample_size,
+                  num_threads=-1):
     e_size = e_laser.shape[0]
     f_size = f_laser.shape[0]
 
@@ -420,18 +532,12 @@ def make_del_knob(e_laser,
         if e_size * f_size < sample_size:
             # dont sample, just compute full matrix
             sample_size = e_size * f_size
-            x_idxs = np.zeros(sample_size, dtype=np.int32)
-            y_idxs = np.zeros(sample_size, dtype=np.int32)
-            c = 0
-            for ii in range(e_size):
-                for jj in range(f_size):
-                    x_idxs[c] = ii
-                    y_idxs[c] = jj
-                    c += 1
+            x_idxs = np.repeat(np.arange(e_size, dtype=np.int32), f_size)
+            y_idxs = np.tile(np.arange(f_size, dtype=np.int32), e_size)
         else:
             # get random samples
-            x_idxs = np.random.choice(range(e_size), size=sample_size, replace=True).astype(np.int32)
-            y_idxs = np.random.choice(range(f_size), size=sample_size, replace=True).astype(np.int32)
+            x_idxs = np.random.choice(e_size, size=sample_size, replace=True).astype(np.int32)
+            y_idxs = np.random.choice(f_size, size=sample_size, replace=True).astype(np.int32)
 
         # output
         random_scores = np.empty(sample_size, dtype=np.float32)
@@ -439,7 +545,7 @@ def make_del_knob(e_laser,
         score_path(x_idxs, y_idxs,
                    e_laser_norms, f_laser_norms,
                    e_laser, f_laser,
-                   random_scores, )
+                   random_scores, num_threads)
 
         min_score = 0
         max_score = max(random_scores)  # could bump this up... but its probably fine
@@ -474,13 +580,13 @@ def compute_norms(vecs0, vecs1, num_samples, overlaps_to_use=None):
         # sample other size (from all overlaps) to compre to this side
         vecs1_rand_sample = np.empty((samps_per_overlap * overlaps_to_use, dim), dtype=np.float32)
         for overlap_ii in range(overlaps_to_use):
-            idxs = np.random.choice(range(size1), size=samps_per_overlap, replace=True)
+            idxs = np.random.choice(size1, size=samps_per_overlap, replace=True)
             random_vecs = vecs1[overlap_ii, idxs, :]
             vecs1_rand_sample[overlap_ii * samps_per_overlap:(overlap_ii + 1) * samps_per_overlap, :] = random_vecs
 
         norms0 = np.empty((overlaps0, size0), dtype=np.float32)
         for overlap_ii in range(overlaps0):
-            e_laser = vecs0[overlap_ii, :, :]
+            e_laser = to_float32(vecs0[overlap_ii, :, :])
             sim = np.matmul(e_laser, vecs1_rand_sample.T)
             norms0[overlap_ii, :] = 1.0 - sim.mean(axis=1)
 
@@ -493,20 +599,19 @@ def compute_norms(vecs0, vecs1, num_samples, overlaps_to_use=None):
 def downsample_vectors(vecs1):
     a, b, c = vecs1.shape
     half = np.empty((a, b // 2, c), dtype=np.float32)
-    for ii in range(a):
-        # average consecutive vectors
-        for jj in range(0, b - b % 2, 2):
-            v1 = vecs1[ii, jj, :]
-            v2 = vecs1[ii, jj + 1, :]
-            half[ii, jj // 2, :] = v1 + v2
-        # compute mean for all vectors
-        mean = np.mean(half[ii, :, :], axis=0)
-        for jj in range(0, b - b % 2, 2):
-            # remove mean
-            half[ii, jj // 2, :] = half[ii, jj // 2, :] - mean
+    # average consecutive vectors
+    if precision_of(vecs1) == 'float32':
+        np.add(vecs1[:, 0:b - b % 2:2, :], vecs1[:, 1:b - b % 2:2, :], out=half)
+    else:
+        for ii in range(a):
+            np.add(to_float32(vecs1[ii, 0:b - b % 2:2, :]), to_float32(vecs1[ii, 1:b - b % 2:2, :]), out=half[ii])
+    if b // 2:
+        # remove mean
+        half -= np.mean(half, axis=1, keepdims=True)
     # make vectors norm==1 so dot product is cosine distance
     make_norm1(half)
-    return half
+    # keep the pyramid at the precision of the input
+    return quantize(half, precision_of(vecs1))
 
 
 def vecalign(vecs0,
@@ -518,14 +623,32 @@ def vecalign(vecs0,
              costs_sample_size,
              num_samps_for_norm,
              norms0=None,
-             norms1=None):
+             norms1=None,
+             precision=None,
+             projection=None,
+             num_threads=-1):
+    """
+    precision: if given, store the embeddings (and the pyramid built from them) at this precision,
+       one of quantize.PRECISIONS; reduced precision inputs are used as they are and must have norm 1
+    projection: optional projection.Projection applied to the embeddings before anything else
+    num_threads: threads for the DP kernels; below 1 means DP_NUM_THREADS
+    """
     if width_over2 < 3:
         logger.warning('width_over2 was set to %d, which does not make sense. increasing to 3.', width_over2)
         width_over2 = 3
 
+    if projection is not None:
+        vecs0 = projection.apply(to_float32(vecs0))
+        vecs1 = projection.apply(to_float32(vecs1))
+
     # make sure input embeddings are norm==1
-    make_norm1(vecs0)
-    make_norm1(vecs1)
+    if precision_of(vecs0) == 'float32':
+        make_norm1(vecs0)
+    if precision_of(vecs1) == 'float32':
+        make_norm1(vecs1)
+    if precision is not None:
+        vecs0 = quantize(vecs0, precision)
+        vecs1 = quantize(vecs1, precision)
 
     # save off runtime stats for summary
     runtimes = OrderedDict()
@@ -579,11 +702,12 @@ def vecalign(vecs0,
     # Compute deletion penalty for all depths
     t0 = time()
     for depth in stack:
-        stack[depth]['del_knob'] = make_del_knob(e_laser=stack[depth]['v0'][0, :, :],
-                                                 f_laser=stack[depth]['v1'][0, :, :],
+        stack[depth]['del_knob'] = make_del_knob(e_laser=to_float32(stack[depth]['v0'][0, :, :]),
+                                                 f_laser=to_float32(stack[depth]['v1'][0, :, :]),
                                                  e_laser_norms=stack[depth]['n0'][0, :],
                                                  f_laser_norms=stack[depth]['n1'][0, :],
-                                                 sample_size=costs_sample_size)
+                                                 sample_size=costs_sample_size,
+                                                 num_threads=num_threads)
         stack[depth]['del_penalty'] = stack[depth]['del_knob'].percentile_frac_to_del_penalty(del_percentile_frac)
         logger.debug('del_penalty at depth %d: %f', depth, stack[depth]['del_penalty'])
     runtimes['Compute deletion penalties'] = time() - t0
@@ -593,8 +717,8 @@ def vecalign(vecs0,
                  tt / (stack[max_depth]['size0'] + 1e-6) / (stack[max_depth]['size1'] + 1e-6))
     # full DP at maximum recursion depth
     t0 = time()
-    stack[max_depth]['costs_1to1'] = make_dense_costs(stack[max_depth]['v0'],
-                                                      stack[max_depth]['v1'],
+    stack[max_depth]['costs_1to1'] = make_dense_costs(to_float32(stack[max_depth]['v0']),
+                                                      to_float32(stack[max_depth]['v1']),
                                                       stack[max_depth]['n0'],
                                                       stack[max_depth]['n1'])
 
@@ -625,7 +749,8 @@ def vecalign(vecs0,
                                                                                 stack[depth]['n0'], stack[depth]['n1'],
                                                                                 stack[depth]['searchpath'],
                                                                                 stack[depth]['alignment_types'],
-                                                                                width_over2)
+                                                                                width_over2,
+                                                                                num_threads=num_threads)
 
         tt = time() - t0
         num_dot_products = len(stack[depth]['b_offset']) * len(stack[depth]['alignment_types']) * width_over2 * 2
@@ -640,7 +765,8 @@ def vecalign(vecs0,
         stack[depth]['a_b_csum'], stack[depth]['a_b_xp'], stack[depth]['a_b_yp'], \
         stack[depth]['new_b_offset'] = sparse_dp(stack[depth]['a_b_costs'], stack[depth]['b_offset'],
                                                  stack[depth]['alignment_types'], stack[depth]['del_penalty'],
-                                                 stack[depth]['size0'], stack[depth]['size1'])
+                                                 stack[depth]['size0'], stack[depth]['size1'],
+                                                 num_threads=num_threads)
 
         # performace traceback to get alignments and alignment scores
         # for debugging, avoid overwriting stack[depth]['alignments']
@@ -664,5 +790,7 @@ def vecalign(vecs0,
     for key in runtimes:
         if runtimes[key] > 5e-5:
             logger.info(key + ' took ' + '.' * (max_key_str_len + 5 - len(key)) + ('%.4fs' % runtimes[key]).rjust(7))
+    # and keep them for callers that report them, like bench.py
+    stack[0]['runtimes'] = runtimes
 
     return stack
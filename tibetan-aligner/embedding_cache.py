@@ -0,0 +1,117 @@
+"""
+Content-addressed on-disk cache of sentence embeddings.
+
+Vectors are keyed by model, max_seq_length and a hash of the normalized
+overlay text, so re-aligning a revised edition of a text only encodes the
+sentences that changed. The cache is a single sqlite file in EMBEDDING_CACHE_DIR
+(default ./cache/embeddings, next to the download cache); once it grows past
+max_bytes the least recently used vectors are evicted.
+"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+import unicodedata
+from pathlib import Path
+from time import time
+
+import numpy as np
+
+EMBEDDING_CACHE_DIR = os.getenv("EMBEDDING_CACHE_DIR", "./cache/embeddings")
+EMBEDDING_CACHE_MAX_BYTES = int(os.getenv("EMBEDDING_CACHE_MAX_BYTES", 2 * 1024 ** 3))
+
+# sqlite limits the number of host parameters in one statement
+_QUERY_CHUNK_SIZE = 500
+
+
+def normalize_text(text):
+    return ' '.join(unicodedata.normalize('NFC', text).split())
+
+
+class EmbeddingCache(object):
+    def __init__(self, cache_dir, model_path, max_seq_length, max_bytes=EMBEDDING_CACHE_MAX_BYTES):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.model_path = model_path
+        self.max_seq_length = max_seq_length
+        self.max_bytes = max_bytes
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.cache_dir / 'embeddings.sqlite'),
+                                     timeout=60, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS embeddings ('
+                           'key BLOB PRIMARY KEY, vec BLOB NOT NULL, nbytes INTEGER NOT NULL, last_access REAL NOT NULL)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS embeddings_last_access ON embeddings (last_access)')
+        self._conn.commit()
+
+    def key(self, text):
+        prefix = '%s\0%d\0' % (self.model_path, self.max_seq_length)
+        return hashlib.sha256((prefix + normalize_text(text)).encode('utf-8')).digest()
+
+    def get_many(self, texts):
+        """
+        Returns a list with the cached float32 vector for each text, or None where it is not cached
+        """
+        keys = [self.key(text) for text in texts]
+        found = dict()
+        now = time()
+        with self._lock:
+            for start in range(0, len(keys), _QUERY_CHUNK_SIZE):
+                chunk = list(set(keys[start:start + _QUERY_CHUNK_SIZE]))
+                marks = ','.join('?' * len(chunk))
+                rows = self._conn.execute('SELECT key, vec FROM embeddings WHERE key IN (%s)' % marks, chunk)
+                for key, vec in rows:
+                    found[key] = np.frombuffer(vec, dtype=np.float32)
+                self._conn.execute('UPDATE embeddings SET last_access = ? WHERE key IN (%s)' % marks, [now] + chunk)
+            self._conn.commit()
+        return [found.get(key) for key in keys]
+
+    def put_many(self, texts, vectors):
+        now = time()
+        rows = []
+        for text, vec in zip(texts, vectors):
+            vec = np.ascontiguousarray(vec, dtype=np.float32).tobytes()
+            rows.append((self.key(text), vec, len(vec), now))
+        with self._lock:
+            self._conn.executemany('INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)', rows)
+            self._conn.commit()
+            self._evict()
+
+    def size_bytes(self):
+        return self._conn.execute('SELECT COALESCE(SUM(nbytes), 0) FROM embeddings').fetchone()[0]
+
+    def _evict(self):
+        excess = self.size_bytes() - self.max_bytes
+        if excess <= 0:
+            return
+        # drop least recently used vectors until we are back under the limit
+        freed = 0
+        stale = []
+        cursor = self._conn.execute('SELECT key, nbytes FROM embeddings ORDER BY last_access')
+        for key, nbytes in cursor:
+            stale.append((key,))
+            freed += nbytes
+            if freed >= excess:
+                break
+        cursor.close()
+        self._conn.executemany('DELETE FROM embeddings WHERE key = ?', stale)
+        self._conn.commit()
+
+
+_caches = dict()
+_caches_lock = threading.Lock()
+
+
+def get_embedding_cache(model_path, max_seq_length, cache_dir=EMBEDDING_CACHE_DIR):
+    """
+    Shared cache for model_path/max_seq_length, or None if caching is disabled by setting EMBEDDING_CACHE_DIR to ''
+    """
+    if not cache_dir:
+        return None
+    with _caches_lock:
+        key = (str(cache_dir), model_path, max_seq_length)
+        if key not in _caches:
+            _caches[key] = EmbeddingCache(cache_dir, model_path, max_seq_length)
+        return _caches[key]
@@ -0,0 +1,180 @@
+"""
+On-disk embedding store written by get_vectors.py and read by vecalign.py.
+
+A store is a directory holding the vectors as one .npy matrix (float32 or
+float16), which is memory-mapped when opened, and an index from a 64 bit hash
+of each overlay text to its row, kept as two sorted arrays. Looking up a
+document's overlays is one vectorized searchsorted, and only the rows that are
+actually used are ever read from disk.
+
+get_vectors.py also records in the store which overlap depths it holds and a
+hash of the text it was made from, so that a later run on the same text with
+more overlays only has to encode the missing depths (see extend). Stores are
+always written next to their path and then renamed into place, so several
+processes can share them.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+from pathlib import Path
+
+import numpy as np
+
+STORE_VERSION = 1
+
+
+def hash_texts(texts):
+    """64 bit blake2b hash of each text, as a uint64 array"""
+    digests = b''.join(hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest() for text in texts)
+    return np.frombuffer(digests, dtype='<u8').copy()
+
+
+def _write(path, keys, rows, vectors, meta):
+    """Write a store for keys[ii] -> rows[ii], keeping the last row of every repeated key"""
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    # stable sort, then keep the last row of every run of equal keys
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+    last = np.append(sorted_keys[1:] != sorted_keys[:-1], True) if len(keys) else np.empty(0, dtype=bool)
+
+    np.save(path / 'vectors.npy', vectors)
+    np.save(path / 'keys.npy', sorted_keys[last])
+    np.save(path / 'rows.npy', rows[order][last].astype(np.int64))
+    (path / 'meta.json').write_text(json.dumps(dict(meta,
+                                                    version=STORE_VERSION,
+                                                    count=int(len(vectors)),
+                                                    dim=int(vectors.shape[1]) if vectors.ndim == 2 else 0,
+                                                    dtype=np.dtype(vectors.dtype).name)))
+
+
+def _swap_in(new_path, path):
+    """
+    Move the store written at new_path to path, replacing whatever store is there,
+       so that readers see either the old or the new store but never a half-written one
+    """
+    while True:
+        try:
+            # only succeeds if nothing (or an empty directory) is at path
+            os.replace(new_path, path)
+            return
+        except OSError:
+            if not path.is_dir():
+                raise
+        old_path = path.with_name('%s.%s.old' % (path.name, uuid.uuid4().hex))
+        try:
+            os.replace(path, old_path)
+        except FileNotFoundError:
+            continue  # another writer is swapping in its store right now
+        shutil.rmtree(old_path, ignore_errors=True)
+
+
+def _temp_path(path):
+    """A fresh path next to path, on the same file system so that it can be renamed into place"""
+    return path.with_name('%s.%s.tmp' % (path.name, uuid.uuid4().hex))
+
+
+class EmbeddingStore(object):
+    def __init__(self, path, vectors, keys, rows, meta=None):
+        self.path = Path(path)
+        self.vectors = vectors
+        self._keys = keys
+        self._rows = rows
+        self.meta = meta or dict()
+
+    @classmethod
+    def save(cls, path, texts, vectors, dtype=np.float32, **meta):
+        """
+        Write texts and their vectors (one row per text) to a new store at path.
+        Repeated texts keep the row of their last occurrence, like read_in_embeddings always did.
+        Any meta (e.g. depths=) is kept in meta.json. An existing store at path is replaced.
+        """
+        vectors = np.asarray(vectors)
+        if len(texts) != len(vectors):
+            raise Exception('got %d texts but %d vectors' % (len(texts), len(vectors)))
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        keys = hash_texts(texts)
+        new_path = _temp_path(path)
+        _write(new_path, keys, np.arange(len(keys), dtype=np.int64), vectors.astype(dtype, copy=False), meta)
+        _swap_in(new_path, path)
+        return cls.open(path)
+
+    def extend(self, texts, vectors, **meta):
+        """
+        Add texts and their vectors to this store, replacing it on disk with one that also holds them,
+           and return the new store; meta replaces the stored meta fields of the same name
+        """
+        vectors = np.asarray(vectors)
+        if len(texts) != len(vectors):
+            raise Exception('got %d texts but %d vectors' % (len(texts), len(vectors)))
+        dtype = self.vectors.dtype
+        keys = np.concatenate([self._keys, hash_texts(texts)])
+        # the new rows come last, so they win over existing rows of the same text
+        rows = np.concatenate([self._rows, len(self.vectors) + np.arange(len(texts), dtype=np.int64)])
+        all_vectors = np.concatenate([self.vectors, vectors.astype(dtype, copy=False)])
+        # write next to the store and swap it in, the old vectors are memory-mapped from the file being replaced
+        new_path = _temp_path(self.path)
+        _write(new_path, keys, rows, all_vectors, dict(self.meta, **meta))
+        del all_vectors
+        self.vectors = None
+        _swap_in(new_path, self.path)
+        return EmbeddingStore.open(self.path)
+
+    @classmethod
+    def open(cls, path, retries=5):
+        path = Path(path)
+        for attempt in range(retries + 1):
+            # the files are read one by one, so a store swapped in by another process meanwhile
+            #   shows up as a missing file or as files that do not belong together: read it again
+            try:
+                meta = json.loads((path / 'meta.json').read_text())
+                if meta['version'] != STORE_VERSION:
+                    raise Exception('unsupported embedding store version %s in %s' % (meta['version'], path))
+                store = cls(path,
+                            vectors=np.load(path / 'vectors.npy', mmap_mode='r'),
+                            keys=np.load(path / 'keys.npy'),
+                            rows=np.load(path / 'rows.npy'),
+                            meta=meta)
+                if len(store.vectors) == meta['count'] and len(store._keys) == len(store._rows) \
+                        and (not len(store._rows) or store._rows.max() < len(store.vectors)):
+                    return store
+                error = Exception('embedding store %s changed while it was read' % path)
+            except FileNotFoundError as e:
+                error = e
+            time.sleep(0.1 * (attempt + 1))
+        raise error
+
+    @staticmethod
+    def is_store(path):
+        return (Path(path) / 'meta.json').is_file()
+
+    def __len__(self):
+        return len(self.vectors)
+
+    @property
+    def dim(self):
+        return self.vectors.shape[1]
+
+    @property
+    def depths(self):
+        """Overlap depths (1 = single lines) the store holds overlays for, if get_vectors.py recorded them"""
+        return self.meta.get('depths')
+
+    def lookup(self, texts):
+        """Row of each text, or -1 where the text is not in the store"""
+        hashes = hash_texts(texts)
+        if not len(self._keys):
+            return np.full(len(hashes), -1, dtype=np.int64)
+        pos = np.searchsorted(self._keys, hashes)
+        pos[pos == len(self._keys)] = 0
+        return np.where(self._keys[pos] == hashes, self._rows[pos], -1)
+
+    def get(self, text, default=None):
+        """dict-style lookup of one text, for callers that treat the store like sent2line"""
+        row = self.lookup([text])[0]
+        return default if row < 0 else int(row)
@@ -1,35 +1,134 @@
+import hashlib
+import logging
+import os
 import sys
 
-from sentence_transformers import SentenceTransformer
 import numpy as np
 
-filename = sys.argv[1]
-number_of_overlays = int(sys.argv[2]) + 1 # +1 because we want to include the original sentence
+from embedding_cache import get_embedding_cache
+from embedding_store import EmbeddingStore
+from model_registry import MODEL_PATH, get_model
 
-def process_file(filename):
-    model_path = "buddhist-nlp/bod-eng-similarity"
-    model = SentenceTransformer(model_path)
+ENCODE_BATCH_SIZE = int(os.getenv("ENCODE_BATCH_SIZE", 32))
+ENCODE_BUCKET_WIDTH = int(os.getenv("ENCODE_BUCKET_WIDTH", 16))  # in tokens
+EMBEDDING_STORE_DTYPE = os.getenv("EMBEDDING_STORE_DTYPE", "float32")  # or float16, to halve the store
 
-    model.max_seq_length = 500
+logger = logging.getLogger('vecalign')
+
+
+def token_lengths(model, sentences):
+    """
+    Number of tokens the model will actually see for each sentence (after truncation)
+    """
+    input_ids = model.tokenizer(sentences, add_special_tokens=True, truncation=True,
+                                max_length=model.max_seq_length)['input_ids']
+    return np.array([len(ids) for ids in input_ids], dtype=np.int64)
+
+
+def encode_bucketed(model, sentences, batch_size=ENCODE_BATCH_SIZE, bucket_width=ENCODE_BUCKET_WIDTH):
+    """
+    Encode sentences grouped into buckets of similar token length, so that a batch is
+       never padded by more than bucket_width tokens, and return the vectors in input order
+    """
+    if not sentences:
+        return np.empty((0, model.get_sentence_embedding_dimension()), dtype=np.float32)
+
+    lengths = token_lengths(model, sentences)
+    order = np.argsort(lengths, kind='stable')
+    buckets = lengths[order] // max(bucket_width, 1)
+    # start of each run of equal bucket ids in the sorted order
+    starts = np.flatnonzero(np.diff(buckets, prepend=-1))
+    ends = np.append(starts[1:], len(order))
+
+    vectors = np.empty((len(sentences), model.get_sentence_embedding_dimension()), dtype=np.float32)
+    for start, end in zip(starts, ends):
+        idxs = order[start:end]
+        vectors[idxs] = model.encode([sentences[ii] for ii in idxs],
+                                     batch_size=batch_size, show_progress_bar=False)
+    return vectors
+
+
+def encode_overlays(model, sentences_overlay, cache=None,
+                    batch_size=ENCODE_BATCH_SIZE, bucket_width=ENCODE_BUCKET_WIDTH):
+    """
+    Encode every distinct overlay once, taking whatever is already there from cache
+       (an embedding_cache.EmbeddingCache), and return one vector per input overlay
+    """
+    unique_overlays = list(dict.fromkeys(sentences_overlay))
+    if cache is not None:
+        unique_vectors = cache.get_many(unique_overlays)
+    else:
+        unique_vectors = [None] * len(unique_overlays)
+
+    missing = [ii for ii, vec in enumerate(unique_vectors) if vec is None]
+    if missing:
+        new_overlays = [unique_overlays[ii] for ii in missing]
+        new_vectors = encode_bucketed(model, new_overlays, batch_size=batch_size, bucket_width=bucket_width)
+        for ii, vec in zip(missing, new_vectors):
+            unique_vectors[ii] = vec
+        if cache is not None:
+            cache.put_many(new_overlays, new_vectors)
+
+    if not unique_vectors:
+        return np.empty((0, model.get_sentence_embedding_dimension()), dtype=np.float32)
+
+    unique_vectors = np.stack(unique_vectors)
+    overlay2row = {overlay: ii for ii, overlay in enumerate(unique_overlays)}
+    return unique_vectors[[overlay2row[overlay] for overlay in sentences_overlay]]
+
+
+def _overlays(sentences, depths):
+    """The overlays of sentences of each of depths (1 = single sentences)"""
+    for x in range(len(sentences)):
+        for i in depths:
+            if x + i <= len(sentences):
+                yield ' '.join(sentences[x:x+i])
+
+
+def process_file(filename, number_of_overlays, store_path=None):
+    """
+    Embed the overlays of filename of depth 1 up to number_of_overlays - 1 into an embedding store,
+       by default filename + "_store".
+    If the store already holds some of these depths for the same text, only the missing ones are encoded.
+    """
     file = open(filename,'r')
 
     sentences = [line.rstrip('\n').strip() for line in file]
-    sentences_overlay = []
+    store_path = store_path or filename + "_store"
+    depths = list(range(1, number_of_overlays))
+    # of the file as it is on disk, like sha256sum, which align_tib_en.sh names shared stores by
+    with open(filename, 'rb') as fin:
+        source_sha256 = hashlib.sha256(fin.read()).hexdigest()
 
-    for x in range(len(sentences)):
-        val = number_of_overlays
-        if (len(sentences) - x) < val:
-            val = (len(sentences) - x) + 1
-        for i in range(1,val):
-            sentences_overlay.append(' '.join(sentences[x:x+i]))
-    overlay_string = "\n".join(sentences_overlay)
-    vectors = np.array(model.encode(sentences_overlay,show_progress_bar=False))
+    store = None
+    if EmbeddingStore.is_store(store_path):
+        store = EmbeddingStore.open(store_path)
+        # made from another text (or before depths were recorded), start over
+        if store.meta.get('source_sha256') != source_sha256 or store.depths is None:
+            store = None
+    stored_depths = set(store.depths) if store is not None else set()
+    missing_depths = [depth for depth in depths if depth not in stored_depths]
+    if not missing_depths:
+        logger.debug('reusing store %s with depths %s', store_path, store.depths)
+        return
+
+    model = get_model()
+    sentences_overlay = list(_overlays(sentences, missing_depths))
+    cache = get_embedding_cache(MODEL_PATH, model.max_seq_length)
+    vectors = encode_overlays(model, sentences_overlay, cache=cache)
     print("LEN SENTENCES",len(sentences_overlay))
     print("LEN VECTORS",len(vectors))
-    with open(sys.argv[1] + "_overlay", "w") as text_file:
-        text_file.write(overlay_string)
-
-    np.save(sys.argv[1] + "_vectors",vectors)
+    # keyed like read_in_embeddings keys the lines of an overlay file
+    texts = [overlay.strip() for overlay in sentences_overlay]
+    meta = dict(depths=sorted(stored_depths | set(missing_depths)), source_sha256=source_sha256)
+    if store is None:
+        EmbeddingStore.save(store_path, texts, vectors, dtype=EMBEDDING_STORE_DTYPE, **meta)
+    else:
+        store.extend(texts, vectors, **meta)
 
-process_file(filename)
 
+if __name__ == "__main__":
+    filename = sys.argv[1]
+    number_of_overlays = int(sys.argv[2]) + 1 # +1 because we want to include the original sentence
+    store_path = sys.argv[3] if len(sys.argv) > 3 else None
+    process_file(filename, number_of_overlays, store_path=store_path)
@@ -0,0 +1,82 @@
+"""
+Process-wide registry of SentenceTransformer models.
+
+Each model is loaded once (on the first get_model call, or eagerly with
+preload_model when the server starts) and the same instance then serves the
+Tibetan and English encodes of every alignment job.
+"""
+
+import logging
+import resource
+import threading
+from time import time
+
+MODEL_PATH = "buddhist-nlp/bod-eng-similarity"
+MAX_SEQ_LENGTH = 500
+
+logger = logging.getLogger('vecalign')
+
+_models = dict()
+_metrics = dict()
+_lock = threading.Lock()
+
+
+def _max_rss_bytes():
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _parameter_bytes(model):
+    params = sum(p.numel() * p.element_size() for p in model.parameters())
+    buffers = sum(b.numel() * b.element_size() for b in model.buffers())
+    return params + buffers
+
+
+def load_model(model_path=MODEL_PATH):
+    # imported here so that the constants above can be used without loading torch
+    from sentence_transformers import SentenceTransformer
+
+    model = SentenceTransformer(model_path)
+    model.max_seq_length = MAX_SEQ_LENGTH
+    return model
+
+
+def get_model(model_path=MODEL_PATH):
+    """
+    Return the shared model for model_path, loading it on first use
+    """
+    model = _models.get(model_path)
+    if model is not None:
+        return model
+
+    with _lock:
+        if model_path not in _models:
+            rss_before = _max_rss_bytes()
+            t0 = time()
+            model = load_model(model_path)
+            load_time = time() - t0
+            _metrics[model_path] = dict(model_path=model_path,
+                                        load_time_s=load_time,
+                                        parameter_bytes=_parameter_bytes(model),
+                                        max_rss_increase_bytes=_max_rss_bytes() - rss_before,
+                                        max_seq_length=model.max_seq_length)
+            _models[model_path] = model
+            logger.info('Loaded model %s in %.2fs', model_path, load_time)
+        return _models[model_path]
+
+
+def preload_model(model_path=MODEL_PATH):
+    """
+    Load the model ahead of the first request and run one encode to warm it up
+    """
+    model = get_model(model_path)
+    model.encode(['BLANK_LINE'], show_progress_bar=False)
+    return model
+
+
+def model_metrics():
+    """
+    Load time and memory footprint of every loaded model, plus the process high-water mark
+    """
+    return dict(models=[dict(m) for m in _metrics.values()],
+                process_max_rss_bytes=_max_rss_bytes())
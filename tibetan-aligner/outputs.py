@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+
+"""
+Alignment output files, written in a single streaming pass.
+
+From the alignments and scores of dp_utils.vecalign this writes, next to an
+output prefix:
+
+  .org            the same as ladder2org.py
+  .train          the same as create_train.py
+  .train_cleaned  the same as create_train_clean.py
+  .train_cleaned-bo.txt / -en.txt
+                  the Tibetan and English halves of .train_cleaned, one segment
+                  per line, i.e. the TM files tm.convert_raw_align_to_tm would
+                  otherwise build by parsing .train_cleaned again
+  .npz            the alignments and scores themselves, as an alignment_table
+
+Every line is written as soon as its alignment is reached, so the time is
+linear in the size of the documents and nothing but the input lines is held in
+memory. It can also be run on the output of vecalign.py, which align_tib_en.sh does:
+
+    python outputs.py bo.txt en.txt alignments.npz output/bo.txt
+"""
+
+import argparse
+from ast import literal_eval
+from contextlib import ExitStack
+from pathlib import Path
+
+from alignment_table import AlignmentTable
+
+# suffixes of the TM halves, added to the name of the .train_cleaned file; tm.py uses the same names
+TM_BO_SUFFIX = "-bo.txt"
+TM_EN_SUFFIX = "-en.txt"
+
+
+def _tm_segments(row):
+    """bo/en segments of a .train_cleaned row, split like tm.convert_raw_align_to_tm does"""
+    for seg_pair in row.splitlines():
+        if not seg_pair:
+            continue
+        if "\t" in seg_pair:
+            yield seg_pair.split("\t", 1)
+        else:
+            yield seg_pair, "\n"
+
+
+def write_outputs(bo_lines, en_lines, alignments, scores, output_prefix):
+    """
+    Write the .org, .train and .train_cleaned files, the TM halves and the alignment table
+       next to output_prefix and return the path of the .train_cleaned file
+    """
+    bo_lines = [line.rstrip('\n').strip() for line in bo_lines]
+    en_lines = [line.rstrip('\n').strip() for line in en_lines]
+    output_prefix = str(output_prefix)
+    train_cleaned_fn = Path(output_prefix + ".train_cleaned")
+
+    with ExitStack() as stack:
+        org, train, train_cleaned, tm_bo, tm_en = (
+            stack.enter_context(open(fn, "w", encoding="utf-8"))
+            for fn in (output_prefix + ".org",
+                       output_prefix + ".train",
+                       train_cleaned_fn,
+                       str(train_cleaned_fn) + TM_BO_SUFFIX,
+                       str(train_cleaned_fn) + TM_EN_SUFFIX))
+
+        # where the last .org/.train segment ended
+        org_bo, org_en = 0, 0
+        train_bo, train_en = 0, 0
+        for (x, y), score in zip(alignments, scores):
+            # insertions/deletions are not in the ladder the old scripts parsed
+            if not (len(x) and len(y)):
+                continue
+            bo_num, en_num = x[0], y[0]
+            # the ladder file holds scores with 6 decimals
+            if round(float(score), 6) > 0.0:
+                org.write(' +$+ '.join(bo_lines[org_bo:bo_num]) + "\n")
+                org.write("# " + ' +!+ '.join(en_lines[org_en:en_num]) + "\n")
+                org_bo, org_en = bo_num, en_num
+
+            train.write(' '.join(bo_lines[train_bo:bo_num]) + "\t")
+            train.write(' '.join(en_lines[train_en:en_num]) + "\n")
+            train_bo, train_en = bo_num, en_num
+
+            row = "".join(bo_lines[num] + " " for num in x) + "\t" + "".join(en_lines[num] + " " for num in y) + "\n"
+            train_cleaned.write(row)
+            for bo_seg, en_seg in _tm_segments(row):
+                tm_bo.write(bo_seg + "\n")
+                tm_en.write(en_seg + "\n")
+
+        # whatever follows the last segment, without the last line (as the old scripts did)
+        org.write(' / '.join(bo_lines[org_bo:-1]) + "\n")
+        org.write("# " + ' / '.join(en_lines[org_en:-1]) + "\n")
+        train.write(' '.join(bo_lines[train_bo:-1]) + "\t")
+        train.write(' '.join(en_lines[train_en:-1]) + "\n")
+        # create_train.py and create_train_clean.py printed their output, adding a newline
+        train.write("\n")
+        train_cleaned.write("\n")
+
+    AlignmentTable.from_alignments(alignments, scores).save(output_prefix + ".npz")
+    return train_cleaned_fn
+
+
+def read_ladder(fn):
+    """
+    alignments and scores from a vecalign output file: an alignment_table .npz file
+       or text with 'src ids:tgt ids:score' lines
+    """
+    if AlignmentTable.is_table(fn):
+        table = AlignmentTable.load(fn)
+        return table.alignments(), table.scores.tolist()
+
+    alignments, scores = [], []
+    with open(fn, 'rt', encoding='utf-8') as fin:
+        for line in fin:
+            fields = line.split(':')
+            if len(fields) != 3:
+                continue
+            alignments.append((literal_eval(fields[0].strip()), literal_eval(fields[1].strip())))
+            scores.append(float(fields[2]))
+    return alignments, scores
+
+
+def main():
+    parser = argparse.ArgumentParser('Write the .org, .train and .train_cleaned files for a vecalign ladder',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('bo', help='Tibetan text, one sentence per line')
+    parser.add_argument('en', help='English text, one sentence per line')
+    parser.add_argument('ladder', help='vecalign output for the two texts, as text or an alignment table (.npz)')
+    parser.add_argument('output_prefix', help='Output files are named <output_prefix>.org etc.')
+    args = parser.parse_args()
+
+    with open(args.bo, 'r', encoding='utf-8') as fin:
+        bo_lines = fin.readlines()
+    with open(args.en, 'r', encoding='utf-8') as fin:
+        en_lines = fin.readlines()
+    alignments, scores = read_ladder(args.ladder)
+    print(write_outputs(bo_lines, en_lines, alignments, scores, args.output_prefix))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+
+"""
+Optional projection of sentence embeddings to fewer dimensions before the DP.
+
+Every cost in dp_core is a dot product over the full embedding size, so
+projecting e.g. 768 -> 192 dimensions makes the cost kernels about 4x cheaper
+at every pyramid level. Two methods:
+
+  random  a fixed Gaussian random projection, needs no fitting
+  pca     the top principal directions of the model's embeddings (uncentered,
+          so dot products are preserved as well as possible), fitted once per
+          model with this script and saved under PROJECTION_DIR
+
+Fit and save a PCA projection, and print how well it preserves cosine similarity:
+
+    python projection.py --fit pca --dim 192 --texts bo.txt en.txt
+"""
+
+import argparse
+import logging
+import os
+from pathlib import Path
+
+import numpy as np
+
+from model_registry import MODEL_PATH
+
+logger = logging.getLogger('vecalign')
+
+PROJECTION_METHODS = ('pca', 'random')
+PROJECTION_DIR = os.getenv("PROJECTION_DIR", str(Path(__file__).parent / "projections"))
+PROJECTION_METHOD = os.getenv("PROJECTION_METHOD", "pca")
+PROJECTION_DIM = int(os.getenv("PROJECTION_DIM", 0))  # 0 = no projection
+
+_projections = dict()
+
+
+class Projection(object):
+    def __init__(self, matrix, method):
+        self.matrix = np.ascontiguousarray(matrix, dtype=np.float32)  # (dim, target dim)
+        self.method = method
+
+    @property
+    def dim(self):
+        return self.matrix.shape[1]
+
+    def apply(self, vecs):
+        """Project the last axis of vecs; the result is float32 and not normalized"""
+        vecs = np.asarray(vecs, dtype=np.float32)
+        return np.dot(vecs.reshape(-1, vecs.shape[-1]), self.matrix).reshape(vecs.shape[:-1] + (self.dim,))
+
+    def save(self, path):
+        np.savez(path, matrix=self.matrix, method=self.method)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['matrix'], str(data['method']))
+
+
+def fit_random(input_dim, dim, seed=42):
+    rng = np.random.RandomState(seed)
+    return Projection(rng.standard_normal((input_dim, dim)) / np.sqrt(dim), 'random')
+
+
+def fit_pca(samples, dim):
+    """Projection onto the top dim eigenvectors of the second moment of samples (n, input_dim)"""
+    samples = np.asarray(samples, dtype=np.float64)
+    if len(samples) < dim:
+        raise Exception('need at least %d samples to fit a %d dimensional PCA, got %d' % (dim, dim, len(samples)))
+    eigvals, eigvecs = np.linalg.eigh(samples.T @ samples)
+    top = np.argsort(eigvals)[::-1][:dim]
+    return Projection(eigvecs[:, top], 'pca')
+
+
+def projection_path(model_path, method, dim, projection_dir=PROJECTION_DIR):
+    return Path(projection_dir) / ('%s-%s-%d.npz' % (model_path.replace('/', '--'), method, dim))
+
+
+def get_projection(model_path=MODEL_PATH, method=PROJECTION_METHOD, dim=PROJECTION_DIM, input_dim=None,
+                   projection_dir=PROJECTION_DIR):
+    """
+    Shared projection for model_path, or None if dim is 0.
+    A pca projection must have been fitted with this script; a random one is made on first use
+       (input_dim, the embedding size, is needed for that).
+    """
+    if not dim:
+        return None
+    if method not in PROJECTION_METHODS:
+        raise Exception('unknown projection method %r, expected one of %s' % (method, ', '.join(PROJECTION_METHODS)))
+    key = (model_path, method, dim)
+    if key not in _projections:
+        path = projection_path(model_path, method, dim, projection_dir)
+        if path.is_file():
+            _projections[key] = Projection.load(path)
+        elif method == 'random':
+            if input_dim is None:
+                raise Exception('input_dim is needed to make a random projection')
+            _projections[key] = fit_random(input_dim, dim)
+        else:
+            raise Exception('no %s projection to %d dimensions fitted for %s at %s, '
+                            'fit one with "python projection.py --fit %s --dim %d --texts ..."'
+                            % (method, dim, model_path, path, method, dim))
+    return _projections[key]
+
+
+def cosine_fidelity(vecs, projection, num_pairs=20000, seed=0):
+    """
+    How well projection preserves the cosine similarity of random pairs of vecs (n, input_dim):
+       correlation and mean/max absolute error of the projected vs. original similarities
+    """
+    rng = np.random.RandomState(seed)
+    vecs = np.asarray(vecs, dtype=np.float32)
+    xx = rng.randint(len(vecs), size=num_pairs)
+    yy = rng.randint(len(vecs), size=num_pairs)
+
+    def cosines(v):
+        v = v / (np.linalg.norm(v, axis=1, keepdims=True) + 1e-5)
+        return np.einsum('ij,ij->i', v[xx], v[yy])
+
+    original = cosines(vecs)
+    projected = cosines(projection.apply(vecs))
+    error = np.abs(projected - original)
+    return dict(method=projection.method,
+                dim=projection.dim,
+                input_dim=vecs.shape[1],
+                correlation=float(np.corrcoef(original, projected)[0, 1]),
+                mean_abs_error=float(error.mean()),
+                max_abs_error=float(error.max()))
+
+
+def main():
+    from dp_utils import yield_overlaps
+    from get_vectors import encode_overlays
+    from model_registry import get_model
+
+    parser = argparse.ArgumentParser('Fit a projection of the model embeddings to fewer dimensions',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--fit', choices=PROJECTION_METHODS, required=True)
+    parser.add_argument('--dim', type=int, required=True, help='Target number of dimensions')
+    parser.add_argument('--texts', nargs='+', required=True,
+                        help='Text files (one sentence per line) whose overlays are embedded to fit and evaluate on')
+    parser.add_argument('--num_overlaps', type=int, default=4)
+    parser.add_argument('--model', default=MODEL_PATH)
+    parser.add_argument('--projection_dir', default=PROJECTION_DIR)
+    args = parser.parse_args()
+
+    model = get_model(args.model)
+    overlays = []
+    for fn in args.texts:
+        with open(fn, 'rt', encoding='utf-8') as fin:
+            overlays.extend(yield_overlaps(fin.readlines(), args.num_overlaps))
+    vecs = encode_overlays(model, list(dict.fromkeys(overlays)))
+
+    # fit on every other vector, report fidelity on the rest
+    if args.fit == 'pca':
+        projection = fit_pca(vecs[::2], args.dim)
+    else:
+        projection = fit_random(vecs.shape[1], args.dim)
+    print(cosine_fidelity(vecs[1::2], projection))
+
+    path = projection_path(args.model, args.fit, args.dim, args.projection_dir)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    projection.save(path)
+    print('saved', path)
+
+
+if __name__ == '__main__':
+    main()
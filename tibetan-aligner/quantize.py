@@ -0,0 +1,87 @@
+"""
+Reduced-precision storage for document embeddings.
+
+vecalign keeps (num_overlaps, num_lines, dim) float32 tensors for both
+documents at every pyramid level. With precision='float16' they are stored as
+float16 (half the memory), with 'int8' as int8 codes with one float32 scale
+per vector (about a quarter). The cost kernels only ever read blocks of
+vectors, which to_float32 expands, so every dot product is still computed in
+float32 by BLAS.
+
+Vectors must already have norm 1 when they are quantized.
+"""
+
+import os
+
+import numpy as np
+
+PRECISIONS = ('float32', 'float16', 'int8')
+EMBEDDING_PRECISION = os.getenv('EMBEDDING_PRECISION', 'float32')
+
+
+class Int8Vectors(object):
+    """
+    int8 codes with a per-vector scale, indexable like the float32 array they stand for
+       (indexing returns float32)
+    """
+
+    def __init__(self, codes, scales):
+        self.codes = codes  # (..., dim) int8
+        self.scales = scales  # (..., 1) float32
+
+    @classmethod
+    def from_float(cls, vecs):
+        vecs = np.asarray(vecs, dtype=np.float32)
+        scales = np.abs(vecs).max(axis=-1, keepdims=True) / 127.0
+        scales[scales == 0] = 1.0
+        codes = np.rint(vecs / scales).astype(np.int8)
+        return cls(codes, scales.astype(np.float32))
+
+    @property
+    def shape(self):
+        return self.codes.shape
+
+    @property
+    def dtype(self):
+        return self.codes.dtype
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + self.scales.nbytes
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        # the scales have a length 1 last axis, so they take every index except the one for dim
+        if len(key) == self.codes.ndim:
+            scale_key = key[:-1] + (slice(None),)
+        else:
+            scale_key = key
+        return self.codes[key].astype(np.float32) * self.scales[scale_key]
+
+
+def precision_of(vecs):
+    if isinstance(vecs, Int8Vectors):
+        return 'int8'
+    return np.dtype(vecs.dtype).name
+
+
+def quantize(vecs, precision):
+    """vecs (float32, norm 1) stored at precision, one of PRECISIONS"""
+    if precision not in PRECISIONS:
+        raise Exception('unknown precision %r, expected one of %s' % (precision, ', '.join(PRECISIONS)))
+    if precision == precision_of(vecs):
+        return vecs
+    if precision == 'int8':
+        return Int8Vectors.from_float(vecs)
+    return np.asarray(to_float32(vecs), dtype=precision)
+
+
+def to_float32(vecs):
+    """float32 array for a (block of) vectors at any precision; no copy if it already is one"""
+    if isinstance(vecs, Int8Vectors):
+        return vecs[...]
+    return np.asarray(vecs, dtype=np.float32)
@@ -23,12 +23,16 @@ from collections import defaultdict
 
 import numpy as np
 
+from alignment_table import AlignmentTable
 from dp_utils import read_alignments
 
 """
 Faster implementation of lax and strict precision and recall, based on
    https://www.aclweb.org/anthology/W11-4624/.
 
+Alignments are scored as integer span arrays (see _Spans) with array operations;
+   _precision is the original set based version, still used for alignments that
+   have a side which is not a run of consecutive sentence ids.
 """
 
 
@@ -79,17 +83,158 @@ def _precision(goldalign, testalign):
     return np.array([tpstrict, fpstrict, tplax, fplax], dtype=np.int32)
 
 
-def score_multiple(gold_list, test_list, value_for_div_by_0=0.0):
-    # accumulate counts for all gold/test files
-    pcounts = np.array([0, 0, 0, 0], dtype=np.int32)
-    rcounts = np.array([0, 0, 0, 0], dtype=np.int32)
-    for goldalign, testalign in zip(gold_list, test_list):
-        pcounts += _precision(goldalign=goldalign, testalign=testalign)
+# bits per field of the packed uint64 key of a bead: start and length of both sides
+_START_BITS = 27
+_LENGTH_BITS = 5
+
+
+class _Spans(object):
+    """
+    An alignment as integer spans: one row (src start, src end, tgt start, tgt end) per distinct bead.
+    Beads empty on both sides are dropped, and empty sides are stored as (0, 0) so that they compare equal.
+    """
+
+    def __init__(self, rows):
+        starts = rows[:, [0, 2]]
+        lengths = rows[:, [1, 3]] - starts
+        # beads of real documents fit in one uint64, anything else is compared row by row
+        self.packed = not len(rows) or (starts.max() < 2 ** _START_BITS and lengths.max() < 2 ** _LENGTH_BITS)
+        if self.packed:
+            keys = ((starts[:, 0].astype(np.uint64) << np.uint64(_START_BITS + 2 * _LENGTH_BITS))
+                    | (lengths[:, 0].astype(np.uint64) << np.uint64(_START_BITS + _LENGTH_BITS))
+                    | (starts[:, 1].astype(np.uint64) << np.uint64(_LENGTH_BITS))
+                    | lengths[:, 1].astype(np.uint64))
+            self.keys, first = np.unique(keys, return_index=True)
+            self.rows = rows[first]
+        else:
+            self.rows = np.unique(rows, axis=0)
+            self.keys = None
+        self._lax_index = None
+
+    @classmethod
+    def from_table(cls, table, no_del=False):
+        """_Spans for an AlignmentTable; no_del drops insertions/deletions as well"""
+        rows = np.stack([table.src_start, table.src_end, table.tgt_start, table.tgt_end], axis=1).astype(np.int64)
+        src_empty = rows[:, 0] == rows[:, 1]
+        tgt_empty = rows[:, 2] == rows[:, 3]
+        rows[src_empty, :2] = 0
+        rows[tgt_empty, 2:] = 0
+        keep = ~(src_empty | tgt_empty) if no_del else ~(src_empty & tgt_empty)
+        return cls(rows[keep])
+
+    def __len__(self):
+        return len(self.rows)
+
+    def row_keys(self):
+        """one 32 byte key per row, for comparing with beads that do not fit a packed key"""
+        return np.ascontiguousarray(self.rows).view('V32').ravel()
+
+    def lax_index(self):
+        """
+        For every source id of a bead with both sides: (source ids, tgt starts, tgt ends), sorted by source id,
+           i.e. the src_id_to_gold_tgt_ids mapping of _precision as arrays
+        """
+        if self._lax_index is None:
+            rows = self.rows[(self.rows[:, 1] > self.rows[:, 0]) & (self.rows[:, 3] > self.rows[:, 2])]
+            lengths = rows[:, 1] - rows[:, 0]
+            bead = np.repeat(np.arange(len(rows)), lengths)
+            src_ids = rows[bead, 0] + np.arange(len(bead)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+            order = np.argsort(src_ids, kind='stable')
+            bead = bead[order]
+            self._lax_index = src_ids[order], rows[bead, 2], rows[bead, 3]
+        return self._lax_index
+
+
+def _table(alignments):
+    """alignments as an AlignmentTable, or None if some side is not a run of consecutive ids"""
+    if isinstance(alignments, AlignmentTable):
+        return alignments
+    try:
+        return AlignmentTable.from_alignments(alignments)
+    except Exception:
+        return None
+
+
+def _span_precision(gold, test):
+    """_precision for _Spans: tpstrict, fpstrict, tplax, fplax"""
+    rows = test.rows
+    if gold.packed and test.packed:
+        strict = np.isin(test.keys, gold.keys, assume_unique=True)
+    else:
+        strict = np.isin(test.row_keys(), gold.row_keys(), assume_unique=True)
+    tpstrict = int(np.count_nonzero(strict))
+
+    # a test bead is a lax match if it shares a source and a target id with a gold bead
+    cand = np.flatnonzero(~strict & (rows[:, 1] > rows[:, 0]) & (rows[:, 3] > rows[:, 2]))
+    src_ids, tgt_start, tgt_end = gold.lax_index()
+    laxonly = 0
+    if len(cand) and len(src_ids):
+        lo = np.searchsorted(src_ids, rows[cand, 0])
+        hi = np.searchsorted(src_ids, rows[cand, 1])
+        counts = hi - lo
+        # every (candidate, gold entry for one of its source ids) pair
+        pair_cand = np.repeat(np.arange(len(cand)), counts)
+        pos = np.repeat(lo - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        pair_rows = rows[cand[pair_cand]]
+        hit = (tgt_start[pos] < pair_rows[:, 3]) & (tgt_end[pos] > pair_rows[:, 2])
+        laxonly = int(np.count_nonzero(np.bincount(pair_cand[hit], minlength=len(cand))))
+
+    fpstrict = len(rows) - tpstrict
+    return np.array([tpstrict, fpstrict, tpstrict + laxonly, fpstrict - laxonly], dtype=np.int64)
+
+
+def _counts(goldalign, testalign, gold=None):
+    """
+    precision and recall counts of testalign against goldalign, see score_multiple;
+       gold is (_Spans, _Spans without insertions/deletions) for goldalign, if already made
+    """
+    gold_table = _table(goldalign) if gold is None else None
+    test_table = _table(testalign)
+    if test_table is None or (gold is None and gold_table is None):
+        goldalign, testalign = (x.alignments() if isinstance(x, AlignmentTable) else x for x in (goldalign, testalign))
+        pcounts = _precision(goldalign=goldalign, testalign=testalign)
         # recall is precision with no insertion/deletion and swap args
         test_no_del = [(x, y) for x, y in testalign if len(x) and len(y)]
         gold_no_del = [(x, y) for x, y in goldalign if len(x) and len(y)]
-        rcounts += _precision(goldalign=test_no_del, testalign=gold_no_del)
+        rcounts = _precision(goldalign=test_no_del, testalign=gold_no_del)
+        return pcounts.astype(np.int64), rcounts.astype(np.int64)
+
+    if gold is None:
+        gold = _Spans.from_table(gold_table), _Spans.from_table(gold_table, no_del=True)
+    pcounts = _span_precision(gold=gold[0], test=_Spans.from_table(test_table))
+    rcounts = _span_precision(gold=_Spans.from_table(test_table, no_del=True), test=gold[1])
+    return pcounts, rcounts
+
 
+def score_multiple(gold_list, test_list, value_for_div_by_0=0.0):
+    """
+    Strict and lax precision, recall and F1 of the test alignments against the gold ones, over all pairs.
+    Alignments are lists of (src ids, tgt ids), or AlignmentTables.
+    """
+    # accumulate counts for all gold/test files
+    pcounts = np.array([0, 0, 0, 0], dtype=np.int64)
+    rcounts = np.array([0, 0, 0, 0], dtype=np.int64)
+    for goldalign, testalign in zip(gold_list, test_list):
+        p, r = _counts(goldalign, testalign)
+        pcounts += p
+        rcounts += r
+    return _scores(pcounts, rcounts, value_for_div_by_0)
+
+
+def score_many(goldalign, test_list, value_for_div_by_0=0.0):
+    """
+    score_multiple([goldalign], [testalign]) for every testalign in test_list, e.g. the runs of a parameter sweep;
+       the gold alignment is only encoded once
+    """
+    gold_table = _table(goldalign)
+    gold = None
+    if gold_table is not None:
+        gold = _Spans.from_table(gold_table), _Spans.from_table(gold_table, no_del=True)
+    return [_scores(*_counts(goldalign, testalign, gold), value_for_div_by_0=value_for_div_by_0)
+            for testalign in test_list]
+
+
+def _scores(pcounts, rcounts, value_for_div_by_0=0.0):
     # Compute results
     # pcounts: tpstrict,fnstrict,tplax,fnlax
     # rcounts: tpstrict,fpstrict,tplax,fplax
@@ -154,10 +299,16 @@ def main():
     parser.add_argument('-g', '--gold', type=str, nargs='+', required=True,
                         help='one or more gold alignment files')
 
+    parser.add_argument('-b', '--baseline', type=str, nargs='+',
+                        help='optional baseline alignment files for the same documents, e.g. aligned with full size '
+                             'embeddings, to report how much the test alignments (e.g. with a projection) differ')
+
     args = parser.parse_args()
 
     if len(args.test) != len(args.gold):
         raise Exception('number of gold/test files must be the same')
+    if args.baseline and len(args.baseline) != len(args.test):
+        raise Exception('number of baseline/test files must be the same')
 
     gold_list = [read_alignments(x) for x in args.gold]
     test_list = [read_alignments(x) for x in args.test]
@@ -165,6 +316,19 @@ def main():
     res = score_multiple(gold_list=gold_list, test_list=test_list)
     log_final_scores(res)
 
+    if args.baseline:
+        baseline_list = [read_alignments(x) for x in args.baseline]
+        baseline_res = score_multiple(gold_list=gold_list, test_list=baseline_list)
+        print('Baseline:', file=sys.stderr)
+        log_final_scores(baseline_res)
+        print('F1 change vs baseline: strict {:+.3f}, lax {:+.3f}'.format(res['f1_strict'] - baseline_res['f1_strict'],
+                                                                        res['f1_lax'] - baseline_res['f1_lax']),
+              file=sys.stderr)
+        # the baseline as gold: how often the test run makes the same decisions
+        fidelity = score_multiple(gold_list=baseline_list, test_list=test_list)
+        print('Agreement with baseline:', file=sys.stderr)
+        log_final_scores(fidelity)
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,36 @@
+"""
+Builds the dp_core Cython extension.
+
+    pip install ./tibetan-aligner                    # into site-packages
+    python setup.py build_ext --inplace              # next to dp_core.pyx, for running from this directory
+
+build_dp_core.py runs the in-place build if dp_core is not built yet; app.py calls it at startup.
+If dp_core is missing, dp_utils falls back to the (slower) pure-NumPy dp_core_np.
+"""
+
+import sys
+
+import numpy as np
+from Cython.Build import cythonize
+from setuptools import Extension, setup
+
+# OpenMP for the prange kernels in dp_core.pyx; Apple clang does not support -fopenmp
+openmp_args = [] if sys.platform == "darwin" else ["-fopenmp"]
+
+extensions = [
+    Extension(
+        "dp_core",
+        sources=["dp_core.pyx"],
+        include_dirs=[np.get_include()],
+        extra_compile_args=["-O3"] + openmp_args,
+        extra_link_args=openmp_args,
+    )
+]
+
+setup(
+    name="tibetan-aligner-dp-core",
+    version="0.1.0",
+    # dp_core imports quantize, so a site-packages install needs it as well
+    py_modules=["quantize"],
+    ext_modules=cythonize(extensions, compiler_directives={"language_level": "3"}),
+)
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+
+"""
+Parameter sweep: runtime vs. F1 of vecalign over a grid of settings.
+
+The text pair is embedded once, with as many overlays as the largest
+alignment_max_size in the grid; every configuration then uses the first
+alignment_max_size layers of that embedding. The DP runs for all
+configurations on a process pool, which reads the embeddings from a
+memory-mapped file, and the alignments are scored with score.score_many.
+Each configuration runs on --threads threads (1 by default, DP kernels and
+BLAS alike), so that --workers configurations at a time do not compete for
+the cores and the runtimes stay comparable; both are recorded in the results.
+
+    python sweep.py --src bo.txt --tgt en.txt --gold gold.txt
+    python sweep.py --synthetic 5000        # stub embeddings with a known gold, no model needed
+
+Without --gold, F1 is measured against the alignment with the settings of
+align_tib_en.sh. One JSON line is printed per configuration (and written to
+--output), followed by a table sorted by runtime in which the configurations
+that no other one beats on both runtime and F1 are marked with '*'.
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from itertools import product
+from math import ceil
+from pathlib import Path
+from time import time
+
+import numpy as np
+
+from aligner import DELETION, NUMBER_OF_OVERLAYS, SEARCH_BUFFER_SIZE, embed_document, threadpool_limits
+from alignment_table import AlignmentTable
+from bench import make_doc_vectors, make_gold, make_line_vectors
+from dp_utils import make_alignment_types, read_alignments, vecalign
+from score import score_many
+
+logger = logging.getLogger('vecalign')
+
+PARAMETERS = ('alignment_max_size', 'del_percentile_frac', 'search_buffer_size', 'max_size_full_dp')
+# align_tib_en.sh
+DEFAULT_CONFIG = dict(alignment_max_size=NUMBER_OF_OVERLAYS,
+                      del_percentile_frac=DELETION,
+                      search_buffer_size=SEARCH_BUFFER_SIZE,
+                      max_size_full_dp=300)
+
+# document embeddings of the worker processes, memory-mapped
+_docs = None
+
+
+def _init_worker(doc0_fn, doc1_fn, num_threads):
+    global _docs
+    _docs = np.load(doc0_fn, mmap_mode='r'), np.load(doc1_fn, mmap_mode='r')
+    # BLAS gets the same share of the cores as the DP kernels
+    if threadpool_limits is not None:
+        threadpool_limits(num_threads)
+
+
+def _run_config(config, num_threads):
+    """Align with one configuration; returns the alignments as an AlignmentTable, the runtime and its stages"""
+    np.random.seed(42)
+    alignment_max_size = config['alignment_max_size']
+    # vecalign normalizes its input in place, so copy the layers out of the shared file
+    vecs0 = np.array(_docs[0][:alignment_max_size])
+    vecs1 = np.array(_docs[1][:alignment_max_size])
+    t0 = time()
+    stack = vecalign(vecs0=vecs0,
+                     vecs1=vecs1,
+                     final_alignment_types=make_alignment_types(alignment_max_size),
+                     del_percentile_frac=config['del_percentile_frac'],
+                     width_over2=ceil(alignment_max_size / 2.0) + config['search_buffer_size'],
+                     max_size_full_dp=config['max_size_full_dp'],
+                     costs_sample_size=20000,
+                     num_samps_for_norm=100,
+                     num_threads=num_threads)
+    runtime = time() - t0
+    table = AlignmentTable.from_alignments(stack[0]['final_alignments'], stack[0]['alignment_scores'])
+    return table, runtime, dict(stack[0]['runtimes'])
+
+
+def embed_pair(args, num_overlaps):
+    """(num_overlaps, lines, dim) embeddings of both documents, and the gold alignment if there is one"""
+    if args.synthetic:
+        rng = np.random.default_rng(args.seed)
+        gold, size0, size1 = make_gold(args.synthetic, rng)
+        line0, line1 = make_line_vectors(gold, size0, size1, args.dim, 1.0, rng)
+        return make_doc_vectors(line0, num_overlaps, rng), make_doc_vectors(line1, num_overlaps, rng), gold
+
+    from model_registry import get_model
+
+    model = get_model()
+    docs = []
+    for fn in (args.src, args.tgt):
+        with open(fn, 'rt', encoding='utf-8') as fin:
+            docs.append(embed_document(model, fin.readlines(), num_overlaps))
+    gold = read_alignments(args.gold) if args.gold else None
+    return docs[0], docs[1], gold
+
+
+def pareto_front(results):
+    """indices of the results that no other result beats on both runtime and strict F1"""
+    front = set()
+    best_f1 = -1.0
+    for ii in sorted(range(len(results)), key=lambda ii: (results[ii]['runtime_s'], -results[ii]['f1_strict'])):
+        if results[ii]['f1_strict'] > best_f1:
+            front.add(ii)
+            best_f1 = results[ii]['f1_strict']
+    return front
+
+
+def main():
+    parser = argparse.ArgumentParser('Sweep vecalign settings and report runtime vs. F1',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--src', help='Source text, one sentence per line')
+    parser.add_argument('--tgt', help='Target text, one sentence per line')
+    parser.add_argument('--gold', help='Gold alignment of src and tgt (text or .npz); '
+                                       'without it, F1 is against the align_tib_en.sh settings')
+    parser.add_argument('--synthetic', type=int, help='Sweep on a synthetic pair with this many source lines instead')
+    parser.add_argument('--dim', type=int, default=768, help='Embedding size of the synthetic pair')
+    parser.add_argument('-a', '--alignment_max_size', type=int, nargs='+', default=[2, 4, 6])
+    parser.add_argument('-d', '--del_percentile_frac', type=float, nargs='+', default=[0.03, 0.06, 0.1])
+    parser.add_argument('--search_buffer_size', type=int, nargs='+', default=[5, 20, 50])
+    parser.add_argument('--max_size_full_dp', type=int, nargs='+', default=[300])
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='Configurations run at the same time; runtimes are measured under that load')
+    parser.add_argument('--threads', type=int, default=1,
+                        help='DP and BLAS threads of each configuration; workers * threads should not exceed the cores')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='Write the results here, one JSON line per configuration')
+    args = parser.parse_args()
+
+    if not args.synthetic and not (args.src and args.tgt):
+        parser.error('give --src and --tgt, or --synthetic')
+    args.workers = max(args.workers, 1)
+    args.threads = max(args.threads, 1)
+    if args.workers * args.threads > (os.cpu_count() or 1):
+        print('Warning: %d workers * %d threads is more than the %d cores, runtimes will include contention'
+              % (args.workers, args.threads, os.cpu_count() or 1), file=sys.stderr)
+
+    configs = [dict(zip(PARAMETERS, values)) for values in product(args.alignment_max_size,
+                                                                   args.del_percentile_frac,
+                                                                   args.search_buffer_size,
+                                                                   args.max_size_full_dp)]
+    for config in configs:
+        if config['alignment_max_size'] < 2:
+            raise Exception('alignment_max_size must be at least 2')
+
+    # without a gold alignment the default settings are run as the reference, which may need more overlays
+    num_overlaps = max(args.alignment_max_size + ([] if args.gold or args.synthetic else [NUMBER_OF_OVERLAYS]))
+    t0 = time()
+    doc0, doc1, gold = embed_pair(args, num_overlaps)
+    print('Embedded %d and %d lines in %.1fs' % (doc0.shape[1], doc1.shape[1], time() - t0), file=sys.stderr)
+    reference = 'gold'
+    if gold is None:
+        reference = 'default settings'
+        if DEFAULT_CONFIG not in configs:
+            configs.append(dict(DEFAULT_CONFIG))
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        doc_fns = [str(Path(tmpdir) / 'doc0.npy'), str(Path(tmpdir) / 'doc1.npy')]
+        np.save(doc_fns[0], doc0)
+        np.save(doc_fns[1], doc1)
+        del doc0, doc1
+        with ProcessPoolExecutor(max_workers=args.workers, mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=_init_worker, initargs=(*doc_fns, args.threads)) as executor:
+            runs = list(executor.map(_run_config, configs, [args.threads] * len(configs)))
+
+    tables = [table for table, _, _ in runs]
+    if gold is None:
+        gold = tables[configs.index(DEFAULT_CONFIG)]
+    scores = score_many(gold, tables)
+
+    results = []
+    for config, (_, runtime, stages), f1 in zip(configs, runs, scores):
+        results.append(dict(config,
+                            reference=reference,
+                            workers=args.workers,
+                            threads=args.threads,
+                            runtime_s=round(runtime, 4),
+                            stages_s={key: round(value, 4) for key, value in stages.items()},
+                            **f1))
+    for result in results:
+        print(json.dumps(result), flush=True)
+    if args.output:
+        with open(args.output, 'wt', encoding='utf-8') as fout:
+            for result in results:
+                print(json.dumps(result), file=fout)
+
+    front = pareto_front(results)
+    print('%3s %8s %8s %8s %8s %10s %9s %7s' % ('', 'max_size', 'deletion', 'buffer', 'full_dp', 'runtime_s',
+                                                'f1_strict', 'f1_lax'))
+    for ii in sorted(range(len(results)), key=lambda ii: results[ii]['runtime_s']):
+        result = results[ii]
+        print('%3s %8d %8g %8d %8d %10.3f %9.3f %7.3f' % ('*' if ii in front else '',
+                                                         result['alignment_max_size'],
+                                                         result['del_percentile_frac'],
+                                                         result['search_buffer_size'],
+                                                         result['max_size_full_dp'],
+                                                         result['runtime_s'],
+                                                         result['f1_strict'],
+                                                         result['f1_lax']))
+
+
+if __name__ == '__main__':
+    main()
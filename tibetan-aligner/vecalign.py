@@ -34,9 +34,34 @@ logger.addHandler(consoleHandler)
 from dp_utils import make_alignment_types, print_alignments, read_alignments, \
     read_in_embeddings, make_doc_embedding, vecalign
 
+from alignment_table import AlignmentTable
+from embedding_cache import EMBEDDING_CACHE_DIR, get_embedding_cache
+from embedding_store import EmbeddingStore
+from model_registry import MAX_SEQ_LENGTH, MODEL_PATH
 from score import score_multiple, log_final_scores
 
 
+def split_embed_args(embed, num_files, has_cache):
+    """
+    The embeddings of each of num_files files from --src_embed/--tgt_embed: one set shared by all files
+       (a store, or a text file and a binary embeddings file), or one per file (a store per file,
+       or a text file and a binary embeddings file per file)
+    """
+    if len(embed) > 1 and all(EmbeddingStore.is_store(fn) for fn in embed):
+        per_file = [[fn] for fn in embed]
+    elif len(embed) > 2 and len(embed) == 2 * num_files:
+        per_file = [embed[ii:ii + 2] for ii in range(0, len(embed), 2)]
+    elif len(embed) == 2 or (len(embed) == 1 and (has_cache or EmbeddingStore.is_store(embed[0]))):
+        return [embed] * num_files
+    else:
+        raise Exception('embeddings must be given as an embedding store directory, '
+                        'or a text file and a binary embeddings file (or an --embed_cache_dir), '
+                        'either once for all files or once per file')
+    if len(per_file) != num_files:
+        raise Exception('got embeddings for %d files but %d files to align' % (len(per_file), num_files))
+    return per_file
+
+
 def _main():
     # make runs consistent
     seed(42)
@@ -54,11 +79,20 @@ def _main():
     parser.add_argument('-g', '--gold_alignment', type=str, nargs='+', required=False,
                         help='preprocessed target file to align')
 
-    parser.add_argument('--src_embed', type=str, nargs=2, required=True,
-                        help='Source embeddings. Requires two arguments: first is a text file, sencond is a binary embeddings file. ')
+    parser.add_argument('--src_embed', type=str, nargs='+', required=True,
+                        help='Source embeddings: an embedding store directory written by get_vectors.py, or two arguments: '
+                             'first is a text file, sencond is a binary embeddings file. '
+                             'The binary embeddings file can be omitted if --embed_cache_dir is given. '
+                             'Either once for all source files, or once for each of them.')
 
-    parser.add_argument('--tgt_embed', type=str, nargs=2, required=True,
-                        help='Target embeddings. Requires two arguments: first is a text file, sencond is a binary embeddings file. ')
+    parser.add_argument('--tgt_embed', type=str, nargs='+', required=True,
+                        help='Target embeddings: an embedding store directory written by get_vectors.py, or two arguments: '
+                             'first is a text file, sencond is a binary embeddings file. '
+                             'The binary embeddings file can be omitted if --embed_cache_dir is given. '
+                             'Either once for all target files, or once for each of them.')
+
+    parser.add_argument('--embed_cache_dir', type=str, default=EMBEDDING_CACHE_DIR,
+                        help='Embedding cache written by get_vectors.py, used for overlaps missing from the embeddings files.')
 
     parser.add_argument('-a', '--alignment_max_size', type=int, default=4,
                         help='Searches for alignments up to size N-M, where N+M <= this value. Note that the the embeddings must support the requested number of overlaps')
@@ -81,6 +115,10 @@ def _main():
     parser.add_argument('--search_buffer_size', type=int, default=5,
                         help='Width (one side) of search buffer. Larger values makes search more likely to recover from errors but increases runtime.')
 
+    parser.add_argument('-o', '--output', type=str, nargs='+', required=False,
+                        help='Write the alignments of each source file here instead of to stdout; '
+                             'files ending in .npz get the binary alignment_table format')
+
     parser.add_argument('--debug_save_stack', type=str,
                         help='Write stack to pickle file for debug purposes')
 
@@ -93,6 +131,9 @@ def _main():
         if len(args.gold_alignment) != len(args.src):
             raise Exception('number of gold alignment files, if provided, must match number of source and target files')
 
+    if args.output is not None and len(args.output) != len(args.src):
+        raise Exception('number of output files, if provided, must match number of source and target files')
+
     if args.verbose:
         import logging
         logger.setLevel(logging.INFO)
@@ -101,21 +142,41 @@ def _main():
         logger.warning('Alignment_max_size < 2. Increasing to 2 so that 1-1 alignments will be considered')
         args.alignment_max_size = 2
 
-    src_sent2line, src_line_embeddings = read_in_embeddings(args.src_embed[0], args.src_embed[1])
-    tgt_sent2line, tgt_line_embeddings = read_in_embeddings(args.tgt_embed[0], args.tgt_embed[1])
+    src_embeds = split_embed_args(args.src_embed, len(args.src), bool(args.embed_cache_dir))
+    tgt_embeds = split_embed_args(args.tgt_embed, len(args.tgt), bool(args.embed_cache_dir))
+
+    cache = get_embedding_cache(MODEL_PATH, MAX_SEQ_LENGTH, cache_dir=args.embed_cache_dir)
+    # the last embeddings read for each side, so that shared ones are read only once
+    loaded = dict()
+
+    def load_embeddings(side, embed):
+        if side not in loaded or loaded[side][0] != embed:
+            sent2line, line_embeddings = read_in_embeddings(*embed, cache=cache)
+            if isinstance(sent2line, EmbeddingStore) and sent2line.depths \
+                    and max(sent2line.depths) < args.alignment_max_size:
+                logger.warning('%s only holds overlays of up to %d lines, the rest get random vectors; '
+                               'rerun get_vectors.py with %d overlays to add them',
+                               embed[0], max(sent2line.depths), args.alignment_max_size)
+            loaded[side] = embed, sent2line, line_embeddings
+        return loaded[side][1:]
 
     width_over2 = ceil(args.alignment_max_size / 2.0) + args.search_buffer_size
 
     test_alignments = []
     stack_list = []
-    for src_file, tgt_file in zip(args.src, args.tgt):
+    for ii, (src_file, tgt_file) in enumerate(zip(args.src, args.tgt)):
         logger.info('Aligning src="%s" to tgt="%s"', src_file, tgt_file)
 
+        src_sent2line, src_line_embeddings = load_embeddings('src', src_embeds[ii])
+        tgt_sent2line, tgt_line_embeddings = load_embeddings('tgt', tgt_embeds[ii])
+
         src_lines = open(src_file, 'rt', encoding="utf-8").readlines()
-        vecs0 = make_doc_embedding(src_sent2line, src_line_embeddings, src_lines, args.alignment_max_size)
+        vecs0 = make_doc_embedding(src_sent2line, src_line_embeddings, src_lines, args.alignment_max_size,
+                                   cache=cache)
 
         tgt_lines = open(tgt_file, 'rt', encoding="utf-8").readlines()
-        vecs1 = make_doc_embedding(tgt_sent2line, tgt_line_embeddings, tgt_lines, args.alignment_max_size)
+        vecs1 = make_doc_embedding(tgt_sent2line, tgt_line_embeddings, tgt_lines, args.alignment_max_size,
+                                   cache=cache)
 
         final_alignment_types = make_alignment_types(args.alignment_max_size)
         logger.debug('Considering alignment types %s', final_alignment_types)
@@ -129,8 +190,15 @@ def _main():
                          costs_sample_size=args.costs_sample_size,
                          num_samps_for_norm=args.num_samps_for_norm)
 
-        # write final alignments to stdout
-        print_alignments(stack[0]['final_alignments'], stack[0]['alignment_scores'])
+        if args.output is None:
+            # write final alignments to stdout
+            print_alignments(stack[0]['final_alignments'], stack[0]['alignment_scores'])
+        elif args.output[ii].endswith('.npz'):
+            AlignmentTable.from_alignments(stack[0]['final_alignments'],
+                                           stack[0]['alignment_scores']).save(args.output[ii])
+        else:
+            with open(args.output[ii], 'wt', encoding='utf-8') as fout:
+                print_alignments(stack[0]['final_alignments'], stack[0]['alignment_scores'], file=fout)
 
         test_alignments.append(stack[0]['final_alignments'])
         stack_list.append(stack)